@@ -0,0 +1,151 @@
+"""
+Benchmark for loading log entries with lazily decoded fields.
+
+The ``args``, ``extra`` and ``exc_text`` fields of ``LogEntryDetail`` are only
+decoded when they are accessed. Before, ``JSONField`` and ``TupleField``
+decoded every value that was loaded. The "eager" timings below load the same
+rows with copies of these earlier fields, for comparison.
+
+Usage, from the directory containing the testproject::
+
+    python benchmarks/load_entries.py [number of entries]
+
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ['DJANGO_SETTINGS_MODULE'] = 'testproject.settings'
+
+from django.conf import settings
+
+db_file = tempfile.mktemp(suffix='.db')
+settings.DATABASES['default']['NAME'] = db_file
+settings.DEBUG = False
+
+import logging
+logging.getLogger().handlers = []
+
+from django.core.management import call_command
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, models, transaction
+from django.utils import simplejson as json
+
+from djangologdb.models import LogEntry, LogEntryDetail
+
+class EagerJSONField(models.TextField):
+    """
+    The earlier `JSONField`, which decodes values when they are loaded.
+    """
+    __metaclass__ = models.SubfieldBase
+
+    def to_python(self, value):
+        if isinstance(value, basestring) and value:
+            try:
+                value = json.loads(value)
+            except ValueError:
+                return None
+
+        return value
+
+    def get_db_prep_save(self, value, connection):
+        if value is None:
+            return None
+
+        value = json.dumps(value, cls=DjangoJSONEncoder)
+        return super(EagerJSONField, self).get_db_prep_save(value, connection=connection)
+
+class EagerTupleField(models.TextField):
+    """
+    The earlier `TupleField`, which decodes values when they are loaded.
+    """
+    __metaclass__ = models.SubfieldBase
+
+    def to_python(self, value):
+        if value is None:
+            return None
+
+        if isinstance(value, basestring):
+            try:
+                value = tuple(json.loads(value))
+            except ValueError:
+                return None
+
+        return value
+
+    def get_db_prep_save(self, value, connection):
+        if value is None:
+            return None
+
+        value = json.dumps(value, cls=DjangoJSONEncoder)
+        return super(EagerTupleField, self).get_db_prep_save(value, connection=connection)
+
+class EagerLogEntryDetail(models.Model):
+    """
+    The log entry details with the earlier fields, on the same table.
+    """
+    log_entry_id = models.IntegerField(primary_key=True)
+    args = EagerTupleField(blank=True, null=True)
+    exc_text = models.TextField(blank=True, null=True)
+    extra = EagerJSONField(blank=True)
+
+    class Meta:
+        app_label = 'djangologdb'
+        db_table = LogEntryDetail._meta.db_table
+        managed = False
+
+def timed(label, func):
+    start = time.time()
+    result = func()
+    print '%-40s %8.3fs' % (label, time.time() - start)
+    return result
+
+def create_entries(count):
+    """
+    Insert `count` log entries with details directly, which is a lot faster
+    than creating them one by one.
+    """
+    cursor = connection.cursor()
+    cursor.executemany(
+        'INSERT INTO %s (id, filename, function_name, level, line_number, module, msg, name, path, created, process, process_name, thread, thread_name) VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s)' % LogEntry._meta.db_table,
+        [(i, 'views.py', 'index', logging.INFO, 10, 'views', 'Request %s from %s', 'testproject', '/testproject/views.py', '2010-01-01 00:00:00', 1, 'MainProcess', 1, 'MainThread') for i in xrange(1, count + 1)]
+    )
+    cursor.executemany(
+        'INSERT INTO %s (log_entry_id, args, exc_text, extra) VALUES (%%s, %%s, %%s, %%s)' % LogEntryDetail._meta.db_table,
+        [(i, '["%d", "127.0.0.1"]' % i, None, '{"ip_address": "127.0.0.1", "user": "%d"}' % i) for i in xrange(1, count + 1)]
+    )
+    transaction.commit_unless_managed()
+
+def load(model, decode):
+    for detail in model.objects.all().iterator():
+        if decode:
+            detail.args, detail.extra, detail.exc_text
+
+def save(model, decode, count):
+    for detail in model.objects.all()[:count].iterator():
+        if decode:
+            detail.args, detail.extra, detail.exc_text
+        detail.save()
+    transaction.commit_unless_managed()
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    save_count = min(count, 10000)
+
+    try:
+        call_command('syncdb', interactive=False, verbosity=0)
+        timed('Create %d entries' % count, lambda: create_entries(count))
+
+        timed('Load %d entries, eager' % count, lambda: load(EagerLogEntryDetail, True))
+        timed('Load %d entries, lazy, decode all' % count, lambda: load(LogEntryDetail, True))
+        timed('Load %d entries, lazy, decode none' % count, lambda: load(LogEntryDetail, False))
+        timed('Save %d entries, eager' % save_count, lambda: save(EagerLogEntryDetail, True, save_count))
+        timed('Save %d entries, lazy, decode all' % save_count, lambda: save(LogEntryDetail, True, save_count))
+        timed('Save %d entries, lazy, decode none' % save_count, lambda: save(LogEntryDetail, False, save_count))
+    finally:
+        os.remove(db_file)
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,175 @@
+import datetime
+
 from django.contrib import admin
+from django.contrib.admin.filterspecs import FilterSpec
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
 from django.utils.translation import ugettext
 from django.utils.encoding import force_unicode
 
-from models import LogEntry, LogAggregate
+from models import LogEntry, LogAggregate, LogString
 from djangologdb import settings as djangologdb_settings
+from djangologdb.utils import InternedCharField
+from djangologdb.replicas import get_read_database
+
+class InternedFilterSpec(FilterSpec):
+    """
+    Shows the string values of an `InternedCharField` rather than their ids.
+    """
+    def __init__(self, f, request, params, model, model_admin):
+        super(InternedFilterSpec, self).__init__(f, request, params, model, model_admin)
+        self.lookup_val = request.GET.get(f.name, None)
+        # The strings are in the dictionary of the database of the log entries.
+        queryset = model_admin.queryset(request)
+        ids = queryset.order_by().values(f.name).distinct()
+        self.lookup_choices = LogString.objects.using(queryset.db).filter(pk__in=ids).order_by('value').values_list('value', flat=True)
+
+    def choices(self, cl):
+        yield {
+            'selected': self.lookup_val is None,
+            'query_string': cl.get_query_string({}, [self.field.name]),
+            'display': ugettext('All'),
+        }
+        for val in self.lookup_choices:
+            yield {
+                'selected': self.lookup_val == val,
+                'query_string': cl.get_query_string({self.field.name: val}),
+                'display': val,
+            }
+
+# The default filter specs match any field, so this one needs to go first.
+FilterSpec.filter_specs.insert(0, (lambda f: isinstance(f, InternedCharField), InternedFilterSpec))
+
+# The parameter that selects the shard to show, see `LOGDB_SHARDS`.
+SHARD_VAR = 'shard'
+
+def _get_shard(request):
+    shard = request.GET.get(SHARD_VAR)
+    if shard not in djangologdb_settings.SHARDS:
+        shard = djangologdb_settings.SHARDS[0]
+    return shard
+
+def _use_read_database(queryset, request):
+    """
+    Uses the database for read-only queries for `queryset` if `request` only
+    views a changelist. Other views and actions use the primary database.
+    
+    If the log entries are sharded, all views use the shard that is selected
+    in `request`.
+    """
+    if djangologdb_settings.SHARDS:
+        return queryset.using(_get_shard(request))
+    if getattr(request, 'logdb_read_only', False):
+        return queryset.using(get_read_database())
+    return queryset
 
 class LogEntryInline(admin.TabularInline):
     model = LogEntry
 
+class ShardChangeList(ChangeList):
+    """
+    Leaves the shard parameter to the queryset of the model admin, and keeps
+    it in the links to the objects.
+    """
+    def get_query_set(self):
+        params = self.params
+        self.params = dict([(k, v) for k, v in params.items() if k != SHARD_VAR])
+        try:
+            return super(ShardChangeList, self).get_query_set()
+        finally:
+            self.params = params
+
+    def url_for_result(self, result):
+        url = super(ShardChangeList, self).url_for_result(result)
+        if djangologdb_settings.SHARDS:
+            url = '%s?%s=%s' % (url, SHARD_VAR, result._state.db)
+        return url
+
+class DateRangeChangeList(ShardChangeList):
+    """
+    Filters on the date hierarchy with a range instead of on the year, month and
+    day of the date, so the database can use the index (and partitions) of the
+    date field.
+    """
+    def get_query_set(self):
+        field = self.date_hierarchy
+        year = self.params.get('%s__year' % field)
+        if field is None or year is None:
+            return super(DateRangeChangeList, self).get_query_set()
+
+        month = self.params.get('%s__month' % field)
+        day = self.params.get('%s__day' % field)
+        try:
+            start = datetime.datetime(int(year), int(month or 1), int(day or 1))
+        except ValueError:
+            raise IncorrectLookupParameters
+
+        if day is not None:
+            end = start + datetime.timedelta(1)
+        elif month is not None:
+            end = (start + datetime.timedelta(32)).replace(day=1)
+        else:
+            end = start.replace(year=start.year + 1)
+
+        # The date hierarchy parameters are still needed to render the page.
+        params = self.params
+        self.params = dict([(k, v) for k, v in params.items() if not k.startswith('%s__' % field)])
+        try:
+            qs = super(DateRangeChangeList, self).get_query_set()
+        finally:
+            self.params = params
+
+        return qs.filter(**{'%s__gte' % field: start, '%s__lt' % field: end})
+
+class SearchChangeList(DateRangeChangeList):
+    """
+    Searches with the `search` method of the queryset, which uses the search
+    index, instead of with the `search_fields` of the model admin.
+    """
+    def get_query_set(self):
+        query = self.query
+        self.query = ''
+        try:
+            qs = super(SearchChangeList, self).get_query_set()
+        finally:
+            self.query = query
+
+        if query:
+            qs = qs.search(query)
+        return qs
+
+class ExtraChangeList(SearchChangeList):
+    """
+    Filters log entries on their indexed extra attributes with `filter_extra`,
+    for parameters like ``extra__ip_address=127.0.0.1``.
+    """
+    def get_query_set(self):
+        params = self.params
+        self.params = dict([(k, v) for k, v in params.items() if not k.startswith('extra__')])
+        try:
+            qs = super(ExtraChangeList, self).get_query_set()
+        finally:
+            self.params = params
+
+        try:
+            extra = dict([(str(k[len('extra__'):]), v) for k, v in params.items() if k.startswith('extra__')])
+            if extra:
+                qs = qs.filter_extra(**extra)
+        except (UnicodeEncodeError, ValueError):
+            raise IncorrectLookupParameters
+        return qs
+
 class LogAggregateOptions(admin.ModelAdmin):
-    list_display = ('name', 'module', 'function_name', 'line_number', 'level', 'last_seen', 'times_seen',)
-    list_filter = ('name', 'level',)
+    list_display = ('name', 'module', 'function_name', 'line_number', 'level', 'last_seen', 'times_seen', 'get_sparkline',)
+    list_filter = ('name', 'level', 'is_overflow',)
     date_hierarchy = 'last_seen'
     ordering = ('-last_seen',)
     inlines = (LogEntryInline,)
+    # Only used to show the search box, see `SearchChangeList`.
+    search_fields = djangologdb_settings.SEARCH_INDEX and ('msg',) or ()
+
+    def get_changelist(self, request, **kwargs):
+        return SearchChangeList
 
     def change_view(self, request, object_id, extra_context=None):
         djangologdb_context = {
@@ -23,19 +179,31 @@ class LogAggregateOptions(admin.ModelAdmin):
         }
         return super(LogAggregateOptions, self).change_view(request, object_id, extra_context=djangologdb_context)
 
+    def queryset(self, request):
+        return _use_read_database(super(LogAggregateOptions, self).queryset(request), request)
+
     def changelist_view(self, request, extra_context=None):
         djangologdb_context = {
             'djangologdb_settings': djangologdb_settings,
             'aggregate': 'checksum',
             'title': ugettext('Select %s to view') % force_unicode(self.opts.verbose_name),
         }
+        if djangologdb_settings.SHARDS:
+            djangologdb_context['djangologdb_shard'] = _get_shard(request)
+        if request.method == 'GET':
+            request.logdb_read_only = True
         return super(LogAggregateOptions, self).changelist_view(request, extra_context=djangologdb_context)
 
 class LogEntryOptions(admin.ModelAdmin):
-    list_display = ('created', 'level', 'name', 'module', 'function_name', 'line_number', 'process', 'thread', 'get_message_display', 'extra')
+    list_display = ('created', 'level', 'name', 'module', 'function_name', 'line_number', 'process', 'thread', 'get_msg_display')
     list_filter = ('name', 'level',)
     date_hierarchy = 'created'
     ordering = ('-created',)
+    # Only used to show the search box, see `SearchChangeList`.
+    search_fields = djangologdb_settings.SEARCH_INDEX and ('msg',) or ()
+
+    def get_changelist(self, request, **kwargs):
+        return ExtraChangeList
 
     def change_view(self, request, object_id, extra_context=None):
         djangologdb_context = {
@@ -44,12 +212,19 @@ class LogEntryOptions(admin.ModelAdmin):
         }
         return super(LogEntryOptions, self).change_view(request, object_id, extra_context=djangologdb_context)
 
+    def queryset(self, request):
+        return _use_read_database(super(LogEntryOptions, self).queryset(request), request)
+
     def changelist_view(self, request, extra_context=None):
         djangologdb_context = {
             'djangologdb_settings': djangologdb_settings,
             'aggregate': 'level',
             'title': ugettext('Select %s to view') % force_unicode(self.opts.verbose_name),
         }
+        if djangologdb_settings.SHARDS:
+            djangologdb_context['djangologdb_shard'] = _get_shard(request)
+        if request.method == 'GET':
+            request.logdb_read_only = True
         return super(LogEntryOptions, self).changelist_view(request, extra_context=djangologdb_context)
 
 admin.site.register(LogAggregate, LogAggregateOptions)
@@ -0,0 +1,75 @@
+"""
+The grouping of log entries into log aggregates, shared by the 
+`aggregate_logs` and `rebuild_aggregates` commands.
+"""
+from django.utils.hashcompat import md5_constructor
+
+from djangologdb.models import LogTemplate
+
+def get_checksum(log_entry, template_tree=None, learn=True):
+    """
+    Returns the checksum of the log aggregate for `log_entry`, and the values
+    for a new log aggregate.
+    
+    If a `template_tree` is given, pre-formatted messages are aggregated by
+    their template. New and changed templates are only stored if `learn` is
+    ``True``, otherwise only the existing templates are used.
+    """
+    entries = {
+        'filename': log_entry.filename,
+        'function_name': log_entry.function_name,
+        'level': log_entry.level,
+        'line_number': log_entry.line_number,
+        'module': log_entry.module,
+        'msg': log_entry.msg,
+        'name': log_entry.name,
+        'path': log_entry.path,
+    }
+    if log_entry.fingerprint:
+        # Log entries with an exception trace are aggregated by the exception
+        # and where it was raised, instead of by where it was logged. Their
+        # messages often contain the exception message.
+        checksum = md5_constructor(str({
+            'fingerprint': log_entry.fingerprint,
+            'level': log_entry.level,
+            'name': log_entry.name,
+        }))
+        return checksum.hexdigest(), entries
+
+    cluster = None
+    if template_tree is not None and '%' not in (log_entry.msg or ''):
+        # Messages without format string were probably formatted before they
+        # were logged, so they are aggregated by their template.
+        if learn:
+            cluster, is_changed = template_tree.cluster(log_entry.msg)
+            if is_changed:
+                LogTemplate.objects.db_manager(log_entry._state.db).save_cluster(cluster)
+        else:
+            cluster = template_tree.match(log_entry.msg)
+
+    if cluster is not None:
+        checksum = md5_constructor(str(dict(entries, msg=None, template=cluster.id)))
+        entries['msg'] = cluster.get_template()
+    else:
+        checksum = md5_constructor(str(entries))
+    return checksum.hexdigest(), entries
+
+def get_overflow_checksum(name, level):
+    """
+    Returns the checksum of the overflow log aggregate of the logger `name`, 
+    and the values for a new one with `level`. See the
+    `LOGDB_MAX_AGGREGATES_PER_LOGGER` setting.
+    """
+    entries = {
+        'filename': None,
+        'function_name': None,
+        'level': level,
+        'line_number': 0,
+        'module': None,
+        'msg': u'(django-logdb: Log entries beyond the maximum number of log aggregates of this logger)',
+        'name': name,
+        'path': None,
+        'is_overflow': True,
+    }
+    checksum = md5_constructor(str({'overflow': name}))
+    return checksum.hexdigest(), entries
@@ -0,0 +1,233 @@
+"""
+Archived log entries.
+
+The `archive_logs` command moves old log entries out of the database into
+segment files in `LOGDB_ARCHIVE_DIR`. Segments are never changed after they
+are written and only keep what the graphs need: the time, level and checksum
+of each log entry, sorted by time. `LogQuerySet.get_datasets` adds the log
+entries in the segments to those in the database.
+
+A segment file consists of:
+
+* A header (`HEADER`) with a magic string, the number of log entries, the
+  number of log entries per index entry, the number of index entries and the
+  length of the summary.
+* The summary, a JSON object with the time of the first and the last log entry,
+  the number of log entries per level and the checksum, name and number of log
+  entries of each log aggregate.
+* A sparse index with the time of every `INDEX_STEP`th log entry (`INDEX`).
+* The log entries (`RECORD`) with their time, level and the position of their
+  log aggregate in the summary, or `NO_AGGREGATE`.
+
+Times are stored as Javascript timestamps (see `get_timestamp`), including the
+milliseconds. Segments are memory-mapped when they are read, so only the parts
+of a segment that are needed for a graph are loaded from disk.
+"""
+import bisect
+import datetime
+import logging
+import mmap
+import os
+import struct
+import threading
+
+from django.utils import simplejson
+
+from djangologdb import settings as djangologdb_settings
+from djangologdb.utils import get_timestamp
+
+MAGIC = 'LOGDBSG1'
+HEADER = struct.Struct('<8sIIII')
+INDEX = struct.Struct('<d')
+RECORD = struct.Struct('<dHI')
+
+INDEX_STEP = 256
+NO_AGGREGATE = 0xffffffff
+EXTENSION = '.seg'
+
+def get_exact_timestamp(date_time):
+    """
+    Like `get_timestamp`, but keeps the milliseconds.
+    """
+    return get_timestamp(date_time) + date_time.microsecond / 1000.0
+
+def write_segment(path, rows):
+    """
+    Writes a segment with the log entries in `rows` to `path` and returns the
+    number of log entries. The rows are tuples with the `created` date, the
+    level and the checksum and name of the log aggregate (or ``None``), sorted
+    by `created`.
+
+    The segment is written to a temporary file first, so a segment is either
+    complete or does not exist.
+    """
+    levels = {}
+    checksums = []
+    positions = {}
+    index = []
+    records = []
+    timestamp = None
+    for created, level, checksum, name in rows:
+        timestamp = get_exact_timestamp(created)
+        if len(records) % INDEX_STEP == 0:
+            index.append(timestamp)
+
+        levels[level] = levels.get(level, 0) + 1
+        if checksum is None:
+            position = NO_AGGREGATE
+        else:
+            position = positions.get(checksum)
+            if position is None:
+                position = positions[checksum] = len(checksums)
+                checksums.append([checksum, name, 0])
+            checksums[position][2] += 1
+
+        records.append(RECORD.pack(timestamp, level, position))
+
+    if len(records) == 0:
+        raise ValueError('A segment needs at least one log entry.')
+
+    summary = simplejson.dumps({
+        'start': index[0],
+        'end': timestamp,
+        'levels': levels.items(),
+        'checksums': checksums,
+    })
+
+    f = open(path + '.tmp', 'wb')
+    try:
+        f.write(HEADER.pack(MAGIC, len(records), INDEX_STEP, len(index), len(summary)))
+        f.write(summary)
+        f.write(''.join([INDEX.pack(timestamp) for timestamp in index]))
+        f.write(''.join(records))
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(path + '.tmp', path)
+
+    return len(records)
+
+class Segment(object):
+    """
+    A memory-mapped segment file.
+    """
+    def __init__(self, path):
+        self.path = path
+
+        f = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        magic, self.count, self.index_step, index_count, summary_length = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a segment file.' % path)
+
+        offset = HEADER.size
+        summary = simplejson.loads(self.map[offset:offset + summary_length])
+        self.start = summary['start']
+        self.end = summary['end']
+        self.levels = dict(summary['levels'])
+        self.checksums = summary['checksums']
+
+        offset += summary_length
+        self.index = [INDEX.unpack_from(self.map, offset + i * INDEX.size)[0] for i in range(index_count)]
+        self.records_offset = offset + index_count * INDEX.size
+
+    def get_start_date(self):
+        return datetime.datetime.fromtimestamp(self.start / 1000)
+
+    def get_end_date(self):
+        return datetime.datetime.fromtimestamp(self.end / 1000)
+
+    def iter_records(self, start, end):
+        """
+        Yields the time, level and log aggregate position of the log entries
+        from the timestamp `start` up to `end`.
+        """
+        # The index entry before the first one at or after `start` is the last
+        # one before it, so its log entries may be in the range.
+        i = max(bisect.bisect_left(self.index, start) - 1, 0) * self.index_step
+        while i < self.count:
+            timestamp, level, position = RECORD.unpack_from(self.map, self.records_offset + i * RECORD.size)
+            if timestamp >= end:
+                break
+            if timestamp >= start:
+                yield timestamp, level, position
+            i += 1
+
+_lock = threading.Lock()
+_segments = {}
+
+def get_segments(directory=None):
+    """
+    Returns the segments in `directory`, ordered by time. The default is the
+    `LOGDB_ARCHIVE_DIR` setting. Segments stay mapped between calls.
+    """
+    if directory is None:
+        directory = djangologdb_settings.ARCHIVE_DIR
+    if directory is None or not os.path.isdir(directory):
+        return []
+
+    paths = [os.path.join(directory, filename) for filename in os.listdir(directory) if filename.endswith(EXTENSION)]
+
+    _lock.acquire()
+    try:
+        # Forget segments that were removed. They are unmapped once no other
+        # thread is reading them.
+        for path in _segments.keys():
+            if os.path.dirname(path) == directory and path not in paths:
+                del _segments[path]
+
+        segments = []
+        for path in paths:
+            if path not in _segments:
+                _segments[path] = Segment(path)
+            segments.append(_segments[path])
+    finally:
+        _lock.release()
+
+    segments.sort(key=lambda segment: segment.start)
+    return segments
+
+def get_counts(segments, boundaries, aggregate):
+    """
+    Returns the number of log entries in `segments` per level or checksum (see
+    `aggregate`) between each two consecutive timestamps in `boundaries`, as a
+    dictionary with the `label` and a list of `counts` per level or checksum.
+    """
+    counts = {}
+
+    def get_counts_of(key, label):
+        if key not in counts:
+            counts[key] = {'label': label, 'counts': [0] * (len(boundaries) - 1)}
+        return counts[key]['counts']
+
+    for segment in segments:
+        if segment.end < boundaries[0] or segment.start >= boundaries[-1]:
+            continue
+
+        # Use the summary if the whole segment is in one period.
+        period = bisect.bisect_right(boundaries, segment.start) - 1
+        if period >= 0 and segment.end < boundaries[period + 1]:
+            if aggregate == 'checksum':
+                for checksum, name, count in segment.checksums:
+                    get_counts_of(checksum, name)[period] += count
+            else:
+                for level, count in segment.levels.items():
+                    get_counts_of(level, logging.getLevelName(level))[period] += count
+            continue
+
+        for timestamp, level, position in segment.iter_records(boundaries[0], boundaries[-1]):
+            period = bisect.bisect_right(boundaries, timestamp) - 1
+            if aggregate == 'checksum':
+                if position == NO_AGGREGATE:
+                    continue
+                checksum, name, count = segment.checksums[position]
+                get_counts_of(checksum, name)[period] += 1
+            else:
+                get_counts_of(level, logging.getLevelName(level))[period] += 1
+
+    return counts
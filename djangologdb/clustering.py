@@ -0,0 +1,126 @@
+"""
+Online clustering of log messages into message templates.
+
+Log messages that are formatted before they are logged differ in their
+variable parts, like ids, durations or host names. The messages are clustered
+with a fixed depth parse tree, as in the Drain algorithm: messages are first
+grouped by their number of tokens and by their leading tokens, and then
+compared only with the templates in that group. A template is a message in
+which the tokens that differ between its messages are replaced by a wildcard.
+
+Finding the template of a message only takes a few dictionary lookups and a
+comparison with a small number of templates.
+"""
+WILDCARD = u'<*>'
+
+class Cluster(object):
+    """
+    A message template, which is a list of tokens. The `id` is for the user of
+    the tree, like the primary key of a stored template.
+    """
+    def __init__(self, tokens, id=None):
+        self.tokens = tokens
+        self.id = id
+
+    def get_template(self):
+        return u' '.join(self.tokens)
+
+    def get_similarity(self, tokens):
+        """
+        Returns the fraction of `tokens` that are equal to the tokens of the
+        template. The messages should have the same number of tokens.
+        """
+        if not tokens:
+            return 1.0
+
+        equal = 0
+        for template_token, token in zip(self.tokens, tokens):
+            if template_token == token:
+                equal += 1
+        return float(equal) / len(tokens)
+
+    def merge(self, tokens):
+        """
+        Replaces the tokens of the template that differ from `tokens` by a
+        wildcard. Returns ``True`` if the template changed.
+        """
+        is_changed = False
+        for i, (template_token, token) in enumerate(zip(self.tokens, tokens)):
+            if template_token != token and template_token != WILDCARD:
+                self.tokens[i] = WILDCARD
+                is_changed = True
+        return is_changed
+
+def tokenize(msg):
+    return (msg or u'').split()
+
+def _has_digits(token):
+    for c in token:
+        if c.isdigit():
+            return True
+    return False
+
+class TemplateTree(object):
+    """
+    The parse tree. The first level groups the templates by their number of
+    tokens, the next `depth` - 2 levels by their leading tokens. The leaves
+    contain the templates.
+    """
+    def __init__(self, similarity=0.5, depth=4, max_children=100):
+        self.similarity = similarity
+        self.depth = depth
+        self.max_children = max_children
+        self.root = {}
+
+    def _get_leaf(self, tokens):
+        node = self.root.setdefault(len(tokens), {})
+        for token in tokens[:self.depth - 2]:
+            # Tokens with digits are likely variable, and the number of
+            # children of a node is limited to keep the tree small.
+            if _has_digits(token):
+                token = WILDCARD
+            if token not in node and len(node) >= self.max_children:
+                token = WILDCARD
+            node = node.setdefault(token, {})
+
+        return node.setdefault(None, [])
+
+    def add(self, cluster):
+        """
+        Adds an existing `cluster` to the tree.
+        """
+        self._get_leaf(cluster.tokens).append(cluster)
+
+    def _match(self, leaf, tokens):
+        best_cluster = None
+        best_similarity = -1
+        for cluster in leaf:
+            similarity = cluster.get_similarity(tokens)
+            if similarity > best_similarity:
+                best_cluster, best_similarity = cluster, similarity
+
+        if best_cluster is not None and best_similarity >= self.similarity:
+            return best_cluster
+        return None
+
+    def match(self, msg):
+        """
+        Returns the cluster of `msg` or ``None``, without changing the tree.
+        """
+        tokens = tokenize(msg)
+        return self._match(self._get_leaf(tokens), tokens)
+
+    def cluster(self, msg):
+        """
+        Returns the cluster of `msg` and whether it was created or changed.
+        """
+        tokens = tokenize(msg)
+        leaf = self._get_leaf(tokens)
+
+        cluster = self._match(leaf, tokens)
+        if cluster is not None:
+            return cluster, cluster.merge(tokens)
+
+        cluster = Cluster(tokens)
+        leaf.append(cluster)
+        return cluster, True
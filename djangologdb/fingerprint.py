@@ -0,0 +1,84 @@
+"""
+Fingerprints of exception traces.
+
+Two exception traces get the same fingerprint if the same type of exception
+was raised through the same frames. Line numbers, memory addresses and quoted
+values in the trace are ignored, so a fingerprint survives small code changes
+and does not depend on the values that caused the exception.
+"""
+import re
+
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import md5_constructor
+
+FRAME_RE = re.compile(r'^\s*File "(?P<filename>.*)", line \d+(?:, in (?P<function_name>.*))?$')
+EXCEPTION_RE = re.compile(r'^(?P<type>[A-Za-z_][\w.]*)(?::|$)')
+ADDRESS_RE = re.compile(r'\b0x[0-9a-fA-F]+\b')
+QUOTED_RE = re.compile(r'''u?(?:'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")''')
+NUMBER_RE = re.compile(r'\b\d+\b')
+
+# Fingerprints by the hash of the raw exception trace. The same exception is
+# often logged many times, so this saves parsing the trace again.
+cache_size = 1000
+_fingerprints = {}
+
+def normalize_line(line):
+    """
+    Replaces the memory addresses, quoted values and numbers in `line`.
+    """
+    line = ADDRESS_RE.sub('0x?', line)
+    line = QUOTED_RE.sub("'?'", line)
+    return NUMBER_RE.sub('?', line.strip())
+
+def normalize_traceback(exc_text):
+    """
+    Returns the exception type and the normalized frames of the exception trace
+    `exc_text` as a list of lines, or ``None`` if `exc_text` does not contain an
+    exception trace.
+    """
+    lines = []
+    exc_type = None
+    in_frames = False
+    for line in exc_text.splitlines():
+        match = FRAME_RE.match(line)
+        if match is not None:
+            lines.append(u'%s in %s' % (match.group('filename'), match.group('function_name')))
+            in_frames = True
+        elif in_frames and line.startswith(' '):
+            # The source code line of the frame.
+            lines.append(normalize_line(line))
+        elif in_frames:
+            # The first line after the frames names the exception.
+            match = EXCEPTION_RE.match(line)
+            if match is not None:
+                exc_type = match.group('type')
+            in_frames = False
+
+    if exc_type is None:
+        return None
+    return [exc_type] + lines
+
+def get_fingerprint(exc_text):
+    """
+    Returns the fingerprint (an MD5 hex digest) of the exception trace
+    `exc_text`, or ``None`` if there is no exception trace.
+    """
+    if not exc_text:
+        return None
+
+    key = md5_constructor(smart_str(exc_text)).digest()
+    try:
+        return _fingerprints[key]
+    except KeyError:
+        pass
+
+    lines = normalize_traceback(exc_text)
+    if lines is None:
+        fingerprint = None
+    else:
+        fingerprint = md5_constructor(smart_str(u'\n'.join(lines))).hexdigest()
+
+    if len(_fingerprints) >= cache_size:
+        _fingerprints.clear()
+    _fingerprints[key] = fingerprint
+    return fingerprint
@@ -1,5 +1,52 @@
 import logging
 import logging.handlers
+import os
+import sys
+import threading
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+
+# The log entries of the current thread that are not written yet, if records
+# are batched. See `start_batch`.
+_batch = threading.local()
+
+# The modules that need the Django settings, imported by `_setup`.
+LogEntry = None
+djangologdb_settings = None
+stats = None
+connections = None
+transaction = None
+DatabaseError = None
+load_backend = None
+get_shard = None
+
+def _setup():
+    """
+    Imports the modules that need the Django settings, once. Returns whether
+    Django is ready to write log entries.
+    """
+    global LogEntry, djangologdb_settings, stats, connections, transaction, DatabaseError, load_backend, get_shard
+
+    if LogEntry is not None:
+        return True
+    # Using the settings while their own module is imported, when it adds this
+    # handler or logs, would load them incomplete.
+    from django.conf import settings, ENVIRONMENT_VARIABLE
+    if not settings.configured and os.environ.get(ENVIRONMENT_VARIABLE) in sys.modules:
+        return False
+
+    try:
+        from django.db import connections, transaction, DatabaseError
+        from django.db.utils import load_backend
+        from djangologdb import settings as djangologdb_settings, stats
+        from djangologdb.shards import get_shard
+        from djangologdb.models import LogEntry as log_entry_model
+    except (ImportError, ImproperlyConfigured):
+        return False
+
+    LogEntry = log_entry_model
+    return True
 
 class DjangoDatabaseHandler(logging.Handler):
     """
@@ -23,6 +70,11 @@ class DjangoDatabaseHandler(logging.Handler):
         # from djangologdb.handler import add_handler
         # add_handler(logger, DjangoDatabaseHandler())
         
+    Records that are logged before Django is ready, like errors while loading
+    the settings, are kept in memory and written at once with the first record
+    after that (or when logging shuts down). At most `buffer_size` records are
+    kept, later ones are dropped.
+        
     To use this handler via a config file, simply import this module in your
     Django settings before loading the configuration from a file::
     
@@ -43,20 +95,248 @@ class DjangoDatabaseHandler(logging.Handler):
         class=handlers.DjangoDatabaseHandler
         args=()
         
+    If the `LOGDB_DATABASE` setting is set, log entries are written to that
+    database using a separate, persistent connection. Log entries are then 
+    committed immediately, regardless of any transaction of the application, 
+    and the connection is not closed at the end of each request. The same goes
+    for the shard of each record if the `LOGDB_SHARDS` setting is set.
     """
-    def emit(self, record):
-        from models import LogEntry
+    # Check a persistent connection that was not used for this many seconds
+    # before writing to it.
+    health_check_interval = 60
+
+    # The maximum number of records to keep until Django is ready.
+    buffer_size = 1000
+
+    def __init__(self, using=None):
+        logging.Handler.__init__(self)
+        self.using = using
+        self.buffer = []
+        self.dropped = 0
 
+    def get_database(self, name=None):
+        """
+        Returns the database alias to write log entries of the logger `name` 
+        to, or ``None`` to leave it up to the database routers.
+        
+        A dedicated log database gets its own connection under a separate 
+        alias. Django only closes the connections in `settings.DATABASES` at the
+        end of a request, so this connection stays open.
+        """
+        using = self.using or get_shard(name) or djangologdb_settings.DATABASE
+        if using is None:
+            return None
+
+        alias = 'djangologdb.handler.%s' % using
+        if alias not in connections._connections:
+            connections.ensure_defaults(using)
+            settings_dict = connections.databases[using]
+            backend = load_backend(settings_dict['ENGINE'])
+            connections._connections[alias] = backend.DatabaseWrapper(settings_dict, alias)
+        return alias
+
+    def _check_connection(self, using):
+        """
+        Closes the connection for `using` if it was idle for a while and does 
+        not respond anymore. Django reconnects when it is used again.
+        """
+        connection = connections[using]
+        now = time.time()
+        last_used = getattr(connection, 'djangologdb_last_used', now)
+        connection.djangologdb_last_used = now
+        if connection.connection is None or now - last_used < self.health_check_interval:
+            return
+
+        try:
+            connection.cursor().execute('SELECT 1')
+        except Exception:
+            connection.close()
+
+    def emit(self, record):
         try:
-            LogEntry.objects.create_from_record(record)
+            if not _setup():
+                if len(self.buffer) < self.buffer_size:
+                    self.buffer.append(record)
+                else:
+                    self.dropped += 1
+                return
+            if self.buffer:
+                self.flush_buffer()
+
+            batch = getattr(_batch, 'log_entries', None)
+            if batch is not None:
+                batch.append((self, record, LogEntry.objects.build_from_record(record)))
+                if len(batch) >= djangologdb_settings.BATCH_SIZE:
+                    flush_batch()
+            else:
+                self.write(lambda using: LogEntry.objects.db_manager(using).create_from_record(record), record.name)
+
+            if djangologdb_settings.STATS:
+                stats.incr('handler.records')
+                stats.maybe_flush()
         except (KeyboardInterrupt, SystemExit):
             raise
         except:
             self.handleError(record)
 
+    def flush_buffer(self):
+        """
+        Writes the records that were logged before Django was ready.
+        """
+        records = self.buffer
+        self.buffer = []
+        try:
+            log_entries = [LogEntry.objects.build_from_record(record) for record in records]
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            for record in records:
+                self.handleError(record)
+        else:
+            self.write_many(records, log_entries)
+
+        if djangologdb_settings.STATS:
+            stats.incr('handler.buffered', len(records))
+            stats.incr('handler.dropped', self.dropped)
+        self.dropped = 0
+
+    def flush(self):
+        # Called when logging shuts down, so records that were logged before
+        # Django was ready are not lost if no other record follows.
+        self.acquire()
+        try:
+            if self.buffer and _setup():
+                self.flush_buffer()
+        finally:
+            self.release()
+
+    def write_many(self, records, log_entries):
+        """
+        Writes the unsaved `log_entries` of `records` with a few queries per
+        database.
+        """
+        shards = []
+        batches = {}
+        for record, log_entry in zip(records, log_entries):
+            # Log entries of the same shard are written together.
+            shard = get_shard(record.name)
+            if shard not in batches:
+                shards.append(shard)
+                batches[shard] = (record.name, [], [])
+            batches[shard][1].append(record)
+            batches[shard][2].append(log_entry)
+
+        for shard in shards:
+            name, batch_records, batch_log_entries = batches[shard]
+            try:
+                self.write(lambda using: LogEntry.objects.db_manager(using).create_many(batch_log_entries), name)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                for record in batch_records:
+                    self.handleError(record)
+
+    def write(self, write_func, name=None):
+        """
+        Calls `write_func` with the database alias to write log entries of the
+        logger `name` to. On a database error, it is called once more with a
+        new connection.
+        """
+        using = self.get_database(name)
+        if using is None:
+            write_func(None)
+        else:
+            self._check_connection(using)
+            try:
+                self._write(write_func, using)
+            except DatabaseError:
+                # Nothing was written, so reconnect and try once more.
+                connections[using].close()
+                self._write(write_func, using)
+
+    def _write(self, write_func, using):
+        """
+        Calls `write_func` with `using` in a transaction, so either all or none
+        of the log entries are written.
+        """
+        transaction.enter_transaction_management(using=using)
+        transaction.managed(True, using=using)
+        try:
+            try:
+                write_func(using)
+                transaction.commit(using=using)
+            except:
+                exc_info = sys.exc_info()
+                try:
+                    transaction.rollback(using=using)
+                except Exception:
+                    # Closing a broken connection rolls back as well.
+                    transaction.set_clean(using=using)
+                    connections[using].close()
+                raise exc_info[0], exc_info[1], exc_info[2]
+        finally:
+            transaction.leave_transaction_management(using=using)
+
+    def handleError(self, record):
+        if djangologdb_settings is not None and djangologdb_settings.STATS:
+            stats.incr('handler.errors')
+        logging.Handler.handleError(self, record)
+
 # Add the DjangoDatabaseHandler to the logging.handlers namespace.
 logging.handlers.DjangoDatabaseHandler = DjangoDatabaseHandler
 
+def start_batch(context=None):
+    """
+    Collects the log entries of `DjangoDatabaseHandler`s in the current thread
+    until `end_batch` is called, so they can be written with a few queries. 
+    Log entries are also written when there are `LOGDB_BATCH_SIZE` of them.
+    
+    The items in the `context` dictionary are added to the extra attributes of
+    each log entry when they are written, unless a record has an attribute with
+    the same name.
+    """
+    flush_batch()
+    _batch.log_entries = []
+    _batch.context = context or {}
+
+def flush_batch():
+    """
+    Writes the collected log entries of the current thread.
+    """
+    batch = getattr(_batch, 'log_entries', None)
+    if not batch:
+        return
+    _batch.log_entries = []
+
+    handlers = []
+    handler_batches = {}
+    for handler, record, log_entry in batch:
+        if _batch.context:
+            extra = log_entry.extra
+            for key, value in _batch.context.items():
+                extra.setdefault(key, value)
+            log_entry.extra = extra
+
+        if handler not in handler_batches:
+            handlers.append(handler)
+            handler_batches[handler] = []
+        handler_batches[handler].append((record, log_entry))
+
+    for handler in handlers:
+        handler_batch = handler_batches[handler]
+        handler.write_many([record for record, log_entry in handler_batch], [log_entry for record, log_entry in handler_batch])
+
+    if djangologdb_settings.STATS:
+        stats.incr('handler.batches')
+
+def end_batch():
+    """
+    Writes the collected log entries of the current thread and stops collecting
+    them.
+    """
+    flush_batch()
+    _batch.log_entries = None
+
 def add_handler(logger, handler):
     """
     Simple wrapper for `logging.addHandler` that prevents adding handlers twice.
@@ -1,14 +1,20 @@
 from optparse import make_option
 import logging
 import datetime
+import math
+import threading
+import time
 
 from django.core.management.base import NoArgsCommand
-from django.utils.hashcompat import md5_constructor
-from django.db.models import F
+from django.db.models import Count, F
 from django.db import transaction
 
-from djangologdb.models import LogEntry, LogAggregate
+from djangologdb.models import LogEntry, LogAggregate, LogToken, LogTemplate
+from djangologdb import partitions, signals, stats
+from djangologdb.shards import scatter
+from djangologdb.aggregation import get_checksum, get_overflow_checksum
 from djangologdb import settings as djangologdb_settings
+from djangologdb.utils import get_tokens, get_field_value, bulk_insert
 
 logger = logging.getLogger(__name__)
 
@@ -24,88 +30,345 @@ class Command(NoArgsCommand):
         make_option('--cleanup', dest='cleanup', default='-1', help='Specifies the number of days to keep log entries and deletes the rest.'),
     )
 
-    @transaction.commit_on_success
     def handle_noargs(self, **options):
         self.verbosity = int(options.get('verbosity', 1))
         self.skip_actions = options.get('skip_actions', False)
         self.cleanup = int(options.get('cleanup', -1))
 
-        recent_log_aggregates = {}
-
-        # Process un-aggregated entries.
-        for log_entry in list(LogEntry.objects.filter(log_aggregate=None).order_by('-created')):
-            # Create checksum.
-            entries = {
-                'filename': log_entry.filename,
-                'function_name': log_entry.function_name,
-                'level': log_entry.level,
-                'line_number': log_entry.line_number,
-                'module': log_entry.module,
-                'msg': log_entry.msg,
-                'name': log_entry.name,
-                'path': log_entry.path,
-            }
-            checksum = md5_constructor(str(entries))
+        self.stats = None
+        if djangologdb_settings.STATS:
+            self.stats = {'counters': {}, 'timers': {}}
+            self.stats_lock = threading.Lock()
 
+        # The number of log entries that were added to the overflow log
+        # aggregate, by logger.
+        self.overflowed = {}
+        self.overflowed_lock = threading.Lock()
+
+        # Aggregate each database that holds log entries (each shard, in 
+        # parallel) in a transaction of its own.
+        scatter(self._aggregate_database)
+
+        if self.stats is not None:
+            self._flush_stats()
+
+        if self.verbosity >= 1 and self.overflowed:
+            print 'Loggers that reached the maximum of %d log aggregates:' % djangologdb_settings.MAX_AGGREGATES_PER_LOGGER
+            for name, count in sorted(self.overflowed.items(), key=lambda item: (-item[1], item[0])):
+                print '    %s: %d log entries added to the overflow log aggregate' % (name, count)
+
+    def _aggregate_database(self, using):
+        if self.stats is None:
+            transaction.commit_on_success(using=using)(self.aggregate)(using)
+            return
+
+        query_counter = stats.QueryCounter(using)
+        query_counter.start()
+        try:
+            transaction.commit_on_success(using=using)(self.aggregate)(using)
+        finally:
+            self._incr('queries', query_counter.stop())
+
+    def _incr(self, name, count=1):
+        self.stats_lock.acquire()
+        try:
+            counters = self.stats['counters']
+            counters[name] = counters.get(name, 0) + count
+        finally:
+            self.stats_lock.release()
+
+    def _end_phase(self, name, start):
+        """
+        Records the time since `start` for phase `name` and returns the current
+        time, which is the start of the next phase. The times of the shards are
+        added up.
+        """
+        now = time.time()
+        self.stats_lock.acquire()
+        try:
+            timers = self.stats['timers']
+            timers[name] = timers.get(name, 0) + now - start
+        finally:
+            self.stats_lock.release()
+        return now
+
+    def _flush_stats(self):
+        for name, count in self.stats['counters'].items():
+            stats.incr('aggregate_logs.%s' % name, count)
+        for name, seconds in self.stats['timers'].items():
+            stats.timing('aggregate_logs.%s_time' % name, seconds)
+        stats.flush()
+        signals.logs_aggregated.send(sender=self.__class__, stats=self.stats)
+
+    def aggregate(self, using):
+        if self.stats is not None:
+            phase_start = time.time()
+
+        if djangologdb_settings.CLUSTER_MESSAGES:
+            template_tree = LogTemplate.objects.db_manager(using).get_tree()
+        else:
+            template_tree = None
+
+        # Group the un-aggregated entries by checksum, newest first.
+        checksums = []
+        groups = {}
+        for log_entry in list(LogEntry.objects.using(using).filter(log_aggregate=None).order_by('-created')):
+            checksum, entries = get_checksum(log_entry, template_tree)
+            if checksum not in groups:
+                checksums.append(checksum)
+                groups[checksum] = (entries, [])
+            groups[checksum][1].append(log_entry)
+
+        now = datetime.datetime.now()
+        if djangologdb_settings.MAX_AGGREGATES_PER_LOGGER is not None:
+            checksums = self._limit_aggregates(checksums, groups, now, using)
+
+        # Create or update the log aggregate of each group.
+        recent_log_aggregates = []
+        aggregated_log_entries = []
+        for checksum in checksums:
+            entries, log_entries = groups[checksum]
+            dates = [log_entry.created for log_entry in log_entries]
+            new_log_aggregate = LogAggregate()
+            new_log_aggregate.add_hourly_counts(dates, now)
             entries.update({
-                'first_seen': log_entry.created,
-                'last_seen': log_entry.created,
+                'hourly_counts': new_log_aggregate.hourly_counts,
+                'hourly_counts_updated': now,
+                'first_seen': log_entries[-1].created,
+                'last_seen': log_entries[0].created,
+                'times_seen': len(log_entries),
+                'rate_updated': now,
             })
 
-            # Create log aggregate if none exists for this log entry.
-            log_aggregate, is_created = LogAggregate.objects.get_or_create(
-                checksum=checksum.hexdigest(),
+            # Create log aggregate if none exists for these log entries.
+            log_aggregate, is_created = LogAggregate.objects.using(using).get_or_create(
+                checksum=checksum,
                 defaults=entries
             )
 
+            if self.stats is not None:
+                self._incr('rows', len(log_entries))
+                self._incr(is_created and 'created' or 'updated')
+
             # Update log aggregate if it already existed.
+            rate = log_aggregate.rate
+            rate_variance = log_aggregate.rate_variance
+            current_rate = None
             if not is_created:
-                log_aggregate.times_seen = F('times_seen') + 1
-                log_aggregate.last_seen = log_entry.created
-                log_aggregate.save()
+                current_rate = log_aggregate.update_rate(len(log_entries), now)
+                log_aggregate.add_hourly_counts(dates, now)
+                LogAggregate.objects.using(using).filter(pk=log_aggregate.pk).update(
+                    times_seen=F('times_seen') + len(log_entries),
+                    last_seen=max(log_aggregate.last_seen, entries['last_seen']),
+                    # The template can have changed since the log aggregate
+                    # was created.
+                    msg=entries['msg'],
+                    # Overflow log aggregates have the highest level of their
+                    # log entries.
+                    level=max(log_aggregate.level, entries['level']),
+                    rate=log_aggregate.rate,
+                    rate_variance=log_aggregate.rate_variance,
+                    rate_updated=log_aggregate.rate_updated,
+                    hourly_counts=log_aggregate.hourly_counts,
+                    hourly_counts_updated=now,
+                )
+                log_aggregate.times_seen += len(log_entries)
+
+            # Only update the link to the aggregate, the rest is unchanged.
+            for i in range(0, len(log_entries), 500):
+                LogEntry.objects.using(using).filter(pk__in=[log_entry.pk for log_entry in log_entries[i:i + 500]]).update(log_aggregate=log_aggregate)
+            for log_entry in log_entries:
+                log_entry.log_aggregate = log_aggregate
 
-            log_entry.log_aggregate = log_aggregate
-            log_entry.save()
+            # Use the newest entry to have all the variables.
+            recent_log_aggregates.append((log_aggregate, log_entries[0], current_rate, rate, rate_variance))
+            aggregated_log_entries.extend(log_entries)
 
-            # Use an entry to have all the variables.
-            recent_log_aggregates[log_aggregate.id] = log_entry
+        if self.stats is not None:
+            phase_start = self._end_phase('aggregate', phase_start)
+
+        if djangologdb_settings.SEARCH_INDEX:
+            self._index_log_entries(aggregated_log_entries, using)
+            if self.stats is not None:
+                phase_start = self._end_phase('index', phase_start)
 
         # Only process recently created or updated log aggregates.
         if not self.skip_actions:
-            for log_entry in recent_log_aggregates.values():
-                actions = self._get_matching_rule_actions(log_aggregate)
+            for log_aggregate, log_entry, current_rate, rate, rate_variance in recent_log_aggregates:
+                if self.stats is not None:
+                    self._incr('rule_evaluations', len(djangologdb_settings.RULES))
+                actions = self._get_matching_rule_actions(log_aggregate, current_rate, rate, rate_variance, now)
                 if actions is not None:
                     additional_record = logger.makeRecord('django-logdb: %s' % log_entry.name, actions['level'], log_entry.filename, log_entry.line_number, log_entry.msg, log_entry.args, None, log_entry.function_name, extra=log_entry.extra)
                     logger.handle(additional_record)
+            if self.stats is not None:
+                phase_start = self._end_phase('rules', phase_start)
 
-        # Delete old log entries.
+        # Delete old log entries. Partitions with only old log entries are
+        # dropped as a whole.
         if self.cleanup >= 0:
-            LogEntry.objects.exclude(created__gt=datetime.datetime.now() - datetime.timedelta(self.cleanup)).delete()
+            before = datetime.datetime.now() - datetime.timedelta(self.cleanup)
+            if djangologdb_settings.PARTITION_PERIOD is not None and partitions.is_partitioned(using):
+                partitions.drop_partitions(before, using=using)
+            else:
+                LogEntry.objects.using(using).exclude(created__gt=before).delete()
+            if self.stats is not None:
+                self._end_phase('cleanup', phase_start)
 
-    def _get_matching_rule_actions(self, log_aggregate):
+    def _limit_aggregates(self, checksums, groups, now, using):
+        """
+        Adds the groups of log entries that would exceed the maximum number of
+        log aggregates of their logger to the overflow group of that logger, 
+        after pruning stale log aggregates. Returns the remaining checksums.
+        """
+        limit = djangologdb_settings.MAX_AGGREGATES_PER_LOGGER
+
+        existing = set()
+        for i in range(0, len(checksums), 500):
+            existing.update(LogAggregate.objects.using(using).filter(checksum__in=checksums[i:i + 500]).values_list('checksum', flat=True))
+
+        names = []
+        new_checksums = {}
+        for checksum in checksums:
+            if checksum not in existing:
+                name = groups[checksum][0]['name']
+                if name not in new_checksums:
+                    names.append(name)
+                    new_checksums[name] = []
+                new_checksums[name].append(checksum)
+
+        name_field = LogAggregate._meta.get_field('name')
+        counts = {}
+        for i in range(0, len(names), 500):
+            queryset = LogAggregate.objects.using(using).filter(name__in=names[i:i + 500], is_overflow=False)
+            for name, count in queryset.values('name').annotate(aggregate_count=Count('pk')).values_list('name', 'aggregate_count'):
+                counts[get_field_value(name_field, name, using)] = count
+
+        overflowed = set()
+        for name in names:
+            excess = counts.get(name, 0) + len(new_checksums[name]) - limit
+            if excess <= 0:
+                continue
+            excess -= self._prune(name, excess, now, using)
+            if excess <= 0:
+                continue
+
+            # Keep the groups with the newest log entries.
+            log_entries = []
+            for checksum in new_checksums[name][-excess:]:
+                overflowed.add(checksum)
+                log_entries.extend(groups.pop(checksum)[1])
+            log_entries.sort(key=lambda log_entry: log_entry.created, reverse=True)
+
+            checksum, entries = get_overflow_checksum(name, max([log_entry.level for log_entry in log_entries]))
+            checksums.append(checksum)
+            groups[checksum] = (entries, log_entries)
+
+            logger.warning('Logger %s reached the maximum of %d log aggregates, %d log entries were added to its overflow log aggregate.', name, limit, len(log_entries))
+            self.overflowed_lock.acquire()
+            try:
+                self.overflowed[name] = self.overflowed.get(name, 0) + len(log_entries)
+            finally:
+                self.overflowed_lock.release()
+            if self.stats is not None:
+                self._incr('overflowed', len(log_entries))
+
+        return [checksum for checksum in checksums if checksum not in overflowed]
+
+    def _prune(self, name, count, now, using):
+        """
+        Moves the log entries of at most `count` log aggregates of the logger
+        `name` that were not seen for `LOGDB_PRUNE_AFTER` to its overflow log
+        aggregate, least seen first. Returns the number of pruned log
+        aggregates.
+        """
+        before = now - djangologdb_settings.PRUNE_AFTER
+        stale = list(LogAggregate.objects.using(using).filter(name=name, is_overflow=False, last_seen__lt=before).order_by('times_seen', 'last_seen')[:count])
+        if len(stale) == 0:
+            return 0
+
+        checksum, entries = get_overflow_checksum(name, max([log_aggregate.level for log_aggregate in stale]))
+        entries.update({
+            'first_seen': min([log_aggregate.first_seen for log_aggregate in stale]),
+            'last_seen': max([log_aggregate.last_seen for log_aggregate in stale]),
+            'times_seen': 0,
+            'rate_updated': now,
+        })
+        overflow, is_created = LogAggregate.objects.using(using).get_or_create(checksum=checksum, defaults=entries)
+        if not is_created:
+            entries['first_seen'] = min(overflow.first_seen, entries['first_seen'])
+            entries['last_seen'] = max(overflow.last_seen, entries['last_seen'])
+            entries['level'] = max(overflow.level, entries['level'])
+
+        pks = [log_aggregate.pk for log_aggregate in stale]
+        LogEntry.objects.using(using).filter(log_aggregate__in=pks).update(log_aggregate=overflow)
+        LogToken.objects.using(using).filter(log_aggregate__in=pks).update(log_aggregate=overflow)
+        # Saving sets the dates to the current time, so always update.
+        LogAggregate.objects.using(using).filter(pk=overflow.pk).update(
+            times_seen=F('times_seen') + sum([log_aggregate.times_seen for log_aggregate in stale]),
+            first_seen=entries['first_seen'],
+            last_seen=entries['last_seen'],
+            level=entries['level'],
+        )
+        LogAggregate.objects.using(using).filter(pk__in=pks).delete()
+
+        if self.stats is not None:
+            self._incr('pruned', len(stale))
+        return len(stale)
+
+    def _index_log_entries(self, log_entries, using, batch_size=500):
+        """
+        Adds the words in the logger names, messages and exception traces of
+        `log_entries` to the search index.
+        """
+        for i in range(0, len(log_entries), batch_size):
+            batch = log_entries[i:i + batch_size]
+            LogEntry.objects.db_manager(using).load_details(batch)
+
+            log_tokens = []
+            for log_entry in batch:
+                text = u'%s %s %s' % (log_entry.name, log_entry.get_message(), log_entry.exc_text or u'')
+                for token in get_tokens(text):
+                    log_tokens.append(LogToken(token=token, log_entry_id=log_entry.pk, log_aggregate_id=log_entry.log_aggregate_id))
+            bulk_insert(LogToken, log_tokens, using=using)
+
+    def _get_matching_rule_actions(self, log_aggregate, current_rate, rate, rate_variance, now):
         """
         Check if there is a rule that matches the `log_aggregate` and return it.
         
+        The `current_rate` is the rate of the new log entries of the log
+        aggregate, the `rate` and `rate_variance` are the average before they
+        were added.
+        
         This is done by settings rather then a database model to prevent 
         additional overhead. The idea is that there are not that many rules, nor
         the desire to manage them often.
         """
         for rule in djangologdb_settings.RULES:
-
-            # TODO: Is that F() method in times_seen conflicting here?
+            conditions = rule['conditions']
 
             # Inexpensive condition checks first. If the log has the same level
             # as the (only possible) action would result in, skip it.
-            if log_aggregate.level != rule['actions']['level'] and \
-                    log_aggregate.level >= rule['conditions']['min_level'] and \
-                    log_aggregate.name.startswith(rule['conditions']['qualname']) and \
-                    log_aggregate.times_seen >= rule['conditions']['min_times_seen']:
+            if log_aggregate.level == rule['actions']['level'] or \
+                    log_aggregate.level < conditions['min_level'] or \
+                    not log_aggregate.name.startswith(conditions['qualname']):
+                continue
+
+            if 'rate_factor' in conditions:
+                # Compare with the average rate, which needs some history.
+                if current_rate is not None and \
+                        now - log_aggregate.first_seen >= djangologdb_settings.RATE_PERIOD and \
+                        current_rate >= conditions.get('min_rate', 0) and \
+                        current_rate > rate * conditions['rate_factor'] and \
+                        current_rate > rate + conditions.get('rate_deviations', 0) * math.sqrt(rate_variance):
+                    return rule['actions']
 
+            elif log_aggregate.times_seen >= conditions['min_times_seen']:
                 # Perform condition check which requires a database hit.
-                latest_log_entries = log_aggregate.logentry_set.all().order_by('-created')[:rule['conditions']['min_times_seen']]
+                latest_log_entries = log_aggregate.logentry_set.all().order_by('-created')[:conditions['min_times_seen']]
                 times_seen = len(latest_log_entries)
-                if times_seen == rule['conditions']['min_times_seen'] and \
-                        latest_log_entries[0].created - latest_log_entries[times_seen - 1].created <= rule['conditions']['within_time']:
+                if times_seen == conditions['min_times_seen'] and \
+                        latest_log_entries[0].created - latest_log_entries[times_seen - 1].created <= conditions['within_time']:
                     return rule['actions']
 
         return None
@@ -0,0 +1,102 @@
+from optparse import make_option
+import datetime
+import os
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import transaction
+
+from djangologdb.models import LogEntry, LogAggregate
+from djangologdb import settings as djangologdb_settings
+from djangologdb.archive import write_segment, EXTENSION
+from djangologdb.shards import get_shards
+from djangologdb.utils import get_field_value
+
+class Command(NoArgsCommand):
+    help = 'Moves old log entries to segment files in LOGDB_ARCHIVE_DIR, where they are still counted in the graphs.'
+
+    requires_model_validation = True
+    can_import_settings = True
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--days', dest='days', default='30', help='Specifies the number of days to keep log entries in the database.'),
+    )
+
+    def handle_noargs(self, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+        days = int(options.get('days', 30))
+
+        directory = djangologdb_settings.ARCHIVE_DIR
+        if directory is None:
+            raise CommandError('Set LOGDB_ARCHIVE_DIR to archive log entries.')
+        if not os.path.isdir(directory):
+            raise CommandError('The archive directory %s does not exist.' % directory)
+
+        before = datetime.datetime.now() - datetime.timedelta(days)
+
+        # Archive each database that holds log entries (each shard, in
+        # particular). All segments are in the same directory.
+        total = 0
+        for using in get_shards():
+            total += self._archive_database(directory, before, using)
+
+        if self.verbosity >= 1:
+            print 'Archived %d log entries.' % total
+
+    def _archive_database(self, directory, before, using):
+        """
+        Archives the log entries before `before` in the database `using`.
+        Returns the number of log entries.
+        """
+        # Write a segment per day, oldest first.
+        total = 0
+        while True:
+            oldest = list(LogEntry.objects.using(using).filter(created__lt=before).order_by('created').values_list('created', flat=True)[:1])
+            if len(oldest) == 0:
+                break
+            start = datetime.datetime.combine(oldest[0].date(), datetime.time())
+            end = min(start + datetime.timedelta(1), before)
+
+            count = self._archive(directory, start, end, using)
+            total += count
+            if self.verbosity >= 2:
+                print 'Archived %d log entries of %s in database %s.' % (count, start.date(), using)
+
+        return total
+
+    def _archive(self, directory, start, end, using):
+        """
+        Writes the log entries in the database `using` from `start` up to `end`
+        to a new segment and deletes them. Returns the number of log entries.
+        """
+        name_field = LogAggregate._meta.get_field('name')
+        queryset = LogEntry.objects.using(using).filter(created__gte=start, created__lt=end).order_by('created', 'pk')
+
+        pks = []
+        def get_rows():
+            for pk, created, level, checksum, name in queryset.values_list('pk', 'created', 'level', 'log_aggregate__checksum', 'log_aggregate__name').iterator():
+                pks.append(pk)
+                if checksum is not None:
+                    name = get_field_value(name_field, name, queryset.db)
+                yield created, level, checksum, name
+
+        # The first id makes the name unique, even if log entries of the same
+        # day are archived later on. Ids are only unique per shard.
+        prefix = start.strftime('%Y%m%d')
+        if djangologdb_settings.SHARDS:
+            prefix = '%s-%s' % (prefix, using)
+        path = os.path.join(directory, '%s-%s%s' % (prefix, queryset.values_list('pk', flat=True)[0], EXTENSION))
+        count = write_segment(path, get_rows())
+
+        # Only delete the log entries that were written. If the deletion fails
+        # the segment is removed again, so no log entry is counted twice.
+        try:
+            transaction.commit_on_success(using=using)(self._delete)(pks, using)
+        except:
+            os.remove(path)
+            raise
+
+        return count
+
+    def _delete(self, pks, using):
+        for i in range(0, len(pks), 500):
+            LogEntry.objects.using(using).filter(pk__in=pks[i:i + 500]).delete()
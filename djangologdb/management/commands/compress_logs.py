@@ -0,0 +1,81 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from djangologdb.models import LogEntryDetail
+from djangologdb.shards import get_shards
+from djangologdb.utils import is_compressed
+
+class Command(NoArgsCommand):
+    help = 'Compresses the exception traces and extra attributes of existing log entries.'
+
+    requires_model_validation = True
+    can_import_settings = True
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', default='1000', help='Specifies the number of log entries to compress per transaction.'),
+    )
+
+    def handle_noargs(self, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+        self.batch_size = int(options.get('batch_size', 1000))
+
+        # Only fields that have compression enabled.
+        fields = [f for f in LogEntryDetail._meta.fields if getattr(f, 'compress_threshold', None) is not None]
+        columns = ['pk'] + [f.attname for f in fields]
+
+        total = 0
+        # Compress each database that holds log entries (each shard, in
+        # particular).
+        for using in get_shards():
+            total += self._compress_database(fields, columns, using)
+
+        if self.verbosity >= 1:
+            print 'Compressed %d log entries.' % total
+
+    def _compress_database(self, fields, columns, using):
+        """
+        Compresses the log entries in the database `using`. Returns the number
+        of updated rows.
+        """
+        last_pk = None
+        total = 0
+        while True:
+            # The raw database values are used to see what is compressed already.
+            queryset = LogEntryDetail.objects.using(using).order_by('pk').values_list(*columns)
+            if last_pk is not None:
+                queryset = queryset.filter(pk__gt=last_pk)
+            rows = list(queryset[:self.batch_size])
+            if len(rows) == 0:
+                break
+
+            total += transaction.commit_on_success(using=using)(self._compress_rows)(rows, fields, using)
+            last_pk = rows[-1][0]
+
+            if self.verbosity >= 2:
+                print 'Compressed %d log entries up to log entry %s in database %s.' % (total, last_pk, using)
+
+        return total
+
+    def _compress_rows(self, rows, fields, using):
+        """
+        Saves the uncompressed values in `rows` again, so they are compressed.
+        Returns the number of updated rows.
+        """
+        count = 0
+        for row in rows:
+            values = {}
+            for field, raw_value in zip(fields, row[1:]):
+                if raw_value is None or is_compressed(raw_value) or len(raw_value) < field.compress_threshold:
+                    continue
+                value = field.to_python(raw_value)
+                if value is not None:
+                    values[field.name] = value
+
+            if values:
+                # The fields compress the values when they are saved.
+                LogEntryDetail.objects.using(using).filter(pk=row[0]).update(**values)
+                count += 1
+
+        return count
@@ -0,0 +1,84 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import connections, transaction
+from django.db.models import Min, Max
+
+from djangologdb.models import LogEntry, LogEntryDetail
+from djangologdb.shards import get_shards
+
+# The columns of the log entry table that moved to the detail table in 1.1, and
+# the value to use for rows that do not have them.
+OLD_COLUMNS = (('args', 'NULL'), ('exc_text', 'NULL'), ('extra', '\'{}\''))
+
+class Command(NoArgsCommand):
+    help = 'Copies the args, exc_text and extra columns of log entries written before version 1.1 to the LogEntryDetail table.'
+
+    requires_model_validation = True
+    can_import_settings = True
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', default='1000', help='Specifies the number of log entry ids to copy per transaction.'),
+        make_option('--drop-columns', dest='drop_columns', action='store_true', help='Drop the old columns from the log entry table afterwards.'),
+    )
+
+    def handle_noargs(self, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+        self.batch_size = int(options.get('batch_size', 1000))
+        self.drop_columns = options.get('drop_columns', False)
+
+        # Copy each database that holds log entries (each shard, in
+        # particular).
+        total = 0
+        for using in get_shards():
+            total += self._copy_database(using)
+
+        if self.verbosity >= 1:
+            print 'Copied the details of %d log entries.' % total
+
+    def _copy_database(self, using):
+        """
+        Copies the old columns in the database `using`. Returns the number of
+        copied rows.
+        """
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        table = LogEntry._meta.db_table
+        cursor = connection.cursor()
+        existing = [row[0] for row in connection.introspection.get_table_description(cursor, table)]
+        columns = [(column, column in existing and qn(column) or default) for column, default in OLD_COLUMNS]
+        if not [column for column, default in OLD_COLUMNS if column in existing]:
+            if self.verbosity >= 2:
+                print 'The log entry table in database %s has no old columns.' % using
+            return 0
+
+        # Log entries that already have details, like ones written by this
+        # version, are skipped.
+        detail_table = LogEntryDetail._meta.db_table
+        detail_column = LogEntryDetail._meta.pk.column
+        sql = 'INSERT INTO %s (%s, %s) SELECT %s, %s FROM %s WHERE %s >= %%s AND %s < %%s AND NOT EXISTS (SELECT 1 FROM %s WHERE %s.%s = %s.%s)' % (
+            qn(detail_table), qn(detail_column), ', '.join([qn(column) for column, value in columns]),
+            qn('id'), ', '.join([value for column, value in columns]), qn(table),
+            qn('id'), qn('id'),
+            qn(detail_table), qn(detail_table), qn(detail_column), qn(table), qn('id'))
+
+        total = 0
+        bounds = LogEntry.objects.using(using).aggregate(Min('pk'), Max('pk'))
+        if bounds['pk__min'] is not None:
+            for start in range(bounds['pk__min'], bounds['pk__max'] + 1, self.batch_size):
+                total += transaction.commit_on_success(using=using)(self._copy_rows)(sql, start, start + self.batch_size, using)
+                if self.verbosity >= 2:
+                    print 'Copied the details of %d log entries up to log entry %s in database %s.' % (total, start + self.batch_size - 1, using)
+
+        if self.drop_columns:
+            for column, default in OLD_COLUMNS:
+                if column in existing:
+                    cursor.execute('ALTER TABLE %s DROP COLUMN %s' % (qn(table), qn(column)))
+            transaction.commit_unless_managed(using=using)
+
+        return total
+
+    def _copy_rows(self, sql, start, end, using):
+        cursor = connections[using].cursor()
+        cursor.execute(sql, [start, end])
+        return cursor.rowcount
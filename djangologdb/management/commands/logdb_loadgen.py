@@ -0,0 +1,172 @@
+from optparse import make_option
+import bisect
+import logging
+import random
+import time
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from djangologdb.models import LogEntry
+from djangologdb.handlers import DjangoDatabaseHandler
+from djangologdb.shards import get_shard
+
+WORDS = ('user', 'order', 'payment', 'session', 'cache', 'invoice', 'account', 'request', 'upload', 'report', 'token', 'queue', 'worker', 'mail', 'search', 'image')
+VERBS = ('created', 'updated', 'deleted', 'failed', 'expired', 'retried', 'rejected', 'timed out', 'started', 'finished')
+EXCEPTIONS = ('ValueError', 'KeyError', 'TypeError', 'IOError', 'DatabaseError', 'TimeoutError')
+
+class ZipfChoice(object):
+    """
+    Chooses ranks from 0 to `n` - 1, where rank `k` is chosen with a
+    probability proportional to 1 / (k + 1) ** `s`. An `s` of 0 chooses
+    uniformly.
+    """
+    def __init__(self, n, s, random):
+        self.random = random
+        self.cumulative = []
+        total = 0.0
+        for k in range(n):
+            total += 1.0 / (k + 1) ** s
+            self.cumulative.append(total)
+
+    def choose(self, random=None):
+        return bisect.bisect_left(self.cumulative, (random or self.random).random() * self.cumulative[-1])
+
+class Command(NoArgsCommand):
+    help = 'Generates synthetic log entries, to test aggregation, retention and the graphs with many log entries.'
+
+    requires_model_validation = True
+    can_import_settings = True
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--count', dest='count', default='10000', help='Specifies the number of log entries to generate.'),
+        make_option('--handler', dest='handler', action='store_true', help='Logs each record through the logging handler, at the current time, instead of inserting them in batches.'),
+        make_option('--rate', dest='rate', default='0', help='Specifies the maximum number of records per second with --handler. The default is no limit.'),
+        make_option('--days', dest='days', default='28', help='Specifies the number of days before now to spread the log entries over, without --handler.'),
+        make_option('--levels', dest='levels', default='DEBUG:10,INFO:60,WARNING:20,ERROR:9,CRITICAL:1', help='Specifies the relative number of log entries per level.'),
+        make_option('--loggers', dest='loggers', default='50', help='Specifies the number of different logger names.'),
+        make_option('--messages', dest='messages', default='100', help='Specifies the number of different messages per level.'),
+        make_option('--zipf', dest='zipf', default='1.1', help='Specifies how much more often popular loggers and messages are used, as the exponent of a Zipf distribution. 0 uses all equally often.'),
+        make_option('--tracebacks', dest='tracebacks', default='0.5', help='Specifies the fraction of ERROR and CRITICAL log entries with an exception trace.'),
+        make_option('--frames', dest='frames', default='20', help='Specifies the maximum number of frames in an exception trace.'),
+        make_option('--batch-size', dest='batch_size', default='1000', help='Specifies the number of log entries to insert at once, without --handler.'),
+        make_option('--seed', dest='seed', default=None, help='Specifies the seed of the random generator, to generate the same log entries again.'),
+    )
+
+    def handle_noargs(self, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+        count = int(options.get('count', 10000))
+        use_handler = options.get('handler', False)
+        rate = float(options.get('rate', 0))
+        days = float(options.get('days', 28))
+        batch_size = int(options.get('batch_size', 1000))
+        self.traceback_fraction = float(options.get('tracebacks', 0.5))
+        self.max_frames = int(options.get('frames', 20))
+
+        self.random = random.Random(options.get('seed', None))
+        self.levels, self.level_weights = self._parse_levels(options.get('levels', 'DEBUG:10,INFO:60,WARNING:20,ERROR:9,CRITICAL:1'))
+        zipf = float(options.get('zipf', 1.1))
+        self.loggers = ZipfChoice(int(options.get('loggers', 50)), zipf, self.random)
+        self.messages = ZipfChoice(int(options.get('messages', 100)), zipf, self.random)
+
+        start = time.time()
+        if use_handler:
+            self._log(count, rate)
+        else:
+            self._insert(count, days, batch_size)
+        seconds = time.time() - start
+
+        if self.verbosity >= 1:
+            print 'Generated %d log entries in %.1f seconds (%d per second).' % (count, seconds, count / max(seconds, 0.001))
+
+    def _parse_levels(self, value):
+        levels = []
+        weights = []
+        total = 0.0
+        try:
+            for item in value.split(','):
+                name, weight = item.split(':')
+                level = logging.getLevelName(name.strip().upper())
+                if not isinstance(level, int):
+                    raise ValueError(name)
+                total += float(weight)
+                levels.append(level)
+                weights.append(total)
+        except ValueError:
+            raise CommandError('The levels need to be given as LEVEL:WEIGHT,... (for example ERROR:1,INFO:9).')
+        return levels, weights
+
+    def _log(self, count, rate):
+        """
+        Logs `count` records through the handler, at most `rate` per second.
+        """
+        handler = DjangoDatabaseHandler()
+        start = time.time()
+        for i in xrange(count):
+            if rate > 0:
+                delay = start + i / rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            handler.handle(self._make_record(time.time()))
+
+            if self.verbosity >= 2 and (i + 1) % 1000 == 0:
+                print 'Logged %d of %d records.' % (i + 1, count)
+
+    def _insert(self, count, days, batch_size):
+        """
+        Inserts `count` log entries spread over the last `days` days, in
+        batches of `batch_size`.
+        """
+        end = time.time()
+        start = end - days * 24 * 60 * 60
+        for i in xrange(0, count, batch_size):
+            records = [self._make_record(self.random.uniform(start, end)) for j in xrange(min(batch_size, count - i))]
+
+            # Log entries of the same shard are inserted together.
+            shards = []
+            batches = {}
+            for record in records:
+                shard = get_shard(record.name)
+                if shard not in batches:
+                    shards.append(shard)
+                    batches[shard] = []
+                batches[shard].append(LogEntry.objects.build_from_record(record))
+            for shard in shards:
+                LogEntry.objects.db_manager(shard).create_many(batches[shard])
+
+            if self.verbosity >= 2:
+                print 'Inserted %d of %d log entries.' % (i + len(records), count)
+
+    def _make_record(self, created):
+        """
+        Returns a random record that was created at the timestamp `created`.
+        Each message is always logged with the same level, by the same logger
+        and from the same place. Popular loggers get more messages.
+        """
+        level = self.levels[bisect.bisect_left(self.level_weights, self.random.random() * self.level_weights[-1])]
+        message_rank = self.messages.choose() * len(self.levels) + self.levels.index(level)
+        logger_rank = self.loggers.choose(random.Random(message_rank))
+
+        name = 'loadgen.app%d.module%d' % (logger_rank % 10, logger_rank)
+        pathname = '/srv/loadgen/app%d/module%d.py' % (logger_rank % 10, logger_rank)
+        msg = '%s %%s %s (message %d)' % (WORDS[message_rank % len(WORDS)].capitalize(), VERBS[message_rank % len(VERBS)], message_rank)
+        args = (self.random.randint(1, 100000),)
+
+        record = logging.LogRecord(name, level, pathname, 10 + message_rank, msg, args, None, 'function%d' % (message_rank % 20))
+        record.created = created
+        if level >= logging.ERROR and self.random.random() < self.traceback_fraction:
+            record.exc_text = self._make_traceback(message_rank)
+        return record
+
+    def _make_traceback(self, message_rank):
+        """
+        Returns a random exception trace. The frames depend on the message, but
+        the line numbers and the values in the error do not.
+        """
+        rank_random = random.Random(message_rank)
+        frames = rank_random.randint(1, self.max_frames)
+        lines = ['Traceback (most recent call last):']
+        for frame in range(frames):
+            lines.append('  File "/srv/loadgen/lib%d/%s.py", line %d, in %s_%d' % (frame, rank_random.choice(WORDS), self.random.randint(1, 2000), rank_random.choice(WORDS), frame))
+            lines.append('    %s = get_%s(pk=%d)' % (rank_random.choice(WORDS), rank_random.choice(WORDS), self.random.randint(1, 100000)))
+        lines.append("%s: '%s %d' not found" % (EXCEPTIONS[message_rank % len(EXCEPTIONS)], rank_random.choice(WORDS), self.random.randint(1, 100000)))
+        return '\n'.join(lines)
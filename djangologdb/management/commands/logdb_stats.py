@@ -0,0 +1,40 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from djangologdb import stats
+
+class Command(NoArgsCommand):
+    help = 'Shows the counters and timers of the logging handler, the aggregate_logs command and the graphs.'
+
+    can_import_settings = True
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--reset', dest='reset', action='store_true', help='Resets the stats after showing them.'),
+    )
+
+    def handle_noargs(self, **options):
+        shared_stats = stats.get_shared_stats()
+
+        counters = shared_stats['counters']
+        for name in sorted(counters.keys()):
+            print '%-40s %d' % (name, counters[name])
+
+        timers = shared_stats['timers']
+        if timers:
+            print
+            print '%-40s %8s %10s %10s %10s' % ('timer', 'count', 'avg (ms)', 'min (ms)', 'max (ms)')
+        for name in sorted(timers.keys()):
+            timer = timers[name]
+            print '%-40s %8d %10.2f %10.2f %10.2f' % (name, timer['count'], 1000 * timer['total'] / max(timer['count'], 1), 1000 * (timer['min'] or 0), 1000 * (timer['max'] or 0))
+
+            if int(options.get('verbosity', 1)) >= 2:
+                bounds = ['<= %gms' % (1000 * bound) for bound in stats.BUCKETS] + ['slower']
+                for bound, count in zip(bounds, timer['buckets']):
+                    print '    %-36s %8d' % (bound, count)
+
+        if not counters and not timers:
+            print 'No stats. Is LOGDB_STATS enabled?'
+
+        if options.get('reset', False):
+            stats.reset_shared()
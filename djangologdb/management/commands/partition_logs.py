@@ -0,0 +1,56 @@
+from optparse import make_option
+import datetime
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connections
+
+from djangologdb import partitions
+from djangologdb import settings as djangologdb_settings
+from djangologdb.shards import get_shards
+
+class Command(NoArgsCommand):
+    help = 'Partitions the log entry table and creates and drops partitions.'
+
+    requires_model_validation = True
+    can_import_settings = True
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--ahead', dest='ahead', default='3', help='Specifies the number of periods to create partitions for in advance.'),
+        make_option('--cleanup', dest='cleanup', default='-1', help='Specifies the number of days to keep log entries and drops the partitions with older log entries.'),
+    )
+
+    def handle_noargs(self, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+        self.ahead = int(options.get('ahead', 3))
+        self.cleanup = int(options.get('cleanup', -1))
+
+        if djangologdb_settings.PARTITION_PERIOD is None:
+            raise CommandError('Partitioning is disabled, see the LOGDB_PARTITION_PERIOD setting.')
+        # Partition each database that holds log entries (each shard, in
+        # particular).
+        shards = get_shards()
+        for using in shards:
+            if not partitions.is_supported(connections[using]):
+                raise CommandError('Partitioning is only supported on PostgreSQL.')
+
+        for using in shards:
+            self._partition_database(using)
+
+    def _partition_database(self, using):
+        if not partitions.is_partitioned(using):
+            partitions.setup(using)
+            if self.verbosity >= 1:
+                print 'Partitioned the log entry table in database %s.' % using
+
+        end_date = datetime.datetime.now()
+        for i in range(self.ahead):
+            end_date = partitions.get_period_end(partitions.get_period_start(end_date))
+        for name in partitions.create_partitions(end_date, using):
+            if self.verbosity >= 1:
+                print 'Created partition %s in database %s.' % (name, using)
+
+        if self.cleanup >= 0:
+            before = datetime.datetime.now() - datetime.timedelta(self.cleanup)
+            for name in partitions.drop_partitions(before, using):
+                if self.verbosity >= 1:
+                    print 'Dropped partition %s in database %s.' % (name, using)
@@ -0,0 +1,284 @@
+from optparse import make_option
+import cPickle as pickle
+import datetime
+import multiprocessing
+import os
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import Min, Max
+
+from djangologdb.models import LogEntry, LogAggregate, LogTemplate, LogToken
+from djangologdb import settings as djangologdb_settings
+from djangologdb.aggregation import get_checksum
+from djangologdb.shards import get_shards
+from djangologdb.utils import get_hour, get_seconds
+
+# The id of the log aggregate per checksum while relinking. This is a global so
+# the processes inherit it, instead of receiving it with every task.
+_checksum_ids = {}
+
+# The fields of log entries that are needed to compute their checksum.
+CHECKSUM_FIELDS = ('filename', 'function_name', 'level', 'line_number', 'module', 'msg', 'name', 'path', 'fingerprint', 'created', 'log_aggregate')
+
+def _get_template_tree(using):
+    if djangologdb_settings.CLUSTER_MESSAGES:
+        return LogTemplate.objects.db_manager(using).get_tree()
+    return None
+
+def _iter_range(start, end, using):
+    return LogEntry.objects.using(using).filter(pk__gte=start, pk__lt=end).only(*CHECKSUM_FIELDS).order_by('pk').iterator()
+
+def _scan_range((start, end, now, using)):
+    """
+    Returns the partial log aggregates for the log entries in the database
+    `using` with an id from `start` up to `end`, by checksum.
+    """
+    template_tree = _get_template_tree(using)
+    recent = now - djangologdb_settings.RATE_PERIOD
+
+    partials = {}
+    for log_entry in _iter_range(start, end, using):
+        checksum, entries = get_checksum(log_entry, template_tree, learn=False)
+        partial = partials.get(checksum)
+        if partial is None:
+            partial = partials[checksum] = {
+                'entries': entries,
+                'count': 0,
+                'first_seen': log_entry.created,
+                'last_seen': log_entry.created,
+                'recent_count': 0,
+                'hour_counts': {},
+            }
+
+        partial['count'] += 1
+        if log_entry.created < partial['first_seen']:
+            partial['first_seen'] = log_entry.created
+        if log_entry.created >= partial['last_seen']:
+            partial['last_seen'] = log_entry.created
+            partial['entries'] = entries
+        if log_entry.created >= recent:
+            partial['recent_count'] += 1
+        hour = get_hour(log_entry.created)
+        partial['hour_counts'][hour] = partial['hour_counts'].get(hour, 0) + 1
+
+    return start, partials
+
+def _merge_partials(results, partials):
+    for checksum, partial in partials.items():
+        result = results.get(checksum)
+        if result is None:
+            results[checksum] = partial
+            continue
+
+        result['count'] += partial['count']
+        result['recent_count'] += partial['recent_count']
+        result['first_seen'] = min(result['first_seen'], partial['first_seen'])
+        if partial['last_seen'] >= result['last_seen']:
+            result['last_seen'] = partial['last_seen']
+            result['entries'] = partial['entries']
+        for hour, count in partial['hour_counts'].items():
+            result['hour_counts'][hour] = result['hour_counts'].get(hour, 0) + count
+
+def _relink_range((start, end, using)):
+    """
+    Links the log entries in the database `using` with an id from `start` up
+    to `end` to the log aggregate of their checksum.
+    """
+    template_tree = _get_template_tree(using)
+
+    relink = {}
+    for log_entry in _iter_range(start, end, using):
+        checksum, entries = get_checksum(log_entry, template_tree, learn=False)
+        # Log entries that were added after the scan are left alone.
+        log_aggregate_id = _checksum_ids.get(checksum)
+        if log_aggregate_id is not None and log_entry.log_aggregate_id != log_aggregate_id:
+            relink.setdefault(log_aggregate_id, []).append(log_entry.pk)
+
+    for log_aggregate_id, pks in relink.items():
+        for i in range(0, len(pks), 500):
+            LogEntry.objects.using(using).filter(pk__in=pks[i:i + 500]).update(log_aggregate=log_aggregate_id)
+            LogToken.objects.using(using).filter(log_entry__in=pks[i:i + 500]).update(log_aggregate=log_aggregate_id)
+    transaction.commit_unless_managed(using=using)
+
+    return start, None
+
+class Command(NoArgsCommand):
+    help = 'Recomputes all log aggregates from the log entries.'
+
+    requires_model_validation = True
+    can_import_settings = True
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--processes', dest='processes', default=None, help='Specifies the number of processes to use. The default is the number of CPUs.'),
+        make_option('--chunk-size', dest='chunk_size', default='100000', help='Specifies the number of log entry ids per unit of work.'),
+        make_option('--state-dir', dest='state_dir', default=None, help='Specifies a directory to keep the progress in, to resume an interrupted rebuild.'),
+    )
+
+    def handle_noargs(self, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+        self.processes = int(options.get('processes') or multiprocessing.cpu_count())
+        self.chunk_size = int(options.get('chunk_size', 100000))
+        self.state_dir = options.get('state_dir', None)
+        if self.state_dir is not None and not os.path.isdir(self.state_dir):
+            raise CommandError('The state directory %s does not exist.' % self.state_dir)
+
+        # The time of the rebuild is kept, so a resumed rebuild is the same.
+        now = self._load_state('now')
+        if now is None:
+            now = datetime.datetime.now()
+            self._save_state('now', now)
+
+        # Each database that holds log entries (each shard, in particular) has
+        # its own log aggregates.
+        rebuilt = deleted = 0
+        for using in get_shards():
+            checksum_ids, stale_ids = self._rebuild_database(now, using)
+            rebuilt += len(checksum_ids)
+            deleted += len(stale_ids)
+        self._clear_state()
+
+        if self.verbosity >= 1:
+            print 'Rebuilt %d log aggregates, deleted %d log aggregates.' % (rebuilt, deleted)
+
+    def _rebuild_database(self, now, using):
+        """
+        Rebuilds the log aggregates in the database `using`. Returns the id of
+        the log aggregate for each checksum and the ids of the deleted log
+        aggregates.
+        """
+        bounds = LogEntry.objects.using(using).aggregate(Min('pk'), Max('pk'))
+        if bounds['pk__min'] is None:
+            return {}, []
+        ranges = [(start, start + self.chunk_size) for start in range(bounds['pk__min'], bounds['pk__max'] + 1, self.chunk_size)]
+
+        # Compute the log aggregates per range of log entries and merge them.
+        results = {}
+        for start, partials in self._run('scan', _scan_range, [(start, end, now, using) for start, end in ranges], using):
+            _merge_partials(results, partials)
+
+        # Replace the log aggregates at once. Log entries whose log aggregate
+        # changed are linked to their new log aggregate afterwards.
+        checksum_ids, stale_ids = self._load_state('swap-%s' % using) or transaction.commit_on_success(using=using)(self._swap)(results, now, using)
+        self._save_state('swap-%s' % using, (checksum_ids, stale_ids))
+
+        _checksum_ids.clear()
+        _checksum_ids.update(checksum_ids)
+        for start, result in self._run('relink', _relink_range, [(start, end, using) for start, end in ranges], using):
+            pass
+
+        transaction.commit_on_success(using=using)(self._delete_stale)(stale_ids, using)
+        return checksum_ids, stale_ids
+
+    def _run(self, phase, func, tasks, using):
+        """
+        Runs `func` for each of the `tasks` in a pool of processes and yields
+        the results. Tasks that were done before are taken from the state
+        directory.
+        """
+        todo = []
+        for task in tasks:
+            result = self._load_state('%s-%s-%s' % (phase, using, task[0]))
+            if result is None:
+                todo.append(task)
+            else:
+                yield task[0], result
+
+        if self.processes > 1 and len(todo) > 1:
+            # Each process needs its own database connection.
+            for connection in connections.all():
+                connection.close()
+            pool = multiprocessing.Pool(self.processes)
+            results = pool.imap_unordered(func, todo)
+        else:
+            pool = None
+            results = (func(task) for task in todo)
+
+        try:
+            done = len(tasks) - len(todo)
+            for start, result in results:
+                done += 1
+                # Mark tasks without result as done with an empty dictionary.
+                self._save_state('%s-%s-%s' % (phase, using, start), result or {})
+                if self.verbosity >= 2:
+                    print '%s %s: %d of %d ranges done.' % (phase.capitalize(), using, done, len(tasks))
+                yield start, result
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def _swap(self, results, now, using):
+        """
+        Updates, creates and deletes log aggregates in the database `using`
+        according to the merged `results`, in one transaction. Returns the id of
+        the log aggregate for each checksum and the ids of the log aggregates
+        that no longer have log entries.
+        """
+        existing_ids = dict(LogAggregate.objects.using(using).values_list('checksum', 'pk'))
+        rate_minutes = get_seconds(djangologdb_settings.RATE_PERIOD) / 60
+
+        checksum_ids = {}
+        for checksum, result in results.items():
+            log_aggregate = LogAggregate()
+            log_aggregate.add_hour_counts(result['hour_counts'], now)
+
+            values = dict(result['entries'],
+                times_seen=result['count'],
+                first_seen=result['first_seen'],
+                last_seen=result['last_seen'],
+                rate=result['recent_count'] / rate_minutes,
+                rate_variance=0,
+                rate_updated=now,
+                hourly_counts=log_aggregate.hourly_counts,
+                hourly_counts_updated=now,
+            )
+            if checksum in existing_ids:
+                checksum_ids[checksum] = existing_ids[checksum]
+            else:
+                checksum_ids[checksum] = LogAggregate.objects.db_manager(using).create(checksum=checksum, **values).pk
+            # Saving sets the dates to the current time, so always update.
+            LogAggregate.objects.using(using).filter(pk=checksum_ids[checksum]).update(**values)
+
+        stale_ids = [pk for checksum, pk in existing_ids.items() if checksum not in results]
+        return checksum_ids, stale_ids
+
+    def _delete_stale(self, stale_ids, using):
+        for i in range(0, len(stale_ids), 500):
+            pks = stale_ids[i:i + 500]
+            # Unlink any log entries that were aggregated in the meantime, so
+            # they are not deleted along with their log aggregate.
+            LogEntry.objects.using(using).filter(log_aggregate__in=pks).update(log_aggregate=None)
+            LogToken.objects.using(using).filter(log_aggregate__in=pks).update(log_aggregate=None)
+            LogAggregate.objects.using(using).filter(pk__in=pks).delete()
+
+    def _get_state_path(self, name):
+        return os.path.join(self.state_dir, '%s.pickle' % name)
+
+    def _load_state(self, name):
+        if self.state_dir is None or not os.path.exists(self._get_state_path(name)):
+            return None
+        f = open(self._get_state_path(name), 'rb')
+        try:
+            return pickle.load(f)
+        finally:
+            f.close()
+
+    def _save_state(self, name, value):
+        if self.state_dir is None:
+            return
+        # Write to a temporary file first, so an interrupted write is not
+        # mistaken for a finished task.
+        path = self._get_state_path(name)
+        f = open(path + '.tmp', 'wb')
+        try:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(path + '.tmp', path)
+
+    def _clear_state(self):
+        if self.state_dir is None:
+            return
+        for filename in os.listdir(self.state_dir):
+            if filename.endswith('.pickle'):
+                os.remove(os.path.join(self.state_dir, filename))
@@ -0,0 +1,114 @@
+/*
+ * Draws a graph with the datasets from the datasets view, and keeps it up to
+ * date if `refresh` is set. Updates only ask for the data points from the last
+ * one on, and only if there are new or newly aggregated log entries.
+ *
+ * `getParams` returns the GET-parameters of the datasets view. `plot` is
+ * called with the list of datasets whenever they change.
+ */
+function djangologdbGraph($, url, getParams, plot, refresh, wait) {
+	var datasets = null;
+	var last_id = '';
+
+	// Returns the current data point, the first one that can have changed.
+	// A minute is subtracted in case the clock of the server is behind.
+	function getSince() {
+		var now = new Date().getTime() - 60 * 1000;
+		var since = null;
+		$.each(datasets || {}, function(key, dataset) {
+			$.each(dataset.data, function(i, point) {
+				if (point[0] <= now && (since === null || point[0] > since)) {
+					since = point[0];
+				}
+			});
+		});
+		return since;
+	}
+
+	function merge(changes, since, start_date) {
+		// The data points of the changes, to fill in the datasets without log
+		// entries in that period.
+		var timestamps = [];
+		$.each(changes, function(key, dataset) {
+			timestamps = $.map(dataset.data, function(point) { return point[0]; });
+			return false;
+		});
+		if (timestamps.length == 0) {
+			return;
+		}
+
+		// New datasets have no log entries before the changes.
+		$.each(datasets, function(key, dataset) {
+			$.each(changes, function(key, change) {
+				if (!datasets[key]) {
+					datasets[key] = $.extend({}, change, {data: $.map(dataset.data, function(point) { return [[point[0], 0]]; })});
+				}
+			});
+			return false;
+		});
+
+		// Replace the data points from `since` up to the last changed one.
+		var until = timestamps[timestamps.length - 1];
+		$.each(datasets, function(key, dataset) {
+			var before = $.grep(dataset.data, function(point) {
+				return point[0] >= start_date && point[0] < since;
+			});
+			var after = $.grep(dataset.data, function(point) {
+				return point[0] > until;
+			});
+			var changed = changes[key] ? changes[key].data : $.map(timestamps, function(timestamp) { return [[timestamp, 0]]; });
+			dataset.data = before.concat(changed, after);
+		});
+	}
+
+	function draw() {
+		var data = [];
+		$.each(datasets, function(key, val) {
+			data.push(datasets[key]);
+		});
+		plot(data);
+	}
+
+	function update() {
+		var params = getParams();
+		if (refresh) {
+			var since = getSince();
+			params.last_id = last_id;
+			if (since !== null) {
+				params.since = since;
+				params.wait = wait;
+			}
+		}
+
+		$.ajax({
+			url: url,
+			data: params,
+			dataType: 'json',
+			success: function(result) {
+				if (!refresh) {
+					datasets = result;
+					draw();
+					return;
+				}
+
+				if (result.last_id != last_id) {
+					last_id = result.last_id;
+					if (since === null) {
+						datasets = result.datasets;
+					} else {
+						merge(result.datasets, since, params.start_date);
+					}
+					draw();
+				}
+				setTimeout(update, refresh * 1000);
+			},
+			error: function() {
+				if (refresh) {
+					setTimeout(update, refresh * 1000);
+				}
+			}
+		});
+	}
+
+	update();
+}
@@ -1,13 +1,51 @@
 import logging
+import uuid
 
 from django.http import Http404
 from django.utils.encoding import smart_unicode
 
+from djangologdb.handlers import start_batch, flush_batch, end_batch
+
 logger = logging.getLogger(__name__)
 
-__all__ = ('LoggingMiddleware',)
+__all__ = ('LoggingMiddleware', 'BatchingMiddleware',)
 
 class LoggingMiddleware(object):
     def process_exception(self, request, exception):
         if not isinstance(exception, Http404):
             logger.error(smart_unicode(exception), exc_info=True)
+
+class BatchingMiddleware(object):
+    """
+    Writes all log entries of a request at once at the end of the request, or
+    when there are `LOGDB_BATCH_SIZE` of them. The request id, path, method and
+    user id are added to the extra attributes of these log entries.
+
+    Put this middleware first in `MIDDLEWARE_CLASSES`, so it sees the records
+    of all other middleware. The request id is taken from the `X-Request-Id`
+    header if present.
+    """
+    def process_request(self, request):
+        request.logdb_context = {
+            'request_id': request.META.get('HTTP_X_REQUEST_ID') or uuid.uuid4().hex,
+            'request_path': request.path,
+            'request_method': request.method,
+        }
+        start_batch(request.logdb_context)
+
+    def process_exception(self, request, exception):
+        self._add_user_id(request)
+        flush_batch()
+
+    def process_response(self, request, response):
+        self._add_user_id(request)
+        end_batch()
+        return response
+
+    def _add_user_id(self, request):
+        # Only use the user if the authentication middleware loaded it already,
+        # to avoid extra queries.
+        context = getattr(request, 'logdb_context', None)
+        user = getattr(request, '_cached_user', None)
+        if context is not None and user is not None and 'user_id' not in context:
+            context['user_id'] = user.pk
@@ -1,13 +1,22 @@
-﻿import logging
+﻿import bisect
+import logging
 import datetime
+import heapq
+import math
+import time
 
 from django.db import models
-from django.db.models import Count
+from django.db.models import Count, Min, Max, Q
 from django.utils.translation import ugettext_lazy as _
+from django.utils.encoding import force_unicode
 from django.db.models.query import QuerySet
 
 from djangologdb import settings as djangologdb_settings
-from djangologdb.utils import get_timestamp, JSONField, TupleField
+from djangologdb import archive, signals, stats
+from djangologdb.fingerprint import get_fingerprint
+from djangologdb.clustering import Cluster, TemplateTree, tokenize
+from djangologdb.shards import get_shards, scatter
+from djangologdb.utils import get_timestamp, get_seconds, get_hour, get_string_id, get_tokens, get_field_value, translate_interned_lookups, bulk_insert, JSONField, TupleField, InternedCharField, CompressedTextField
 
 LOG_LEVELS = (
     (logging.INFO, 'Info'),
@@ -42,9 +51,83 @@ LOG_RECORD_RESERVED_ATTRS = (
     'asctime',
 )
 
-class LogQuerySet(QuerySet):
+# Only used to format exception traces.
+_formatter = logging.Formatter()
 
-    def get_datasets(self, interval=None, aggregate=None, start_date=None, end_date=None):
+# Repeated string columns are stored in a dictionary table if configured.
+if djangologdb_settings.INTERN_STRINGS:
+    StringField = InternedCharField
+else:
+    StringField = models.CharField
+
+def _get_level_dataset(level):
+    dataset = {
+        'label': logging.getLevelName(level),
+        'data': [],
+    }
+    if level in djangologdb_settings.LEVEL_COLORS:
+        dataset['color'] = djangologdb_settings.LEVEL_COLORS[level]
+    return dataset
+
+def _get_tag_value(value):
+    return force_unicode(value)[:200]
+
+def _get_tags(log_entry):
+    """
+    Returns the unsaved `LogTag`s of the extra attributes of `log_entry` that
+    are in the `LOGDB_INDEXED_EXTRA_KEYS` setting.
+    """
+    extra = log_entry.extra or {}
+    tags = []
+    for key in djangologdb_settings.INDEXED_EXTRA_KEYS:
+        if key in extra:
+            tags.append(LogTag(key=key, value=_get_tag_value(extra[key]), log_entry_id=log_entry.pk))
+    return tags
+
+def _search(queryset, query, column):
+    """
+    Filters `queryset` on the objects that contain all words in `query`,
+    according to the `LogToken` column `column`.
+    """
+    for token in get_tokens(query):
+        queryset = queryset.filter(pk__in=LogToken.objects.filter(token=token).values(column))
+    return queryset
+
+class InternedQuerySet(QuerySet):
+    """
+    Queryset that supports lookups like ``startswith`` on interned strings.
+    """
+    def _filter_or_exclude(self, negate, *args, **kwargs):
+        if not djangologdb_settings.INTERN_STRINGS or not (args or kwargs):
+            return super(InternedQuerySet, self)._filter_or_exclude(negate, *args, **kwargs)
+
+        return super(InternedQuerySet, self)._filter_or_exclude(negate, translate_interned_lookups(self.model, Q(*args, **kwargs)))
+
+class LogQuerySet(InternedQuerySet):
+
+    def search(self, query):
+        """
+        Returns the log entries that contain all words in `query`, in their
+        message or exception trace. Only aggregated log entries can be found,
+        and only if the `LOGDB_SEARCH_INDEX` setting is enabled.
+        """
+        return _search(self, query, 'log_entry')
+
+    def filter_extra(self, **kwargs):
+        """
+        Returns the log entries with the given values of extra attributes, for
+        example ``filter_extra(ip_address='127.0.0.1')``. Only the keys in the
+        `LOGDB_INDEXED_EXTRA_KEYS` setting can be used, and only log entries
+        that were written while the key was in that setting are found.
+        """
+        queryset = self
+        for key, value in kwargs.items():
+            if key not in djangologdb_settings.INDEXED_EXTRA_KEYS:
+                raise ValueError('The extra attribute %s is not in LOGDB_INDEXED_EXTRA_KEYS.' % key)
+            queryset = queryset.filter(pk__in=LogTag.objects.filter(key=key, value=_get_tag_value(value)).values('log_entry'))
+        return queryset
+
+    def get_datasets(self, interval=None, aggregate=None, start_date=None, end_date=None, approximate=False):
         """
         Returns the (graph) datasets, grouped by level or checksum.
         
@@ -56,6 +139,11 @@ class LogQuerySet(QuerySet):
         combination with the `start_date` or `end_date` arguments can lead to 
         unexpected results. These arguments are added for convenience.
         
+        Log entries that were archived by the `archive_logs` command are
+        included if the queryset is not filtered. If `LOGDB_SHARDS` is set, 
+        the datasets of all shards are added up, unless the queryset uses one
+        database.
+        
         **Arguments**
         
         ``interval``
@@ -74,20 +162,103 @@ class LogQuerySet(QuerySet):
             A `datetime.datetime` to end the period for the datasets. The
             default is the last `LogEntry` in the queryset.
         
+        ``approximate``
+            Estimate the number of log entries from a sample of at most
+            `LOGDB_SAMPLE_SIZE` log entries, instead of counting all of them.
+            Each dataset then also has `bounds`, with the timestamp and the
+            lower and upper bound of the 95% confidence interval of each data
+            point. Rare levels or checksums can be missing from a sample.
+        
         """
+        if not djangologdb_settings.STATS:
+            return self._get_datasets(interval, aggregate, start_date, end_date, approximate)
+
+        start = time.time()
+        query_counter = stats.QueryCounter(self.db)
+        query_counter.start()
+        try:
+            datasets = self._get_datasets(interval, aggregate, start_date, end_date, approximate)
+        finally:
+            queries = query_counter.stop()
+
+        datasets_stats = {
+            'queries': queries,
+            'rows': sum([sum([count for timestamp, count in dataset['data']]) for dataset in datasets.values()]),
+            'time': time.time() - start,
+        }
+        stats.incr('get_datasets.calls')
+        stats.incr('get_datasets.queries', datasets_stats['queries'])
+        stats.incr('get_datasets.rows', datasets_stats['rows'])
+        stats.timing('get_datasets.time', datasets_stats['time'])
+        stats.maybe_flush()
+        signals.datasets_created.send(sender=self.__class__, stats=datasets_stats)
+        return datasets
+
+    def _get_segments(self):
+        # Archived log entries can not be filtered, so they are only included
+        # if the queryset is not filtered.
+        if self.query.where.children:
+            return []
+        return archive.get_segments()
+
+    def _get_sharded_datasets(self, interval=None, aggregate=None, start_date=None, end_date=None, approximate=False):
+        shards = get_shards()
+
+        # All shards need to use the same intervals.
+        if start_date is None or end_date is None:
+            segments = self._get_segments()
+            bounds = scatter(lambda alias: self.using(alias).aggregate(Min('created'), Max('created')), shards)
+            if start_date is None:
+                oldest = [bound['created__min'] for bound in bounds if bound['created__min'] is not None]
+                oldest += [segment.get_start_date() for segment in segments[:1]]
+                if len(oldest) == 0:
+                    return {}
+                start_date = min(oldest)
+            if end_date is None:
+                latest = [bound['created__max'] for bound in bounds if bound['created__max'] is not None]
+                latest += [segment.get_end_date() for segment in segments]
+                if len(latest) == 0:
+                    return {}
+                end_date = max(latest)
+
+        # Archived log entries are only counted once.
+        results = scatter(lambda alias: self.using(alias)._get_datasets(interval, aggregate, start_date, end_date, approximate, archived=alias == shards[0]), shards)
+
+        datasets = {}
+        for result in results:
+            for key, dataset in result.items():
+                if key not in datasets:
+                    datasets[key] = dataset
+                    continue
+                for point, (timestamp, count) in zip(datasets[key]['data'], dataset['data']):
+                    point[1] += count
+                # The bounds of the shards are added up as well, which is
+                # pessimistic.
+                for point, (timestamp, lower, upper) in zip(datasets[key].get('bounds', []), dataset.get('bounds', [])):
+                    point[1] += lower
+                    point[2] += upper
+        return datasets
+
+    def _get_datasets(self, interval=None, aggregate=None, start_date=None, end_date=None, approximate=False, archived=True):
+        if djangologdb_settings.SHARDS and self._db is None:
+            return self._get_sharded_datasets(interval, aggregate, start_date, end_date, approximate)
+
         datasets = {}
+        segments = archived and self._get_segments() or []
 
         # Note that calls to self return new querysets.
         if start_date is None:
-            oldest = self.order_by('created')[:1]
+            oldest = [log_entry.created for log_entry in self.order_by('created')[:1]]
+            oldest += [segment.get_start_date() for segment in segments[:1]]
             if len(oldest) == 0:
                 return datasets
-            start_date = oldest[0].created
+            start_date = min(oldest)
         if end_date is None:
-            latest = self.order_by('-created')[:1]
+            latest = [log_entry.created for log_entry in self.order_by('-created')[:1]]
+            latest += [segment.get_end_date() for segment in segments]
             if len(latest) == 0:
                 return datasets
-            end_date = latest[0].created
+            end_date = max(latest)
         if start_date > end_date:
             raise ValueError('The end_date needs to be higher than the start_date.')
         if interval is None:
@@ -97,51 +268,221 @@ class LogQuerySet(QuerySet):
         elif aggregate not in ['level', 'checksum']:
             raise ValueError('The aggregate needs to be either \'checksum\' or \'level\'.')
 
+        if approximate:
+            return self._get_approximate_datasets(interval, aggregate, start_date, end_date, segments)
+
         # Get all the levels used in the specified date range and prepare the
         # datasets.
         if aggregate == 'checksum':
+            name_field = LogAggregate._meta.get_field('name')
             for entry in self.filter(created__range=(start_date, end_date)).exclude(log_aggregate__checksum=None).values('log_aggregate__name', 'log_aggregate__checksum').distinct():
                 datasets[entry['log_aggregate__checksum']] = {
-                    'label': entry['log_aggregate__name'],
+                    'label': get_field_value(name_field, entry['log_aggregate__name'], self.db),
                     'data': [],
                 }
         else:
             for level in self.filter(created__range=(start_date, end_date)).values_list('level', flat=True).distinct():
-                datasets[level] = {
-                    'label': logging.getLevelName(level),
-                    'data': [],
-                }
-                if level in djangologdb_settings.LEVEL_COLORS:
-                    datasets[level]['color'] = djangologdb_settings.LEVEL_COLORS[level]
+                datasets[level] = _get_level_dataset(level)
+
+        # Count the archived log entries per interval at once.
+        archived_counts = {}
+        if segments and start_date < end_date:
+            boundaries = [start_date]
+            while boundaries[-1] < end_date:
+                boundaries.append(boundaries[-1] + interval)
+            archived_counts = archive.get_counts(segments, [archive.get_exact_timestamp(date) for date in boundaries], aggregate)
+            for key, counts in archived_counts.items():
+                if key in datasets:
+                    continue
+                if aggregate == 'checksum':
+                    datasets[key] = {'label': counts['label'], 'data': []}
+                else:
+                    datasets[key] = _get_level_dataset(key)
 
         current_date = start_date
+        current_interval = 0
         # FIXME: It is not possible to group by a certain interval (for example:
         # by month, by hour) via the Django ORM, hence we execute 1 query per 
         # interval.
         while(current_date < end_date):
             # Get the number of log entries per level or checksum.
+            # The half-open range makes sure log entries are only counted once
+            # and lets the database skip partitions outside of it.
+            period = self.filter(created__gte=current_date, created__lt=current_date + interval)
             if aggregate == 'checksum':
-                stats = self.filter(created__range=(current_date, current_date + interval)).values('log_aggregate__checksum').annotate(log_count=Count('level')).values_list('log_aggregate__checksum', 'log_count')
+                stats = period.values('log_aggregate__checksum').annotate(log_count=Count('level')).values_list('log_aggregate__checksum', 'log_count')
             else:
-                stats = self.filter(created__range=(current_date, current_date + interval)).values('level').annotate(log_count=Count('level')).values_list('level', 'log_count')
+                stats = period.values('level').annotate(log_count=Count('level')).values_list('level', 'log_count')
             aggregated_logs = dict(stats)
             timestamp = get_timestamp(current_date)
 
             for aggr, dataset in datasets.items():
-                dataset['data'].append([timestamp, aggregated_logs[aggr] if aggregated_logs.has_key(aggr) else 0])
+                count = aggregated_logs[aggr] if aggregated_logs.has_key(aggr) else 0
+                if archived_counts.has_key(aggr):
+                    count += archived_counts[aggr]['counts'][current_interval]
+                dataset['data'].append([timestamp, count])
 
             current_date += interval
+            current_interval += 1
+
+        return datasets
+
+    def _get_approximate_datasets(self, interval, aggregate, start_date, end_date, segments):
+        boundaries = [start_date]
+        while boundaries[-1] < end_date:
+            boundaries.append(boundaries[-1] + interval)
+
+        # Take every `step`th id, so the sample is spread evenly over the log
+        # entries. Each log entry has a chance of 1 in `step` to be in it, also
+        # if ids are missing, and the ids are looked up by primary key, so
+        # the range of the graph does not matter.
+        ids = self.aggregate(Min('pk'), Max('pk'))
+        step = 1
+        sample = {}
+        labels = {}
+        if ids['pk__min'] is not None:
+            step = max(int(math.ceil((ids['pk__max'] - ids['pk__min'] + 1) / float(djangologdb_settings.SAMPLE_SIZE))), 1)
+            sample_ids = range(ids['pk__min'], ids['pk__max'] + 1, step)
+            queryset = self.filter(created__gte=start_date, created__lt=boundaries[-1])
+            if aggregate == 'checksum':
+                name_field = LogAggregate._meta.get_field('name')
+                queryset = queryset.exclude(log_aggregate=None).values_list('created', 'log_aggregate__checksum', 'log_aggregate__name')
+            else:
+                queryset = queryset.values_list('created', 'level', 'level')
+
+            for i in range(0, len(sample_ids), 500):
+                for created, key, label in queryset.filter(pk__in=sample_ids[i:i + 500]):
+                    if key not in sample:
+                        sample[key] = [0] * (len(boundaries) - 1)
+                        if aggregate == 'checksum':
+                            labels[key] = get_field_value(name_field, label, self.db)
+                    sample[key][bisect.bisect_right(boundaries, created) - 1] += 1
+
+        archived_counts = {}
+        if segments and start_date < end_date:
+            archived_counts = archive.get_counts(segments, [archive.get_exact_timestamp(date) for date in boundaries], aggregate)
+
+        datasets = {}
+        for key in set(sample.keys() + archived_counts.keys()):
+            if aggregate == 'checksum':
+                datasets[key] = {'label': labels.get(key) or archived_counts[key]['label'], 'data': [], 'bounds': []}
+            else:
+                datasets[key] = _get_level_dataset(key)
+                datasets[key]['bounds'] = []
+
+            for period, boundary in enumerate(boundaries[:-1]):
+                found = key in sample and sample[key][period] or 0
+                archived = key in archived_counts and archived_counts[key]['counts'][period] or 0
+                estimate = found * step
+                if step == 1:
+                    margin = 0
+                elif found == 0:
+                    # With none in the sample, there are fewer than 3 times
+                    # `step` log entries with 95% confidence.
+                    margin = 3 * step
+                else:
+                    margin = int(round(1.96 * math.sqrt(found * (1 - 1.0 / step)) * step))
+
+                timestamp = get_timestamp(boundary)
+                datasets[key]['data'].append([timestamp, estimate + archived])
+                datasets[key]['bounds'].append([timestamp, max(estimate - margin, found) + archived, estimate + margin + archived])
 
         return datasets
 
+    def get_top(self, n=20, start_date=None, end_date=None, by='count', level=None):
+        """
+        Returns the `n` log aggregates with the most log entries from 
+        `start_date` to `end_date`, as a list of dictionaries with the 
+        `log_aggregate` and its `count`, most first.
+        
+        **Arguments**
+        
+        ``by``
+            Either 'count' for the log aggregates with the most log entries, or
+            'growth' for the log aggregates whose number of log entries grew 
+            the most compared to the period of the same length just before
+            `start_date`. The dictionaries then also contain the 
+            `previous_count` and the `growth`.
+        
+        ``start_date``
+            A `datetime.datetime`. The default is 1 hour before `end_date`.
+        
+        ``end_date``
+            A `datetime.datetime`. The default is the current time.
+        
+        ``level``
+            Only count log entries with this level.
+        
+        """
+        if by not in ['count', 'growth']:
+            raise ValueError('The by argument needs to be either \'count\' or \'growth\'.')
+        if end_date is None:
+            end_date = datetime.datetime.now()
+        if start_date is None:
+            start_date = end_date - datetime.timedelta(0, 60 * 60)
+        if start_date > end_date:
+            raise ValueError('The end_date needs to be higher than the start_date.')
+
+        if djangologdb_settings.SHARDS and self._db is None:
+            # The log aggregates of the shards are distinct.
+            top = []
+            for shard_top in scatter(lambda alias: self.using(alias).get_top(n, start_date, end_date, by, level)):
+                top.extend(shard_top)
+            top.sort(key=lambda row: (row.get('growth', row['count']), row['count']), reverse=True)
+            return top[:n]
+
+        queryset = self.exclude(log_aggregate=None)
+        if level is not None:
+            queryset = queryset.filter(level=level)
+
+        def get_counts(start_date, end_date):
+            return queryset.filter(created__gte=start_date, created__lt=end_date).values('log_aggregate').annotate(log_count=Count('level'))
+
+        if by == 'count':
+            # The database does the sorting and limiting.
+            top = [{'log_aggregate': row['log_aggregate'], 'count': row['log_count']} for row in get_counts(start_date, end_date).order_by('-log_count')[:n]]
+        else:
+            counts = dict(get_counts(start_date, end_date).values_list('log_aggregate', 'log_count'))
+            previous_counts = dict(get_counts(start_date - (end_date - start_date), start_date).values_list('log_aggregate', 'log_count'))
+
+            growths = []
+            for id, count in counts.items():
+                previous_count = previous_counts.get(id, 0)
+                growths.append((count - previous_count, count, previous_count, id))
+            top = [{'log_aggregate': id, 'count': count, 'previous_count': previous_count, 'growth': growth}
+                for growth, count, previous_count, id in heapq.nlargest(n, growths)]
+
+        log_aggregates = LogAggregate.objects.using(self.db).in_bulk([row['log_aggregate'] for row in top])
+        for row in top:
+            row['log_aggregate'] = log_aggregates.get(row['log_aggregate'])
+        return [row for row in top if row['log_aggregate'] is not None]
+
 class LogManager(models.Manager):
 
     def get_query_set(self):
-        return LogQuerySet(self.model)
+        return LogQuerySet(self.model, using=self._db)
 
     def get_datasets(self, *args, **kwargs):
         return self.get_query_set().get_datasets(*args, **kwargs)
 
+    def search(self, *args, **kwargs):
+        return self.get_query_set().search(*args, **kwargs)
+
+    def get_top(self, *args, **kwargs):
+        return self.get_query_set().get_top(*args, **kwargs)
+
+    def filter_extra(self, *args, **kwargs):
+        return self.get_query_set().filter_extra(*args, **kwargs)
+
+    def load_details(self, log_entries):
+        """
+        Loads the `LogEntryDetail` of each log entry in `log_entries` with a
+        single query, instead of one query per log entry when it is accessed.
+        """
+        details = LogEntryDetail.objects.using(self.db).in_bulk([log_entry.pk for log_entry in log_entries])
+        for log_entry in log_entries:
+            log_entry._detail = details.get(log_entry.pk) or LogEntryDetail(log_entry_id=log_entry.pk)
+
     def _get_extra(self, record):
         """
         Get the extra fields by filtering out the known reserved fields.
@@ -158,6 +499,26 @@ class LogManager(models.Manager):
         """
         Creates an error log for a `logging` module `record` instance. This is
         done with as little overhead as possible.
+        """
+        stats_enabled = djangologdb_settings.STATS
+        if stats_enabled:
+            start = time.time()
+
+        log_entry = self.build_from_record(record)
+
+        if stats_enabled:
+            converted = time.time()
+            stats.timing('handler.convert_time', converted - start)
+
+        log_entry.save(force_insert=True, using=self.db)
+
+        if stats_enabled:
+            stats.timing('handler.db_time', time.time() - converted)
+        return log_entry
+
+    def build_from_record(self, record):
+        """
+        Returns an unsaved log entry for a `logging` module `record` instance.
 
         NOTE: The message and message arguments are stringified in case odd 
         objects are passed, even though this should be up to the user.
@@ -189,9 +550,21 @@ class LogManager(models.Manager):
             except:
                 msg = u'(django-logdb: Message encoding error)'
 
-        log_entry = LogEntry.objects.create(
+        # The exception trace is only formatted if a formatter was used before,
+        # so format it like `logging.Formatter` would.
+        exc_text = record.exc_text
+        if not exc_text and record.exc_info:
+            exc_text = record.exc_text = _formatter.formatException(record.exc_info)
+        if exc_text:
+            exc_text = force_unicode(exc_text, errors='replace')
+
+        return self.model(
             args=tuple(args),
-            exc_text=record.exc_text,
+            # Only kept if the log entry is saved with `create_many`, `save`
+            # always uses the current time.
+            created=datetime.datetime.fromtimestamp(record.created),
+            exc_text=exc_text,
+            fingerprint=get_fingerprint(exc_text),
             filename=record.filename,
             function_name=record.funcName,
             level=record.levelno,
@@ -206,24 +579,125 @@ class LogManager(models.Manager):
             thread_name=record.threadName,
             extra=self._get_extra(record),
         )
-        return log_entry
+
+    def create_many(self, log_entries):
+        """
+        Saves the unsaved `log_entries` and their details with a query per 
+        table (per batch of rows), instead of two queries per log entry.
+        """
+        bulk_insert(self.model, log_entries, using=self.db, return_ids=True)
+
+        changed = [log_entry for log_entry in log_entries if log_entry._detail_changed]
+        for log_entry in changed:
+            log_entry._detail.log_entry_id = log_entry.pk
+        bulk_insert(LogEntryDetail, [log_entry._detail for log_entry in changed], using=self.db)
+
+        if djangologdb_settings.INDEXED_EXTRA_KEYS:
+            tags = []
+            for log_entry in log_entries:
+                tags.extend(_get_tags(log_entry))
+            bulk_insert(LogTag, tags, using=self.db)
+
+        # Only now the details are saved, so a failed call can be repeated.
+        for log_entry in changed:
+            log_entry._detail_changed = False
+
+class LogStringManager(models.Manager):
+    """
+    Manager for the dictionary of interned strings. Both the known ids and the
+    resolved values are cached per process.
+    """
+    cache_size = 10000
+
+    # Interned strings never change, so these caches only need to be bounded.
+    _known_ids = set()
+    _values = {}
+
+    def intern(self, value):
+        """
+        Returns the id of `value` and makes sure it is present in the
+        dictionary of the current database.
+        """
+        id = get_string_id(value)
+        key = (self.db, id)
+        if key not in self._known_ids:
+            log_string, is_created = self.get_or_create(pk=id, defaults={'value': value})
+            # A newly created string can still be rolled back along with the
+            # current transaction, so only remember strings that already existed.
+            if not is_created:
+                if len(self._known_ids) >= self.cache_size:
+                    self._known_ids.clear()
+                self._known_ids.add(key)
+        return id
+
+    def get_value(self, id):
+        """
+        Returns the string for `id` or ``None`` if it is not in the dictionary
+        of the current database.
+        """
+        key = (self.db, id)
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+
+        values = list(self.filter(pk=id).values_list('value', flat=True)[:1])
+        if len(values) == 0:
+            return None
+
+        if len(self._values) >= self.cache_size:
+            self._values.clear()
+        self._values[key] = values[0]
+        return values[0]
+
+class LogString(models.Model):
+    """
+    A string that is repeated in many log entries, like a logger name or a path.
+    Only used if `LOGDB_INTERN_STRINGS` is enabled.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    value = models.TextField()
+
+    objects = LogStringManager()
+
+    def __unicode__(self):
+        return self.value
 
 class BaseLogEntry(models.Model):
     """
     Basic log entry fields.
     """
-    filename = models.CharField(max_length=50, blank=True, null=True)
-    function_name = models.CharField(max_length=50, blank=True, null=True)
+    filename = StringField(max_length=50, blank=True, null=True)
+    function_name = StringField(max_length=50, blank=True, null=True)
     level = models.PositiveIntegerField(choices=LOG_LEVELS, default=logging.CRITICAL, db_index=True)
     line_number = models.PositiveIntegerField(default=0)
-    module = models.CharField(max_length=50, blank=True, null=True)
+    module = StringField(max_length=50, blank=True, null=True)
     msg = models.TextField(blank=True, null=True)
-    name = models.CharField(max_length=200, default='root', db_index=True)
-    path = models.CharField(max_length=200, blank=True, null=True)
+    name = StringField(max_length=200, default='root', db_index=True)
+    path = StringField(max_length=200, blank=True, null=True)
 
     class Meta:
         abstract = True
 
+SPARKLINE_CHARS = u'\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588'
+
+class LogAggregateQuerySet(InternedQuerySet):
+
+    def search(self, query):
+        """
+        Returns the log aggregates with log entries that contain all words in
+        `query`. See `LogQuerySet.search`.
+        """
+        return _search(self, query, 'log_aggregate')
+
+class LogAggregateManager(models.Manager):
+
+    def get_query_set(self):
+        return LogAggregateQuerySet(self.model, using=self._db)
+
+    def search(self, *args, **kwargs):
+        return self.get_query_set().search(*args, **kwargs)
+
 class LogAggregate(BaseLogEntry):
     """
     An aggregation of various similar log entries.
@@ -232,31 +706,190 @@ class LogAggregate(BaseLogEntry):
     last_seen = models.DateTimeField(auto_now=True)
     first_seen = models.DateTimeField(auto_now_add=True)
     checksum = models.CharField(max_length=32, unique=True)
+    # Exponentially weighted moving average and variance of the number of log
+    # entries per minute, as of `rate_updated`.
+    rate = models.FloatField(default=0)
+    rate_variance = models.FloatField(default=0)
+    rate_updated = models.DateTimeField(blank=True, null=True)
+    # Ring buffer of the number of log entries per hour, see `get_hourly_counts`.
+    hourly_counts = TupleField(blank=True, null=True, editable=False)
+    hourly_counts_updated = models.DateTimeField(blank=True, null=True, editable=False)
+    # Whether this log aggregate collects the log entries of its logger beyond
+    # `LOGDB_MAX_AGGREGATES_PER_LOGGER`.
+    is_overflow = models.BooleanField(default=False, editable=False)
+
+    objects = LogAggregateManager()
+
+    def add_hourly_counts(self, dates, now):
+        """
+        Adds log entries created at `dates` to the hourly counts, without 
+        saving. Log entries older than the hours that are kept are ignored.
+        """
+        hour_counts = {}
+        for date in dates:
+            hour = get_hour(date)
+            hour_counts[hour] = hour_counts.get(hour, 0) + 1
+        self.add_hour_counts(hour_counts, now)
+
+    def add_hour_counts(self, hour_counts, now):
+        """
+        Like `add_hourly_counts`, with a dictionary of the number of log 
+        entries per hour (as returned by `get_hour`).
+        """
+        size = djangologdb_settings.SPARKLINE_HOURS
+        current_hour = get_hour(now)
+        counts = list(self.hourly_counts or ())
+        if len(counts) != size or self.hourly_counts_updated is None:
+            counts = [0] * size
+        else:
+            # Clear the hours since the last update.
+            last_hour = get_hour(self.hourly_counts_updated)
+            for hour in range(last_hour + 1, min(current_hour, last_hour + size) + 1):
+                counts[hour % size] = 0
+
+        for hour, count in hour_counts.items():
+            if current_hour - size < hour <= current_hour:
+                counts[hour % size] += count
+
+        self.hourly_counts = tuple(counts)
+        self.hourly_counts_updated = now
+
+    def get_hourly_counts(self, now=None):
+        """
+        Returns the number of log entries per hour, for the last 
+        `LOGDB_SPARKLINE_HOURS` hours up to and including the hour of `now`,
+        oldest first.
+        """
+        size = djangologdb_settings.SPARKLINE_HOURS
+        counts = self.hourly_counts or ()
+        if len(counts) != size or self.hourly_counts_updated is None:
+            return [0] * size
+
+        current_hour = get_hour(now or datetime.datetime.now())
+        last_hour = get_hour(self.hourly_counts_updated)
+        # Hours after the last update had no log entries.
+        return [hour <= last_hour and counts[hour % size] or 0 for hour in range(current_hour - size + 1, current_hour + 1)]
+
+    def get_sparkline(self):
+        counts = self.get_hourly_counts()
+        highest = max(counts)
+        if highest == 0:
+            return SPARKLINE_CHARS[0] * len(counts)
+        return u''.join([SPARKLINE_CHARS[(len(SPARKLINE_CHARS) - 1) * count // highest] for count in counts])
+    get_sparkline.short_description = _('last hours')
+
+    def update_rate(self, count, now):
+        """
+        Updates the average and variance of the rate with `count` new log 
+        entries since `rate_updated`, without saving. Returns the rate of these
+        log entries in log entries per minute, or ``None`` if there was no 
+        previous update.
+        
+        Older rates weigh less, with a time constant of `LOGDB_RATE_PERIOD`.
+        """
+        if self.rate_updated is None or now <= self.rate_updated:
+            self.rate_updated = now
+            return None
+
+        elapsed = get_seconds(now - self.rate_updated)
+        current_rate = count * 60 / elapsed
+        weight = 1 - math.exp(-elapsed / get_seconds(djangologdb_settings.RATE_PERIOD))
+
+        difference = current_rate - self.rate
+        increment = weight * difference
+        self.rate += increment
+        self.rate_variance = (1 - weight) * (self.rate_variance + difference * increment)
+        self.rate_updated = now
+        return current_rate
+
+    def get_log_entries(self):
+        """
+        Returns the log entries of this aggregate, along with their details.
+        """
+        return self.logentry_set.select_related('detail')
 
     def __unicode__(self):
         return u'%s, %d' % (self.filename, self.line_number)
 
+def _detail_property(name, doc):
+    """
+    Returns a property that gives access to the field `name` of the
+    `LogEntryDetail` that belongs to a `LogEntry`.
+    """
+    def fget(self):
+        return getattr(self.get_detail(), name)
+
+    def fset(self, value):
+        setattr(self.get_detail(), name, value)
+        self._detail_changed = True
+
+    return property(fget, fset, doc=doc)
+
+def _truncate(msg, length=40):
+    if len(msg) > length:
+        return u'%s [...]' % msg[:length - 5]
+    else:
+        return u'%s' % msg
+
 class LogEntry(BaseLogEntry):
     """
     Represents a single log entry from the `logger` module. Most of the `logger`
     fields are represented in this model, except for some time related fields.
+    
+    The bulky fields `args`, `exc_text` and `extra` are stored in a separate 
+    `LogEntryDetail` table, which is only read when one of these fields is 
+    accessed. They can be used as if they are regular fields.
     """
-    args = TupleField(blank=True, null=True)
     created = models.DateTimeField(auto_now_add=True, db_index=True)
-    exc_text = models.TextField(blank=True, null=True)
     process = models.PositiveIntegerField(default=0)
-    process_name = models.CharField(max_length=200, blank=True, null=True)
+    process_name = StringField(max_length=200, blank=True, null=True)
     thread = models.DecimalField(max_digits=21, decimal_places=0)
-    thread_name = models.CharField(max_length=200, blank=True, null=True)
-    extra = JSONField(blank=True)
+    thread_name = StringField(max_length=200, blank=True, null=True)
+    fingerprint = models.CharField(max_length=32, blank=True, null=True, editable=False)
 
     log_aggregate = models.ForeignKey(LogAggregate, blank=True, null=True)
 
     objects = LogManager()
 
+    _detail = None
+    _detail_changed = False
+
+    args = _detail_property('args', 'The message arguments, always a tuple.')
+    exc_text = _detail_property('exc_text', 'The formatted exception trace.')
+    extra = _detail_property('extra', 'Dictionary of additional attributes of the record.')
+
     class Meta:
         verbose_name_plural = _('Log entries')
 
+    def get_detail(self):
+        """
+        Returns the `LogEntryDetail` of this log entry. A new one is created 
+        (but not saved) if it does not exist yet.
+        """
+        if self._detail is None:
+            detail = None
+            if self.pk is not None:
+                try:
+                    detail = self.detail
+                except LogEntryDetail.DoesNotExist:
+                    pass
+            if detail is None:
+                detail = LogEntryDetail()
+            self._detail = detail
+        return self._detail
+
+    def save(self, *args, **kwargs):
+        is_new = self.pk is None
+        super(LogEntry, self).save(*args, **kwargs)
+
+        if self._detail_changed:
+            self._detail.log_entry_id = self.pk
+            self._detail.save(force_insert=is_new, using=self._state.db)
+            self._detail_changed = False
+
+        if is_new and djangologdb_settings.INDEXED_EXTRA_KEYS:
+            bulk_insert(LogTag, _get_tags(self), using=self._state.db)
+
     def get_message(self):
         if not self.args:
             return self.msg
@@ -267,12 +900,88 @@ class LogEntry(BaseLogEntry):
             return u'Failed to render message: %s' % e
 
     def get_message_display(self):
-        msg = self.get_message()
-        if len(msg) > 40:
-            return u'%s [...]' % msg[:35]
-        else:
-            return u'%s' % msg
+        return _truncate(self.get_message())
     get_message_display.short_description = _('message')
 
+    def get_msg_display(self):
+        """
+        Like `get_message_display` but without the arguments filled in, so it 
+        does not need to read the `LogEntryDetail`.
+        """
+        return _truncate(self.msg or u'')
+    get_msg_display.short_description = _('message')
+
     def __unicode__(self):
         return self.get_message_display()
+
+class LogEntryDetail(models.Model):
+    """
+    The bulky fields of a `LogEntry`. Since these are rarely needed when 
+    scanning log entries, they are kept out of the log entry table.
+    """
+    log_entry = models.OneToOneField(LogEntry, primary_key=True, related_name='detail')
+    args = TupleField(blank=True, null=True)
+    exc_text = CompressedTextField(blank=True, null=True)
+    extra = JSONField(blank=True, compress=True)
+
+    def __unicode__(self):
+        return u'%s' % self.log_entry_id
+
+class LogToken(models.Model):
+    """
+    A word that occurs in the message or exception trace of a log entry. This 
+    is the search index for `LogQuerySet.search`, which is built by the 
+    `aggregate_logs` command.
+    """
+    token = models.CharField(max_length=64, db_index=True)
+    log_entry = models.ForeignKey(LogEntry, related_name='tokens')
+    log_aggregate = models.ForeignKey(LogAggregate, blank=True, null=True, related_name='tokens')
+
+    def __unicode__(self):
+        return self.token
+
+class LogTag(models.Model):
+    """
+    The value of an extra attribute of a log entry, for the keys in the 
+    `LOGDB_INDEXED_EXTRA_KEYS` setting. This is the index for 
+    `LogQuerySet.filter_extra`, which is written along with the log entries.
+    """
+    key = models.CharField(max_length=64)
+    value = models.CharField(max_length=200, db_index=True)
+    log_entry = models.ForeignKey(LogEntry, related_name='tags')
+
+    def __unicode__(self):
+        return u'%s=%s' % (self.key, self.value)
+
+class LogTemplateManager(models.Manager):
+
+    def get_tree(self):
+        """
+        Returns a `TemplateTree` with all stored templates.
+        """
+        tree = TemplateTree(similarity=djangologdb_settings.CLUSTER_SIMILARITY)
+        for id, template in self.values_list('id', 'template'):
+            tree.add(Cluster(tokenize(template), id=id))
+        return tree
+
+    def save_cluster(self, cluster):
+        """
+        Stores the template of `cluster`, which is new if it has no id yet.
+        """
+        if cluster.id is None:
+            cluster.id = self.create(template=cluster.get_template()).pk
+        else:
+            self.filter(pk=cluster.id).update(template=cluster.get_template())
+
+class LogTemplate(models.Model):
+    """
+    A message template of messages that were formatted before they were
+    logged. Only used if `LOGDB_CLUSTER_MESSAGES` is enabled, see
+    `djangologdb.clustering`.
+    """
+    template = models.TextField()
+
+    objects = LogTemplateManager()
+
+    def __unicode__(self):
+        return self.template
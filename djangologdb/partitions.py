@@ -0,0 +1,230 @@
+"""
+Time based partitioning of the log entry table.
+
+On PostgreSQL (11 and higher), the log entry table can be turned into a table
+that is partitioned by range on its `created` column, with one partition per
+day or per week (see `LOGDB_PARTITION_PERIOD`). PostgreSQL only scans the
+partitions that match the `created` range of a query, and old log entries are
+removed by dropping whole partitions instead of deleting them row by row.
+
+Partitions are created ahead of time by the `partition_logs` command. A
+default partition catches log entries for which no partition exists.
+"""
+import datetime
+
+from django.db import connections, transaction
+
+from djangologdb import settings as djangologdb_settings
+from djangologdb.models import LogEntry
+
+PERIODS = ('day', 'week')
+
+def is_supported(connection):
+    """
+    Returns ``True`` if the database of `connection` supports partitioning.
+    """
+    return 'postgresql' in connection.settings_dict['ENGINE']
+
+def get_period_start(date, period=None):
+    """
+    Returns the start of the period that contains `date`. Weeks start on Monday.
+    """
+    period = period or djangologdb_settings.PARTITION_PERIOD
+    if period not in PERIODS:
+        raise ValueError('The partition period needs to be either \'day\' or \'week\'.')
+
+    start = datetime.datetime(date.year, date.month, date.day)
+    if period == 'week':
+        start -= datetime.timedelta(start.weekday())
+    return start
+
+def get_period_end(start, period=None):
+    """
+    Returns the end of the period that starts at `start`.
+    """
+    period = period or djangologdb_settings.PARTITION_PERIOD
+    if period == 'week':
+        return start + datetime.timedelta(7)
+    return start + datetime.timedelta(1)
+
+def get_partition_name(start):
+    return '%s_%s' % (LogEntry._meta.db_table, start.strftime('%Y%m%d'))
+
+def get_default_partition_name():
+    return '%s_default' % LogEntry._meta.db_table
+
+def _quote(connection, name):
+    return connection.ops.quote_name(name)
+
+def _get_partitions(cursor):
+    """
+    Returns the names of the current partitions of the log entry table.
+    """
+    cursor.execute(
+        'SELECT c.relname FROM pg_inherits i '
+        'JOIN pg_class c ON c.oid = i.inhrelid '
+        'JOIN pg_class p ON p.oid = i.inhparent '
+        'WHERE p.relname = %s', [LogEntry._meta.db_table])
+    return [row[0] for row in cursor.fetchall()]
+
+def is_partitioned(using=None):
+    """
+    Returns ``True`` if the log entry table is partitioned.
+    """
+    connection = connections[using or LogEntry.objects.db]
+    if not is_supported(connection):
+        return False
+
+    cursor = connection.cursor()
+    cursor.execute('SELECT relkind FROM pg_class WHERE relname = %s', [LogEntry._meta.db_table])
+    row = cursor.fetchone()
+    return row is not None and row[0] == 'p'
+
+def setup(using=None):
+    """
+    Turns the existing log entry table into a partitioned table. The existing
+    table becomes the partition for all log entries before the current period.
+
+    PostgreSQL requires the primary key of a partitioned table to include the
+    partition column, so the primary key becomes (id, created) and foreign keys
+    that refer to log entries are dropped. Django does not need them.
+    """
+    using = using or LogEntry.objects.db
+    connection = connections[using]
+    if not is_supported(connection):
+        raise ValueError('Partitioning is only supported on PostgreSQL.')
+    if is_partitioned(using):
+        return
+
+    table = LogEntry._meta.db_table
+    legacy_table = '%s_legacy' % table
+    qn = lambda name: _quote(connection, name)
+    cursor = connection.cursor()
+
+    # Drop the foreign keys that refer to the log entry table.
+    cursor.execute(
+        'SELECT c.conrelid::regclass::text, c.conname FROM pg_constraint c '
+        'JOIN pg_class p ON p.oid = c.confrelid '
+        'WHERE c.contype = \'f\' AND p.relname = %s', [table])
+    for referring_table, constraint in cursor.fetchall():
+        cursor.execute('ALTER TABLE %s DROP CONSTRAINT %s' % (referring_table, qn(constraint)))
+
+    # Create the partitioned table in place of the existing table. The
+    # existing table gets the primary key of the partitioned table, which it
+    # needs to become a partition.
+    cursor.execute('ALTER TABLE %s RENAME TO %s' % (qn(table), qn(legacy_table)))
+    cursor.execute(
+        'SELECT c.conname FROM pg_constraint c '
+        'JOIN pg_class t ON t.oid = c.conrelid '
+        'WHERE c.contype = \'p\' AND t.relname = %s', [legacy_table])
+    for constraint, in cursor.fetchall():
+        cursor.execute('ALTER TABLE %s DROP CONSTRAINT %s' % (qn(legacy_table), qn(constraint)))
+    cursor.execute('ALTER TABLE %s ADD PRIMARY KEY (%s, %s)' % (qn(legacy_table), qn('id'), qn('created')))
+    cursor.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS) PARTITION BY RANGE (%s)' % (qn(table), qn(legacy_table), qn('created')))
+    cursor.execute('ALTER TABLE %s ADD PRIMARY KEY (%s, %s)' % (qn(table), qn('id'), qn('created')))
+    cursor.execute('ALTER SEQUENCE %s OWNED BY %s.%s' % (qn('%s_id_seq' % table), qn(table), qn('id')))
+    for f in LogEntry._meta.fields:
+        if f.db_index and not f.primary_key:
+            cursor.execute('CREATE INDEX %s ON %s (%s)' % (qn('%s_%s_idx' % (table, f.column)), qn(table), qn(f.column)))
+    cursor.execute('CREATE TABLE %s PARTITION OF %s DEFAULT' % (qn(get_default_partition_name()), qn(table)))
+
+    # Move the log entries of the current period to their own partition, so
+    # the existing table only contains older log entries.
+    start = get_period_start(datetime.datetime.now())
+    cursor.execute('CREATE TABLE %s PARTITION OF %s FOR VALUES FROM (%%s) TO (%%s)' % (qn(get_partition_name(start)), qn(table)), [start, get_period_end(start)])
+    cursor.execute('INSERT INTO %s SELECT * FROM %s WHERE %s >= %%s' % (qn(table), qn(legacy_table), qn('created')), [start])
+    cursor.execute('DELETE FROM %s WHERE %s >= %%s' % (qn(legacy_table), qn('created')), [start])
+    cursor.execute('ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (MINVALUE) TO (%%s)' % (qn(table), qn(legacy_table)), [start])
+
+    transaction.commit_unless_managed(using=using)
+
+def _get_create_statements(connection, periods, default=None):
+    """
+    Returns the SQL statements and their parameters that create a partition
+    for each of the `periods`, a list of (name, start, end) tuples.
+
+    PostgreSQL refuses to attach a partition if the `default` partition holds
+    log entries of its range. The default partition is therefore detached
+    first, and its log entries of the new periods are moved to their own
+    partition before it is attached again.
+    """
+    table = LogEntry._meta.db_table
+    qn = lambda name: _quote(connection, name)
+    statements = []
+    if default is not None:
+        statements.append(('ALTER TABLE %s DETACH PARTITION %s' % (qn(table), qn(default)), []))
+    for name, start, end in periods:
+        statements.append(('CREATE TABLE %s PARTITION OF %s FOR VALUES FROM (%%s) TO (%%s)' % (qn(name), qn(table)), [start, end]))
+        if default is not None:
+            where = 'WHERE %s >= %%s AND %s < %%s' % (qn('created'), qn('created'))
+            statements.append(('INSERT INTO %s SELECT * FROM %s %s' % (qn(name), qn(default), where), [start, end]))
+            statements.append(('DELETE FROM %s %s' % (qn(default), where), [start, end]))
+    if default is not None:
+        statements.append(('ALTER TABLE %s ATTACH PARTITION %s DEFAULT' % (qn(table), qn(default)), []))
+    return statements
+
+def create_partitions(end_date, using=None):
+    """
+    Creates the partitions for all periods up to and including `end_date`.
+    Log entries of these periods in the default partition are moved to the new
+    partitions. Returns the names of the created partitions.
+    """
+    using = using or LogEntry.objects.db
+    connection = connections[using]
+    cursor = connection.cursor()
+    existing = set(_get_partitions(cursor))
+
+    periods = []
+    start = get_period_start(datetime.datetime.now())
+    while start <= end_date:
+        name = get_partition_name(start)
+        end = get_period_end(start)
+        if name not in existing:
+            periods.append((name, start, end))
+        start = end
+    if len(periods) == 0:
+        return []
+
+    default = get_default_partition_name()
+    if default not in existing:
+        default = None
+    for sql, params in _get_create_statements(connection, periods, default):
+        cursor.execute(sql, params)
+
+    transaction.commit_unless_managed(using=using)
+    return [name for name, start, end in periods]
+
+def drop_partitions(before, using=None):
+    """
+    Drops the partitions that only contain log entries created before `before`,
+    along with the rows that refer to these log entries. Log entries in the
+    partition of the original table are deleted the regular way.
+
+    Returns the names of the dropped partitions.
+    """
+    using = using or LogEntry.objects.db
+    connection = connections[using]
+    table = LogEntry._meta.db_table
+    qn = lambda name: _quote(connection, name)
+    cursor = connection.cursor()
+
+    dropped = []
+    for name in sorted(_get_partitions(cursor)):
+        try:
+            start = datetime.datetime.strptime(name[len(table) + 1:], '%Y%m%d')
+        except ValueError:
+            # The legacy and default partitions.
+            continue
+        if get_period_end(start) > before:
+            continue
+
+        for related in LogEntry._meta.get_all_related_objects():
+            cursor.execute('DELETE FROM %s WHERE %s IN (SELECT %s FROM %s)' % (
+                qn(related.model._meta.db_table), qn(related.field.column), qn('id'), qn(name)))
+        cursor.execute('DROP TABLE %s' % qn(name))
+        dropped.append(name)
+
+    transaction.commit_unless_managed(using=using)
+
+    LogEntry.objects.using(using).filter(created__lt=before).delete()
+    return dropped
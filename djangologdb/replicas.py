@@ -0,0 +1,76 @@
+"""
+Read-only queries on a replica of the log database.
+
+The graphs, the `top/` view and the admin changelists only read log entries,
+so they can use the database with the alias in `LOGDB_REPLICA_DATABASE`. The
+handler and the commands keep using the primary database.
+
+The replica is only used if the newest log entry on it is at most
+`LOGDB_REPLICA_MAX_LAG` older than the newest log entry on the primary
+database. This is checked at most once every `check_interval` seconds per
+process.
+"""
+import datetime
+import time
+
+from django.db import router, transaction
+
+from djangologdb import settings as djangologdb_settings
+from djangologdb.models import LogEntry
+
+check_interval = 5
+
+# The time of the last check and whether the replica could be used, by alias.
+_checks = {}
+
+def get_replica_lag(replica, primary=None):
+    """
+    Returns how far the log entries on the database `replica` are behind the
+    `primary` database, as a `datetime.timedelta`, or ``None`` if the replica
+    can not be used.
+    """
+    if primary is None:
+        primary = router.db_for_read(LogEntry)
+
+    try:
+        latest = list(LogEntry.objects.using(primary).order_by('-created').values_list('created', flat=True)[:1])
+        replica_latest = list(LogEntry.objects.using(replica).order_by('-created').values_list('created', flat=True)[:1])
+    except Exception:
+        try:
+            transaction.rollback_unless_managed(using=replica)
+        except Exception:
+            pass
+        return None
+
+    if len(latest) == 0:
+        return datetime.timedelta(0)
+    if len(replica_latest) == 0:
+        return None
+    return max(latest[0] - replica_latest[0], datetime.timedelta(0))
+
+def get_read_database():
+    """
+    Returns the alias of the database to use for read-only queries on log
+    entries and log aggregates. This is the replica if it is configured and
+    up to date, otherwise the primary database (or ``None`` to leave it up to
+    the database routers).
+    """
+    # Sharded log entries are read from all shards.
+    if djangologdb_settings.SHARDS:
+        return None
+
+    primary = router.db_for_read(LogEntry)
+    replica = djangologdb_settings.REPLICA_DATABASE
+    if replica is None:
+        return primary
+
+    now = time.time()
+    last_check, is_usable = _checks.get(replica, (None, False))
+    if last_check is None or now - last_check >= check_interval:
+        lag = get_replica_lag(replica, primary)
+        is_usable = lag is not None and lag <= djangologdb_settings.REPLICA_MAX_LAG
+        _checks[replica] = (now, is_usable)
+
+    if is_usable:
+        return replica
+    return primary
@@ -0,0 +1,72 @@
+from djangologdb import settings as djangologdb_settings
+
+class LogDBRouter(object):
+    """
+    Database router that stores all django-logdb models in the database with
+    the alias in the `LOGDB_DATABASE` setting. Add it to your Django settings::
+
+        DATABASE_ROUTERS = ['djangologdb.routers.LogDBRouter']
+
+    If `LOGDB_DATABASE` is not set, this router has no effect, except that it
+    does not create tables on the `LOGDB_REPLICA_DATABASE`. Reads from the
+    replica are chosen explicitly, see `djangologdb.replicas`.
+
+    If `LOGDB_SHARDS` is set, objects are read from and written to the shard of
+    their logger name, or the database they were loaded from. Queries without
+    an object go to the first shard, unless they choose a shard with `using`.
+    """
+    app_label = 'djangologdb'
+
+    def _is_logdb_model(self, model):
+        return model._meta.app_label == self.app_label
+
+    def _get_database(self, hints):
+        if not djangologdb_settings.SHARDS:
+            return djangologdb_settings.DATABASE
+
+        instance = hints.get('instance')
+        if instance is not None:
+            if instance._state.db is not None:
+                return instance._state.db
+            if getattr(instance, 'name', None) is not None:
+                # Routers are loaded while django.db is imported, before the
+                # shards module can be.
+                from djangologdb.shards import get_shard
+                return get_shard(instance.name)
+        return djangologdb_settings.SHARDS[0]
+
+    def db_for_read(self, model, **hints):
+        if self._is_logdb_model(model):
+            return self._get_database(hints)
+        return None
+
+    def db_for_write(self, model, **hints):
+        if self._is_logdb_model(model):
+            return self._get_database(hints)
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Objects on different shards are not related.
+        if djangologdb_settings.SHARDS or djangologdb_settings.DATABASE is None:
+            return None
+        if self._is_logdb_model(obj1) and self._is_logdb_model(obj2):
+            return True
+        if self._is_logdb_model(obj1) or self._is_logdb_model(obj2):
+            return False
+        return None
+
+    def allow_syncdb(self, db, model):
+        # The tables of a replica are created by replication.
+        if db == djangologdb_settings.REPLICA_DATABASE and self._is_logdb_model(model):
+            return False
+        if djangologdb_settings.SHARDS:
+            if self._is_logdb_model(model):
+                return db in djangologdb_settings.SHARDS
+            return None
+        if djangologdb_settings.DATABASE is None:
+            return None
+        if self._is_logdb_model(model):
+            return db == djangologdb_settings.DATABASE
+        if db == djangologdb_settings.DATABASE:
+            return False
+        return None
@@ -40,3 +40,86 @@ LEVEL_COLORS = getattr(settings, 'LOGDB_LEVEL_COLORS',
 
 MEDIA_ROOT = getattr(settings, 'LOGDB_MEDIA_ROOT', os.path.join(djangologdb.__path__[0], 'media'))
 MEDIA_URL = getattr(settings, 'LOGDB_MEDIA_URL', '/admin/djangologdb/media/')
+
+# Store repeated strings of log entries (like the logger name and path) in a
+# separate dictionary table.
+INTERN_STRINGS = getattr(settings, 'LOGDB_INTERN_STRINGS', False)
+
+# Compress exception traces and extra attributes that are at least this many
+# characters long.
+COMPRESS_THRESHOLD = getattr(settings, 'LOGDB_COMPRESS_THRESHOLD', 1024)
+
+# Partition the log entry table per 'day' or 'week' (PostgreSQL only). See the
+# `partition_logs` command.
+PARTITION_PERIOD = getattr(settings, 'LOGDB_PARTITION_PERIOD', None)
+
+# The database alias to store log entries in. Requires the router in
+# `djangologdb.routers.LogDBRouter`.
+DATABASE = getattr(settings, 'LOGDB_DATABASE', None)
+
+# Build a search index of the words in log entries when aggregating them.
+SEARCH_INDEX = getattr(settings, 'LOGDB_SEARCH_INDEX', False)
+
+# Cluster messages that are formatted before they are logged into message
+# templates when aggregating them. Messages are put in the same template if at
+# least this fraction of their words are equal.
+CLUSTER_MESSAGES = getattr(settings, 'LOGDB_CLUSTER_MESSAGES', False)
+CLUSTER_SIMILARITY = getattr(settings, 'LOGDB_CLUSTER_SIMILARITY', 0.5)
+
+# Record counters and timers of the handler, the `aggregate_logs` command and
+# `get_datasets`, see `djangologdb.stats`.
+STATS = getattr(settings, 'LOGDB_STATS', False)
+STATS_FLUSH_INTERVAL = getattr(settings, 'LOGDB_STATS_FLUSH_INTERVAL', 60)
+
+# The maximum number of log entries that are collected in a batch before they
+# are written, see `djangologdb.middleware.BatchingMiddleware`.
+BATCH_SIZE = getattr(settings, 'LOGDB_BATCH_SIZE', 100)
+
+# The period over which the rate of log entries of each log aggregate is
+# averaged, for rules with a `rate_factor` condition.
+RATE_PERIOD = getattr(settings, 'LOGDB_RATE_PERIOD', datetime.timedelta(0, 60 * 60))
+
+# The number of hours of log entry counts that each log aggregate keeps for the
+# sparkline in the admin.
+SPARKLINE_HOURS = getattr(settings, 'LOGDB_SPARKLINE_HOURS', 24)
+
+# The database alias of a replica of the log database, for the graphs and the
+# admin changelists. The replica is not used if it is more than
+# `REPLICA_MAX_LAG` behind.
+REPLICA_DATABASE = getattr(settings, 'LOGDB_REPLICA_DATABASE', None)
+REPLICA_MAX_LAG = getattr(settings, 'LOGDB_REPLICA_MAX_LAG', datetime.timedelta(0, 30))
+
+# The directory with the segment files of archived log entries, see the
+# `archive_logs` command.
+ARCHIVE_DIR = getattr(settings, 'LOGDB_ARCHIVE_DIR', None)
+
+# The maximum number of log aggregates per logger name. Log entries that would
+# create more are added to an overflow log aggregate of the logger, after
+# pruning log aggregates that were not seen for `PRUNE_AFTER`.
+MAX_AGGREGATES_PER_LOGGER = getattr(settings, 'LOGDB_MAX_AGGREGATES_PER_LOGGER', None)
+PRUNE_AFTER = getattr(settings, 'LOGDB_PRUNE_AFTER', datetime.timedelta(7))
+
+# The extra attributes of log entries to index when they are written, so log
+# entries can be filtered on them with `filter_extra` and in the admin.
+INDEXED_EXTRA_KEYS = getattr(settings, 'LOGDB_INDEXED_EXTRA_KEYS', ())
+
+# The database aliases to spread log entries over by logger name, instead of
+# `DATABASE`. Requires the router in `djangologdb.routers.LogDBRouter`. See
+# `djangologdb.shards`.
+SHARDS = getattr(settings, 'LOGDB_SHARDS', ())
+
+# The maximum number of seconds the datasets view waits for new log entries,
+# and the number of seconds between updates of the graphs in the admin, or
+# `None` to not update them.
+LONG_POLL_TIMEOUT = getattr(settings, 'LOGDB_LONG_POLL_TIMEOUT', 0)
+GRAPH_REFRESH = getattr(settings, 'LOGDB_GRAPH_REFRESH', None)
+
+# The number of seconds between reads of new log entries for the live tail,
+# and the maximum number of log entries to keep per client that were not sent
+# yet. See `djangologdb.tail`.
+TAIL_INTERVAL = getattr(settings, 'LOGDB_TAIL_INTERVAL', 1)
+TAIL_BUFFER = getattr(settings, 'LOGDB_TAIL_BUFFER', 1000)
+
+# The maximum number of log entries to count for approximate datasets, see
+# `get_datasets`.
+SAMPLE_SIZE = getattr(settings, 'LOGDB_SAMPLE_SIZE', 10000)
@@ -0,0 +1,73 @@
+"""
+Log entries sharded over several databases.
+
+If the `LOGDB_SHARDS` setting lists database aliases, the handler writes each
+log entry to one of them, by a hash of its logger name. Since the logger name
+is part of the checksum of log aggregates, all log entries of a log aggregate
+are on the same shard, and each shard keeps its own log aggregates. The
+`aggregate_logs` command aggregates each shard separately, and the totals are
+the same as with a single database.
+
+`get_datasets` and `get_top` query all shards in parallel with `scatter` and
+merge the results, unless the queryset is bound to one database with `using`.
+"""
+import sys
+import threading
+
+from django.db import connections, router
+
+from djangologdb import settings as djangologdb_settings
+from djangologdb.utils import get_string_id
+
+def get_shard(name):
+    """
+    Returns the alias of the shard for log entries of the logger `name`, or
+    ``None`` if the log entries are not sharded.
+    """
+    if not djangologdb_settings.SHARDS:
+        return None
+    return djangologdb_settings.SHARDS[get_string_id(name or u'') % len(djangologdb_settings.SHARDS)]
+
+def get_shards():
+    """
+    Returns the aliases of the databases with log entries.
+    """
+    if djangologdb_settings.SHARDS:
+        return list(djangologdb_settings.SHARDS)
+
+    from djangologdb.models import LogEntry
+    return [router.db_for_write(LogEntry)]
+
+def scatter(func, aliases=None):
+    """
+    Calls `func` with each of the database `aliases` in a thread of its own,
+    and returns the results in the same order. The default is all shards. An
+    exception in any of the threads is raised again.
+    """
+    if aliases is None:
+        aliases = get_shards()
+    if len(aliases) == 1:
+        return [func(aliases[0])]
+
+    results = [None] * len(aliases)
+    errors = []
+
+    def run(i, alias):
+        try:
+            try:
+                results[i] = func(alias)
+            except:
+                errors.append(sys.exc_info())
+        finally:
+            # Each thread has its own database connection.
+            connections[alias].close()
+
+    threads = [threading.Thread(target=run, args=(i, alias)) for i, alias in enumerate(aliases)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
@@ -0,0 +1,13 @@
+from django.dispatch import Signal
+
+# Sent by `djangologdb.stats.flush` with the `stats` of this process since the
+# previous flush.
+stats_flushed = Signal(providing_args=['stats'])
+
+# Sent by the `aggregate_logs` command with the `stats` of the run. Only sent if
+# `LOGDB_STATS` is enabled.
+logs_aggregated = Signal(providing_args=['stats'])
+
+# Sent by `LogQuerySet.get_datasets` with the `stats` of the call. Only sent if
+# `LOGDB_STATS` is enabled.
+datasets_created = Signal(providing_args=['stats'])
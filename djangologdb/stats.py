@@ -0,0 +1,189 @@
+"""
+Counters and timers of the logging pipeline.
+
+The handler, the `aggregate_logs` command and `get_datasets` only record stats
+if `LOGDB_STATS` is enabled. Otherwise, the only overhead is checking that
+setting.
+
+Stats are kept per process and added to the stats in Django's cache by
+`flush`, at most every `LOGDB_STATS_FLUSH_INTERVAL` seconds. The `logdb_stats`
+command shows the stats in the cache, so the cache backend needs to be shared
+between processes (like memcached) to see the stats of all processes.
+
+Timers are stored as the number of times, the total, minimum and maximum time
+in seconds and a histogram with the number of times per bucket in `BUCKETS`.
+"""
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import connections
+
+from djangologdb import settings as djangologdb_settings
+from djangologdb import signals
+
+# The upper bounds of the histogram buckets in seconds. The last bucket is for
+# everything slower.
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+CACHE_KEY = 'djangologdb.stats'
+
+_lock = threading.Lock()
+_counters = {}
+_timers = {}
+_last_flush = time.time()
+
+def _new_timer():
+    return {'count': 0, 'total': 0.0, 'min': None, 'max': None, 'buckets': [0] * (len(BUCKETS) + 1)}
+
+def _merge_timer(timer, other):
+    timer['count'] += other['count']
+    timer['total'] += other['total']
+    for key, choose in (('min', min), ('max', max)):
+        if other[key] is not None:
+            timer[key] = other[key] if timer[key] is None else choose(timer[key], other[key])
+    for i, count in enumerate(other['buckets']):
+        timer['buckets'][i] += count
+
+def incr(name, count=1):
+    """
+    Adds `count` to the counter `name`.
+    """
+    _lock.acquire()
+    try:
+        _counters[name] = _counters.get(name, 0) + count
+    finally:
+        _lock.release()
+
+def timing(name, seconds):
+    """
+    Adds a time of `seconds` to the timer `name`.
+    """
+    bucket = len(BUCKETS)
+    for i, bound in enumerate(BUCKETS):
+        if seconds <= bound:
+            bucket = i
+            break
+
+    _lock.acquire()
+    try:
+        timer = _timers.get(name)
+        if timer is None:
+            timer = _timers[name] = _new_timer()
+        timer['count'] += 1
+        timer['total'] += seconds
+        if timer['min'] is None or seconds < timer['min']:
+            timer['min'] = seconds
+        if timer['max'] is None or seconds > timer['max']:
+            timer['max'] = seconds
+        timer['buckets'][bucket] += 1
+    finally:
+        _lock.release()
+
+def get_stats():
+    """
+    Returns the stats of this process that are not flushed yet, as a dictionary
+    with the `counters` and the `timers`.
+    """
+    _lock.acquire()
+    try:
+        timers = {}
+        for name, timer in _timers.items():
+            timers[name] = _new_timer()
+            _merge_timer(timers[name], timer)
+        return {'counters': dict(_counters), 'timers': timers}
+    finally:
+        _lock.release()
+
+def reset():
+    """
+    Discards the stats of this process.
+    """
+    _lock.acquire()
+    try:
+        _counters.clear()
+        _timers.clear()
+    finally:
+        _lock.release()
+
+def get_shared_stats():
+    """
+    Returns the stats of all processes in the cache, like `get_stats`.
+    """
+    return cache.get(CACHE_KEY) or {'counters': {}, 'timers': {}}
+
+def reset_shared():
+    """
+    Discards the stats in the cache.
+    """
+    cache.delete(CACHE_KEY)
+
+def flush():
+    """
+    Adds the stats of this process to the stats in the cache. Processes that
+    flush at the same time can overwrite each other, so the stats in the cache
+    are approximate.
+    """
+    global _last_flush
+
+    local_stats = get_stats()
+    reset()
+    _last_flush = time.time()
+
+    shared_stats = get_shared_stats()
+    for name, count in local_stats['counters'].items():
+        shared_stats['counters'][name] = shared_stats['counters'].get(name, 0) + count
+    for name, timer in local_stats['timers'].items():
+        _merge_timer(shared_stats['timers'].setdefault(name, _new_timer()), timer)
+    cache.set(CACHE_KEY, shared_stats, 30 * 24 * 60 * 60)
+
+    signals.stats_flushed.send(sender=None, stats=local_stats)
+
+def maybe_flush():
+    """
+    Flushes the stats if the last flush was more than
+    `LOGDB_STATS_FLUSH_INTERVAL` seconds ago.
+    """
+    if time.time() - _last_flush >= djangologdb_settings.STATS_FLUSH_INTERVAL:
+        flush()
+
+class _CountingCursor(object):
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def execute(self, *args, **kwargs):
+        self.counter.count += 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self.counter.count += 1
+        return self.cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+class QueryCounter(object):
+    """
+    Counts the queries on the connection of `using` in the current thread
+    between `start` and `stop`, regardless of the `DEBUG` setting.
+    """
+    def __init__(self, using):
+        self.connection = connections[using]
+        self.count = 0
+
+    def start(self):
+        # Counters can be nested, so keep any wrapped cursor method.
+        self.previous = self.connection.__dict__.get('cursor')
+        cursor = self.connection.cursor
+        self.connection.cursor = lambda: _CountingCursor(cursor(), self)
+
+    def stop(self):
+        if self.previous is None:
+            del self.connection.cursor
+        else:
+            self.connection.cursor = self.previous
+        return self.count
@@ -0,0 +1,240 @@
+"""
+Live tail of new log entries.
+
+The `tail/` view streams new log entries to the browser as server-sent events.
+Instead of querying the database for each client, a single `Poller` thread per
+process reads the log entries after the newest one it has seen, once every
+`LOGDB_TAIL_INTERVAL` seconds, and hands them to the `Subscriber` of each
+client whose filters they match. The poller only runs while there are
+subscribers.
+
+Each subscriber keeps at most `LOGDB_TAIL_BUFFER` log entries that were not
+sent yet. If a client can not keep up, the oldest ones are dropped and the
+client is told how many.
+"""
+import collections
+import logging
+import threading
+import time
+
+from django.db import connections, transaction
+
+from djangologdb import settings as djangologdb_settings
+from djangologdb.aggregation import get_checksum
+from djangologdb.models import LogEntry
+from djangologdb.shards import get_shards
+from djangologdb.utils import get_timestamp
+
+# The maximum number of log entries to read per database in one query.
+batch_size = 1000
+
+class Subscriber(object):
+    """
+    A client of the poller, with the log entries that were not sent to it yet.
+
+    Only log entries with at least `level`, of a logger whose name starts with
+    `name` or of the `log_aggregate` are kept. Log entries that were not
+    aggregated yet are matched by their checksum, without the templates of
+    pre-formatted messages.
+    """
+    def __init__(self, level=None, name=None, log_aggregate=None, buffer_size=None):
+        if buffer_size is None:
+            buffer_size = djangologdb_settings.TAIL_BUFFER
+        self.level = level
+        self.name = name
+        self.log_aggregate = log_aggregate
+        self.events = collections.deque(maxlen=buffer_size)
+        self.dropped = 0
+        self.condition = threading.Condition()
+
+    def matches(self, log_entry, get_checksum):
+        if self.level is not None and log_entry.level < self.level:
+            return False
+        if self.name and not (log_entry.name or u'').startswith(self.name):
+            return False
+        if self.log_aggregate is not None:
+            if log_entry.log_aggregate_id is not None:
+                return log_entry.log_aggregate_id == self.log_aggregate.pk
+            return get_checksum(log_entry) == self.log_aggregate.checksum
+        return True
+
+    def put(self, events):
+        self.condition.acquire()
+        try:
+            for event in events:
+                if len(self.events) == self.events.maxlen:
+                    self.dropped += 1
+                self.events.append(event)
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def get(self, timeout):
+        """
+        Waits at most `timeout` seconds for log entries, and returns them with
+        the number of log entries that were dropped since the last call.
+        """
+        self.condition.acquire()
+        try:
+            if not self.events:
+                self.condition.wait(timeout)
+            events = list(self.events)
+            dropped = self.dropped
+            self.events.clear()
+            self.dropped = 0
+        finally:
+            self.condition.release()
+        return events, dropped
+
+def get_event(log_entry):
+    """
+    Returns the data of the server-sent event for `log_entry`.
+    """
+    return {
+        'id': log_entry.pk,
+        'created': get_timestamp(log_entry.created),
+        'level': log_entry.level,
+        'level_name': logging.getLevelName(log_entry.level),
+        'name': log_entry.name,
+        'message': log_entry.get_message(),
+        'filename': log_entry.filename,
+        'line_number': log_entry.line_number,
+        'function_name': log_entry.function_name,
+        'log_aggregate': log_entry.log_aggregate_id,
+    }
+
+class Poller(object):
+    """
+    Reads new log entries and hands them to the subscribers.
+    """
+    def __init__(self, interval=None):
+        if interval is None:
+            interval = djangologdb_settings.TAIL_INTERVAL
+        self.interval = interval
+        self.subscribers = set()
+        self.condition = threading.Condition()
+        self.thread = None
+        # The id of the newest log entry that was read, by database alias.
+        self.last_ids = {}
+
+    def subscribe(self, level=None, name=None, log_aggregate=None, buffer_size=None):
+        subscriber = Subscriber(level, name, log_aggregate, buffer_size)
+        self.condition.acquire()
+        try:
+            self.subscribers.add(subscriber)
+            self.condition.notify()
+        finally:
+            self.condition.release()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.condition.acquire()
+        try:
+            self.subscribers.discard(subscriber)
+        finally:
+            self.condition.release()
+
+    def start(self):
+        """
+        Starts the thread of the poller, unless it is running.
+        """
+        self.condition.acquire()
+        try:
+            if self.thread is None or not self.thread.isAlive():
+                self.thread = threading.Thread(target=self.run, name='djangologdb-tail')
+                self.thread.setDaemon(True)
+                self.thread.start()
+        finally:
+            self.condition.release()
+
+    def run(self):
+        while True:
+            self.condition.acquire()
+            try:
+                if not self.subscribers:
+                    # Log entries written without subscribers are skipped.
+                    self.last_ids = {}
+                    while not self.subscribers:
+                        self.condition.wait()
+            finally:
+                self.condition.release()
+
+            for alias in get_shards():
+                try:
+                    self.poll(alias)
+                    # End the transaction, so the next poll sees new log
+                    # entries.
+                    transaction.rollback_unless_managed(using=alias)
+                except Exception:
+                    # Try again with a new connection.
+                    connections[alias].close()
+            time.sleep(self.interval)
+
+    def poll(self, alias):
+        """
+        Hands the log entries in the database `alias` that were written since
+        the last call to the subscribers. The first call only looks up the
+        newest log entry.
+        """
+        queryset = LogEntry.objects.using(alias)
+        if alias not in self.last_ids:
+            self.last_ids[alias] = (list(queryset.order_by('-pk').values_list('pk', flat=True)[:1]) or [0])[0]
+            return
+
+        while True:
+            log_entries = list(queryset.filter(pk__gt=self.last_ids[alias]).order_by('pk')[:batch_size])
+            if len(log_entries) == 0:
+                break
+            self.last_ids[alias] = log_entries[-1].pk
+            self._publish(log_entries)
+            if len(log_entries) < batch_size:
+                break
+
+    def _publish(self, log_entries):
+        self.condition.acquire()
+        try:
+            subscribers = list(self.subscribers)
+        finally:
+            self.condition.release()
+
+        # Checksums are only calculated once per log entry, and only if a
+        # subscriber needs them.
+        checksums = {}
+        def get_log_entry_checksum(log_entry):
+            if log_entry.pk not in checksums:
+                checksums[log_entry.pk] = get_checksum(log_entry)[0]
+            return checksums[log_entry.pk]
+
+        matches = dict([(subscriber, []) for subscriber in subscribers])
+        for log_entry in log_entries:
+            for subscriber in subscribers:
+                if subscriber.matches(log_entry, get_log_entry_checksum):
+                    matches[subscriber].append(log_entry)
+
+        # The messages need the arguments of the log entries that are sent.
+        sent = dict([(log_entry.pk, log_entry) for entries in matches.values() for log_entry in entries]).values()
+        if len(sent) == 0:
+            return
+        LogEntry.objects.db_manager(sent[0]._state.db).load_details(sent)
+        events = dict([(log_entry.pk, get_event(log_entry)) for log_entry in sent])
+
+        for subscriber, entries in matches.items():
+            if entries:
+                subscriber.put([events[log_entry.pk] for log_entry in entries])
+
+_poller = None
+_lock = threading.Lock()
+
+def get_poller():
+    """
+    Returns the poller of this process, and starts it if needed.
+    """
+    global _poller
+    _lock.acquire()
+    try:
+        if _poller is None:
+            _poller = Poller()
+    finally:
+        _lock.release()
+    _poller.start()
+    return _poller
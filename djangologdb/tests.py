@@ -2,9 +2,12 @@
 import logging
 import datetime
 import copy
+import sys
+from StringIO import StringIO
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.core.management import call_command
+from django.db import connection
 
 from djangologdb.models import LogEntry, LogAggregate
 from djangologdb.handlers import DjangoDatabaseHandler, add_handler
@@ -237,3 +240,1182 @@ class LogTest(TestCase):
         self.assertEqual(normal_log_entry.line_number, rule_log_entry.line_number)
         self.assertEqual(normal_log_entry.thread, rule_log_entry.thread)
         self.assertEqual(normal_log_entry.process, rule_log_entry.process)
+
+    def test_search(self):
+        from djangologdb import settings
+
+        old_search_index = settings.SEARCH_INDEX
+        settings.SEARCH_INDEX = True
+        try:
+            self._foo(logging.WARNING, 'Django')
+            self._foo(logging.WARNING, 'Python')
+            call_command('aggregate_logs')
+        finally:
+            settings.SEARCH_INDEX = old_search_index
+
+        self.assertEqual(LogEntry.objects.search('django GREAT').count(), 1)
+        self.assertEqual(LogEntry.objects.search('great').count(), 2)
+        self.assertEqual(LogEntry.objects.search('ruby').count(), 0)
+        self.assertEqual(LogAggregate.objects.search('python').count(), 1)
+
+    def test_exception_aggregation(self):
+        def fail(exception_class, value):
+            try:
+                raise exception_class('Invalid value: %r' % value)
+            except exception_class, e:
+                # Logs the exception message, like the LoggingMiddleware.
+                logger.error(unicode(e), exc_info=True)
+
+        fail(ValueError, 1)
+        fail(ValueError, 2)
+        fail(KeyError, 1)
+
+        log_entries = LogEntry.objects.order_by('pk')
+        self.assertTrue(log_entries[0].exc_text.startswith('Traceback'))
+        self.assertEqual(log_entries[0].fingerprint, log_entries[1].fingerprint)
+        self.assertNotEqual(log_entries[0].fingerprint, log_entries[2].fingerprint)
+
+        # Different messages but the same exception.
+        call_command('aggregate_logs')
+        self.assertEqual(LogAggregate.objects.count(), 2)
+
+    def test_message_clustering(self):
+        from djangologdb import settings
+        from djangologdb.models import LogTemplate
+
+        def log(msg):
+            # Log from the same line, like a library would.
+            logger.warning(msg)
+
+        old_cluster_messages = settings.CLUSTER_MESSAGES
+        settings.CLUSTER_MESSAGES = True
+        try:
+            log('Request 1234 took 35 ms')
+            log('Request 99 took 12 ms')
+            log('Django is great')
+            call_command('aggregate_logs', skip_actions=True)
+            self.assertEqual(LogAggregate.objects.count(), 2)
+            self.assertEqual(LogTemplate.objects.count(), 2)
+
+            # The templates are used again in the next run.
+            log('Request 7 took 1 ms')
+            call_command('aggregate_logs', skip_actions=True)
+            self.assertEqual(LogAggregate.objects.count(), 2)
+            self.assertEqual(LogAggregate.objects.get(msg=u'Request <*> took <*> ms').times_seen, 3)
+        finally:
+            settings.CLUSTER_MESSAGES = old_cluster_messages
+
+    def test_batching(self):
+        from django.http import HttpRequest, HttpResponse
+        from djangologdb import settings
+        from djangologdb.middleware import BatchingMiddleware
+        from djangologdb.stats import QueryCounter
+
+        request = HttpRequest()
+        request.path = '/batch/'
+        request.method = 'GET'
+        middleware = BatchingMiddleware()
+
+        middleware.process_request(request)
+        for i in range(40):
+            self._foo(logging.WARNING, str(i))
+        self.assertEqual(LogEntry.objects.count(), 0)
+
+        query_counter = QueryCounter(LogEntry.objects.db)
+        query_counter.start()
+        try:
+            middleware.process_response(request, HttpResponse())
+        finally:
+            queries = query_counter.stop()
+
+        # One query for the log entries and one for their details.
+        self.assertEqual(queries, 2)
+        log_entries = LogEntry.objects.order_by('pk')
+        self.assertEqual(log_entries.count(), 40)
+        self.assertEqual(log_entries[39].get_message(), u'39 is great')
+        self.assertEqual(log_entries[0].extra['request_path'], '/batch/')
+        self.assertEqual(log_entries[0].extra['request_id'], request.logdb_context['request_id'])
+
+        # Log entries are written when the batch is full.
+        old_batch_size = settings.BATCH_SIZE
+        settings.BATCH_SIZE = 2
+        try:
+            middleware.process_request(request)
+            for i in range(3):
+                self._foo(logging.WARNING, str(i))
+            self.assertEqual(LogEntry.objects.count(), 42)
+            middleware.process_response(request, HttpResponse())
+            self.assertEqual(LogEntry.objects.count(), 43)
+        finally:
+            settings.BATCH_SIZE = old_batch_size
+
+    def test_top(self):
+        now = datetime.datetime.now()
+        for i in range(4):
+            self._foo(logging.WARNING, 'Django')
+        self._foo(logging.ERROR, 'Django')
+        call_command('aggregate_logs', skip_actions=True)
+
+        # Move two warnings to the previous hour.
+        pks = LogEntry.objects.filter(level=logging.WARNING).values_list('pk', flat=True)[:2]
+        LogEntry.objects.filter(pk__in=list(pks)).update(created=now - datetime.timedelta(0, 90 * 60))
+
+        top = LogEntry.objects.get_top(end_date=now + datetime.timedelta(0, 60))
+        self.assertEqual([(row['log_aggregate'].level, row['count']) for row in top], [(logging.WARNING, 2), (logging.ERROR, 1)])
+
+        top = LogEntry.objects.get_top(1, end_date=now + datetime.timedelta(0, 60), by='growth')
+        self.assertEqual(len(top), 1)
+        self.assertEqual((top[0]['log_aggregate'].level, top[0]['growth'], top[0]['previous_count']), (logging.ERROR, 1, 0))
+
+        top = LogEntry.objects.get_top(end_date=now + datetime.timedelta(0, 60), level=logging.ERROR)
+        self.assertEqual([row['count'] for row in top], [1])
+
+    def test_datasets_view(self):
+        from django.http import HttpRequest, QueryDict
+        from django.utils import simplejson
+        from djangologdb import views
+        from djangologdb.utils import get_timestamp
+
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        params = 'start_date=%d&end_date=%d&interval_seconds=3600' % (get_timestamp(today - datetime.timedelta(1)), get_timestamp(today + datetime.timedelta(1)))
+
+        def get_datasets(query):
+            request = HttpRequest()
+            request.GET = QueryDict('%s&%s' % (params, query))
+            response = views.datasets(request)
+            self.assertEqual(response.status_code, 200)
+            return simplejson.loads(response.content)
+
+        self._foo(logging.WARNING, 'Django')
+        self._foo(logging.WARNING, 'Django')
+        result = get_datasets('last_id=')
+        self.assertEqual(result['last_id'], str(LogEntry.objects.latest('pk').pk))
+        self.assertEqual(len(result['datasets']['30']['data']), 48)
+        self.assertEqual(sum([count for timestamp, count in result['datasets']['30']['data']]), 2)
+
+        # Nothing changed.
+        self.assertEqual(get_datasets('last_id=%s&wait=0' % result['last_id'])['datasets'], {})
+
+        # Only the data points from the current one on are returned.
+        self._foo(logging.ERROR, 'Django')
+        since = get_timestamp(datetime.datetime.now().replace(minute=0, second=0, microsecond=0))
+        changes = get_datasets('last_id=%s&since=%d' % (result['last_id'], since))
+        self.assertNotEqual(changes['last_id'], result['last_id'])
+        self.assertEqual(changes['datasets']['40']['data'], [[since, 1]])
+        self.assertEqual(changes['datasets']['30']['data'], [[since, 2]])
+
+        # Datasets by checksum also change when the log entries are aggregated.
+        result = get_datasets('aggregate=checksum&last_id=')
+        self.assertEqual(result['datasets'], {})
+        call_command('aggregate_logs', skip_actions=True)
+        changes = get_datasets('aggregate=checksum&last_id=%s&wait=0' % result['last_id'])
+        self.assertNotEqual(changes['last_id'], result['last_id'])
+        self.assertEqual(len(changes['datasets']), 2)
+        self.assertEqual(get_datasets('aggregate=checksum&last_id=%s&wait=0' % changes['last_id'])['datasets'], {})
+
+    def test_tail(self):
+        from djangologdb.tail import Poller
+
+        self._foo(logging.WARNING, 'Django')
+        call_command('aggregate_logs', skip_actions=True)
+        log_aggregate = LogAggregate.objects.get()
+
+        poller = Poller()
+        warnings = poller.subscribe(level=logging.WARNING)
+        named = poller.subscribe(name='djangologdb.te')
+        aggregate = poller.subscribe(log_aggregate=log_aggregate)
+        small = poller.subscribe(buffer_size=2)
+
+        # Existing log entries are not sent.
+        poller.poll('default')
+        self.assertEqual(warnings.get(0), ([], 0))
+
+        self._foo(logging.WARNING, 'Django')
+        self._foo(logging.INFO, 'Django')
+        logging.getLogger('djangologdb.tests').error('Tailed')
+        poller.poll('default')
+
+        events, dropped = warnings.get(0)
+        self.assertEqual([(event['level'], event['message']) for event in events], [(logging.WARNING, 'Django is great'), (logging.ERROR, 'Tailed')])
+        self.assertEqual([event['name'] for event in named.get(0)[0]], ['djangologdb.tests'])
+        # The new warning is not aggregated yet, but has the same checksum.
+        self.assertEqual([event['level'] for event in aggregate.get(0)[0]], [logging.WARNING])
+        events, dropped = small.get(0)
+        self.assertEqual(([event['level'] for event in events], dropped), ([logging.INFO, logging.ERROR], 1))
+
+        poller.unsubscribe(warnings)
+        self.assertEqual(len(poller.subscribers), 3)
+
+    def test_approximate_datasets(self):
+        from djangologdb import settings
+
+        for i in range(6):
+            self._foo(logging.WARNING, 'Django')
+        for i in range(3):
+            self._foo(logging.ERROR, 'Django')
+        start_date = datetime.datetime.now() - datetime.timedelta(1)
+        end_date = datetime.datetime.now() + datetime.timedelta(1)
+
+        # A sample of all log entries is exact.
+        datasets = LogEntry.objects.get_datasets(start_date=start_date, end_date=end_date)
+        approximate = LogEntry.objects.get_datasets(start_date=start_date, end_date=end_date, approximate=True)
+        self.assertEqual([dataset['data'] for dataset in approximate.values()], [dataset['data'] for dataset in datasets.values()])
+        self.assertEqual(approximate[logging.WARNING]['bounds'], [[timestamp, count, count] for timestamp, count in datasets[logging.WARNING]['data']])
+
+        old_sample_size = settings.SAMPLE_SIZE
+        settings.SAMPLE_SIZE = 3
+        try:
+            approximate = LogEntry.objects.get_datasets(start_date=start_date, end_date=end_date, approximate=True)
+        finally:
+            settings.SAMPLE_SIZE = old_sample_size
+        # Every third log entry is counted three times.
+        self.assertEqual(sum([count for timestamp, count in approximate[logging.WARNING]['data']]), 6)
+        for dataset in approximate.values():
+            for (timestamp, count), (bounds_timestamp, lower, upper) in zip(dataset['data'], dataset['bounds']):
+                self.assertTrue(lower <= count <= upper)
+
+    def test_rate_rules(self):
+        from djangologdb import settings
+
+        old_rules = settings.RULES
+        settings.RULES = [{
+            'conditions': {
+                'min_level': logging.WARNING,
+                'qualname': '',
+                'rate_factor': 2,
+            },
+            'actions': {
+                'level': logging.CRITICAL,
+            }
+        }]
+        try:
+            self._foo(logging.WARNING, 'Django')
+            call_command('aggregate_logs')
+            log_aggregate = LogAggregate.objects.get()
+            self.assertEqual(log_aggregate.rate, 0)
+
+            # An average of 1 log entry per minute over the last 2 hours.
+            now = datetime.datetime.now()
+            LogAggregate.objects.filter(pk=log_aggregate.pk).update(rate=1, first_seen=now - datetime.timedelta(0, 2 * 60 * 60), rate_updated=now - datetime.timedelta(0, 10 * 60))
+
+            # 15 log entries in 10 minutes is not twice the average.
+            for i in range(15):
+                self._foo(logging.WARNING, 'Django')
+            call_command('aggregate_logs')
+            self.assertEqual(LogEntry.objects.filter(level=logging.CRITICAL).count(), 0)
+
+            log_aggregate = LogAggregate.objects.get()
+            self.assertEqual(log_aggregate.times_seen, 16)
+            self.assertTrue(1 < log_aggregate.rate < 1.5)
+            self.assertTrue(log_aggregate.rate_variance > 0)
+
+            LogAggregate.objects.filter(pk=log_aggregate.pk).update(rate_updated=now - datetime.timedelta(0, 10 * 60))
+            for i in range(30):
+                self._foo(logging.WARNING, 'Django')
+            call_command('aggregate_logs')
+            self.assertEqual(LogEntry.objects.filter(level=logging.CRITICAL).count(), 1)
+        finally:
+            settings.RULES = old_rules
+
+    def test_hourly_counts(self):
+        from djangologdb import settings
+
+        self._foo(logging.WARNING, 'Django')
+        self._foo(logging.WARNING, 'Django')
+        call_command('aggregate_logs', skip_actions=True)
+        log_aggregate = LogAggregate.objects.get()
+        self.assertEqual(log_aggregate.get_hourly_counts()[-1], 2)
+        self.assertEqual(sum(log_aggregate.get_hourly_counts()), 2)
+        self.assertEqual(len(log_aggregate.get_sparkline()), settings.SPARKLINE_HOURS)
+
+        hour = datetime.timedelta(0, 60 * 60)
+        now = datetime.datetime(2010, 1, 1, 12, 30)
+        log_aggregate = LogAggregate()
+        log_aggregate.add_hourly_counts([now - 2 * hour, now - hour, now - hour, now - 30 * hour], now)
+        self.assertEqual(log_aggregate.get_hourly_counts(now)[-3:], [1, 2, 0])
+        self.assertEqual(log_aggregate.get_hourly_counts(now + hour)[-4:], [1, 2, 0, 0])
+
+        # Old hours are overwritten.
+        later = now + (settings.SPARKLINE_HOURS - 2) * hour
+        log_aggregate.add_hourly_counts([later], later)
+        self.assertEqual(log_aggregate.get_hourly_counts(later), [2] + [0] * (settings.SPARKLINE_HOURS - 2) + [1])
+
+    def test_rebuild_aggregates(self):
+        self._foo(logging.WARNING, 'Django')
+        self._foo(logging.WARNING, 'Python')
+        self._foo(logging.ERROR, 'Django')
+        call_command('aggregate_logs', skip_actions=True)
+        self.assertEqual(LogAggregate.objects.count(), 2)
+
+        # Mess up the log aggregates.
+        stale = LogAggregate.objects.create(checksum='stale', level=logging.INFO)
+        LogEntry.objects.filter(level=logging.ERROR).update(log_aggregate=stale)
+        LogAggregate.objects.filter(level=logging.WARNING).update(times_seen=10)
+        LogAggregate.objects.filter(level=logging.ERROR).delete()
+        self._foo(logging.WARNING, 'Ruby')
+
+        call_command('rebuild_aggregates', processes=1, chunk_size=2, verbosity=0)
+        self.assertEqual(sorted(LogAggregate.objects.values_list('level', 'times_seen')), [(logging.WARNING, 3), (logging.ERROR, 1)])
+        self.assertEqual(LogEntry.objects.filter(log_aggregate=None).count(), 0)
+        for log_aggregate in LogAggregate.objects.all():
+            self.assertEqual(log_aggregate.logentry_set.count(), log_aggregate.times_seen)
+            self.assertEqual(sum(log_aggregate.get_hourly_counts()), log_aggregate.times_seen)
+
+    def test_buffer(self):
+        import imp
+        from django.conf import settings
+        from djangologdb import handlers
+
+        handler = DjangoDatabaseHandler()
+        handler.buffer_size = 2
+        def log(msg):
+            handler.emit(logging.LogRecord('buffer', logging.ERROR, __file__, 1, msg, (), None))
+
+        # Django is not ready while the settings module is imported.
+        handlers.LogEntry = None
+        wrapped = settings._wrapped
+        settings._wrapped = None
+        try:
+            log('Django is great')
+            log('Python is great')
+            log('Ruby is great')
+        finally:
+            settings._wrapped = wrapped
+        self.assertEqual(LogEntry.objects.count(), 0)
+        self.assertEqual(handler.dropped, 1)
+
+        # The buffered records are written before the next one.
+        log('Java is great')
+        self.assertEqual(list(LogEntry.objects.order_by('pk').values_list('msg', flat=True)), [u'Django is great', u'Python is great', u'Java is great'])
+        self.assertEqual(handler.buffer, [])
+
+        # Importing other modules, in any thread, does not delay records.
+        handlers.LogEntry = None
+        imp.acquire_lock()
+        try:
+            log('Perl is great')
+        finally:
+            imp.release_lock()
+        self.assertEqual(LogEntry.objects.filter(msg='Perl is great').count(), 1)
+        self.assertEqual(handler.buffer, [])
+
+    def test_max_aggregates_per_logger(self):
+        from djangologdb import settings
+
+        old_max_aggregates = settings.MAX_AGGREGATES_PER_LOGGER
+        settings.MAX_AGGREGATES_PER_LOGGER = 2
+        try:
+            for msg in ['Django %s', 'Python %s', 'Ruby %s']:
+                logger.warning(msg, 'is great')
+            output = StringIO()
+            old_stdout, sys.stdout = sys.stdout, output
+            try:
+                call_command('aggregate_logs', skip_actions=True)
+            finally:
+                sys.stdout = old_stdout
+
+            log_aggregates = LogAggregate.objects.filter(name='root')
+            self.assertEqual(log_aggregates.filter(is_overflow=False).count(), 2)
+            overflow = log_aggregates.get(is_overflow=True)
+            self.assertEqual(overflow.times_seen, 1)
+            self.assertEqual(overflow.logentry_set.count(), 1)
+            # The overflow is reported.
+            self.assertTrue(LogEntry.objects.filter(name__startswith='djangologdb', level=logging.WARNING).exists())
+            self.assertEqual(output.getvalue().splitlines(), [
+                'Loggers that reached the maximum of 2 log aggregates:',
+                '    root: 1 log entries added to the overflow log aggregate',
+            ])
+
+            # Stale log aggregates are pruned to make room, least seen first.
+            stale = datetime.datetime.now() - settings.PRUNE_AFTER - datetime.timedelta(1)
+            log_aggregates.filter(is_overflow=False).update(last_seen=stale)
+            kept = log_aggregates.filter(is_overflow=False)[0]
+            LogAggregate.objects.filter(pk=kept.pk).update(times_seen=5)
+            logger.error('Java %s', 'is great')
+            call_command('aggregate_logs', skip_actions=True)
+
+            self.assertEqual(log_aggregates.filter(is_overflow=False).count(), 2)
+            self.assertTrue(log_aggregates.filter(pk=kept.pk).exists())
+            self.assertTrue(log_aggregates.filter(level=logging.ERROR, is_overflow=False).exists())
+            overflow = log_aggregates.get(is_overflow=True)
+            self.assertEqual(overflow.times_seen, 2)
+            self.assertEqual(overflow.logentry_set.count(), 2)
+        finally:
+            settings.MAX_AGGREGATES_PER_LOGGER = old_max_aggregates
+
+    def test_filter_extra(self):
+        from djangologdb import settings
+        from djangologdb.handlers import start_batch, end_batch
+
+        old_indexed_extra_keys = settings.INDEXED_EXTRA_KEYS
+        settings.INDEXED_EXTRA_KEYS = ('ip_address', 'request_id')
+        try:
+            logger.warning('Django is great', extra={'ip_address': '127.0.0.1', 'user': 'Django'})
+            logger.warning('Python is great', extra={'ip_address': '10.0.0.1'})
+            start_batch({'request_id': 'abc'})
+            logger.error('Ruby is great', extra={'ip_address': '127.0.0.1'})
+            end_batch()
+
+            self.assertEqual(sorted(LogEntry.objects.filter_extra(ip_address='127.0.0.1').values_list('msg', flat=True)), [u'Django is great', u'Ruby is great'])
+            self.assertEqual(list(LogEntry.objects.filter(level=logging.ERROR).filter_extra(ip_address='127.0.0.1', request_id='abc').values_list('msg', flat=True)), [u'Ruby is great'])
+            self.assertEqual(LogEntry.objects.filter_extra(ip_address='192.168.0.1').count(), 0)
+            self.assertRaises(ValueError, LogEntry.objects.filter_extra, user='Django')
+        finally:
+            settings.INDEXED_EXTRA_KEYS = old_indexed_extra_keys
+
+    def test_single_shard(self):
+        from djangologdb import settings
+
+        self._foo(logging.WARNING, 'Django')
+        self._foo(logging.ERROR, 'Django')
+        start_date = datetime.datetime.now() - datetime.timedelta(1)
+        end_date = datetime.datetime.now() + datetime.timedelta(1)
+        datasets = LogEntry.objects.get_datasets(start_date=start_date, end_date=end_date)
+
+        old_shards = settings.SHARDS
+        settings.SHARDS = ('default',)
+        try:
+            self.assertEqual(LogEntry.objects.get_datasets(start_date=start_date, end_date=end_date), datasets)
+            call_command('aggregate_logs', skip_actions=True)
+            self.assertEqual(LogEntry.objects.filter(log_aggregate=None).count(), 0)
+            self.assertEqual([row['count'] for row in LogEntry.objects.get_top(start_date=start_date, end_date=end_date)], [1, 1])
+        finally:
+            settings.SHARDS = old_shards
+
+    def test_logdb_loadgen(self):
+        call_command('logdb_loadgen', count=200, days=7, levels='INFO:1,ERROR:1', tracebacks=1, seed=1, verbosity=0)
+        self.assertEqual(LogEntry.objects.count(), 200)
+        self.assertEqual(set(LogEntry.objects.values_list('level', flat=True)), set([logging.INFO, logging.ERROR]))
+        self.assertEqual(LogEntry.objects.filter(level=logging.ERROR, fingerprint=None).count(), 0)
+        self.assertTrue(LogEntry.objects.filter(created__lt=datetime.datetime.now() - datetime.timedelta(1)).exists())
+
+        call_command('logdb_loadgen', count=10, handler=True, seed=1, verbosity=0)
+        self.assertEqual(LogEntry.objects.count(), 210)
+
+        call_command('aggregate_logs', skip_actions=True)
+        self.assertEqual(LogEntry.objects.filter(log_aggregate=None).count(), 0)
+        self.assertTrue(LogAggregate.objects.count() < 210)
+
+class InternTest(TestCase):
+
+    def test_intern(self):
+        from djangologdb.models import LogString
+        from djangologdb.utils import get_string_id, InternedCharField
+
+        value = u'djangologdb.tests'
+
+        # The id is derived from the string and the string is added once.
+        id = LogString.objects.intern(value)
+        self.assertEqual(id, get_string_id(value))
+        self.assertEqual(LogString.objects.intern(value), id)
+        self.assertEqual(LogString.objects.filter(value=value).count(), 1)
+
+        # The field resolves ids to strings and lookups to ids.
+        field = InternedCharField()
+        self.assertEqual(field.to_python(id), value)
+        self.assertEqual(field.to_python(value), value)
+        self.assertEqual(field.get_prep_lookup('exact', value), id)
+        self.assertEqual(field.get_prep_lookup('in', [value]), [id])
+        self.assertEqual(LogString.objects.get_value(id + 1), None)
+
+    def test_lookups(self):
+        from django.db.models import Q
+        from djangologdb.models import LogString
+        from djangologdb.utils import InternedCharField, InternedLookup
+
+        # The field itself only supports lookups on the ids.
+        field = InternedCharField()
+        self.assertRaises(TypeError, field.get_prep_lookup, 'startswith', u'djangologdb')
+        lookup = InternedLookup('startswith', u'djangologdb')
+        self.assertEqual(field.get_prep_lookup('in', lookup), lookup)
+
+        # An interned string that is not used by any log entry.
+        LogString.objects.intern(u'djangologdb.unused')
+
+        for name in ('djangologdb.lookups', 'other'):
+            record = logging.LogRecord(name, logging.INFO, __file__, 1, 'Foo', (), None)
+            LogEntry.objects.build_from_record(record).save()
+
+        # Other lookups match the strings, also in Q objects and excludes.
+        self.assertEqual(LogEntry.objects.filter(name__startswith='djangologdb').count(), 1)
+        self.assertEqual(LogEntry.objects.filter(name__icontains='LOGDB').count(), 1)
+        self.assertEqual(LogEntry.objects.filter(Q(name__endswith='lookups') | Q(name__iexact='OTHER')).count(), 2)
+        self.assertEqual(LogEntry.objects.exclude(name__startswith='djangologdb').get().name, 'other')
+        self.assertEqual(LogAggregate.objects.filter(name__startswith='djangologdb').count(), 0)
+
+    def test_lookup_translation(self):
+        from django.core.management.color import no_style
+        from django.db import models
+        from django.db.models.loading import cache
+        from djangologdb.models import InternedQuerySet
+        from djangologdb.utils import InternedCharField
+
+        # Models with an interned string, whatever LOGDB_INTERN_STRINGS is.
+        class InternedManager(models.Manager):
+            def get_query_set(self):
+                return InternedQuerySet(self.model, using=self._db)
+
+        class InternedParent(models.Model):
+            name = InternedCharField()
+            objects = InternedManager()
+
+            class Meta:
+                app_label = 'djangologdb'
+
+        class InternedChild(models.Model):
+            parent = models.ForeignKey(InternedParent)
+            objects = InternedManager()
+
+            class Meta:
+                app_label = 'djangologdb'
+
+        try:
+            cursor = connection.cursor()
+            for model in (InternedParent, InternedChild):
+                for sql in connection.creation.sql_create_model(model, no_style())[0]:
+                    cursor.execute(sql)
+            self._test_lookup_translation(InternedParent, InternedChild)
+        finally:
+            # Other tests, like ones that flush the database, should not see
+            # these models.
+            for model in (InternedParent, InternedChild):
+                del cache.app_models['djangologdb'][model._meta.object_name.lower()]
+            cache._get_models_cache.clear()
+
+    def _test_lookup_translation(self, InternedParent, InternedChild):
+        from django.db.models import Q
+        from djangologdb import settings
+        from djangologdb.utils import InternedLookup, translate_interned_lookups
+
+        # Lookups on the strings become subqueries, the others are unchanged.
+        q = translate_interned_lookups(InternedChild, Q(parent__name__startswith='django') | ~Q(parent__name='python', pk=1))
+        self.assertEqual(q.connector, 'OR')
+        (key, value), child = q.children
+        self.assertEqual(key, 'parent__name__in')
+        self.assertTrue(isinstance(value, InternedLookup))
+        self.assertEqual((value.lookup_type, value.value), ('startswith', 'django'))
+        self.assertTrue(child.negated)
+        self.assertEqual(sorted(child.children), [('parent__name', 'python'), ('pk', 1)])
+
+        old_intern_strings = settings.INTERN_STRINGS
+        settings.INTERN_STRINGS = True
+        try:
+            for name in ('djangologdb', 'pydjango', 'python'):
+                InternedChild.objects.create(parent=InternedParent.objects.create(name=name))
+
+            def names(queryset):
+                return sorted([parent.name for parent in queryset])
+            self.assertEqual(names(InternedParent.objects.filter(name__startswith='django')), ['djangologdb'])
+            self.assertEqual(names(InternedParent.objects.filter(name__istartswith='PY')), ['pydjango', 'python'])
+            self.assertEqual(names(InternedParent.objects.filter(name__icontains='LOG')), ['djangologdb'])
+            self.assertEqual(names(InternedParent.objects.filter(name__in=['python', 'ruby'])), ['python'])
+            self.assertEqual(names(InternedParent.objects.exclude(Q(name__endswith='db') | Q(name='python'))), ['pydjango'])
+            self.assertEqual(names([child.parent for child in InternedChild.objects.filter(parent__name__iexact='PYDJANGO')]), ['pydjango'])
+        finally:
+            settings.INTERN_STRINGS = old_intern_strings
+
+    def test_shards(self):
+        from django.db import connections
+        from djangologdb import settings
+        from djangologdb.models import LogString
+        from djangologdb.shards import get_shard
+        from djangologdb.utils import get_field_value, InternedCharField
+
+        # A second in-memory database as the other shard.
+        connections.databases['logdb_shard'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}
+        old_shards = settings.SHARDS
+        settings.SHARDS = ('default', 'logdb_shard')
+        try:
+            call_command('syncdb', database='logdb_shard', verbosity=0, interactive=False)
+
+            # Each shard has its own dictionary.
+            value = u'djangologdb.tests.shard'
+            id = LogString.objects.db_manager('logdb_shard').intern(value)
+            self.assertEqual(LogString.objects.get_value(id), None)
+            self.assertEqual(LogString.objects.db_manager('logdb_shard').get_value(id), value)
+            self.assertEqual(get_field_value(InternedCharField(), id, 'logdb_shard'), value)
+
+            # Log entries are read with the strings of their own shard.
+            names = ['djangologdb.tests.logger%d' % i for i in range(10)]
+            for name in names:
+                record = logging.LogRecord(name, logging.WARNING, __file__, 1, 'Message of %s', (name,), None, 'test_shards')
+                LogEntry.objects.build_from_record(record).save(using=get_shard(name))
+            self.assertEqual(set([get_shard(name) for name in names]), set(settings.SHARDS))
+            for name in names:
+                log_entry = LogEntry.objects.using(get_shard(name)).get(name=name)
+                self.assertEqual((log_entry.name, log_entry.msg, log_entry.get_message()), (name, 'Message of %s', 'Message of %s' % name))
+        finally:
+            settings.SHARDS = old_shards
+            connections['logdb_shard'].close()
+            del connections._connections['logdb_shard']
+            del connections.databases['logdb_shard']
+
+class ShardTest(TestCase):
+
+    def setUp(self):
+        from django.db import connections
+        from djangologdb import settings
+
+        # A second in-memory database as the other shard.
+        connections.databases['logdb_shard'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}
+        self.old_shards = settings.SHARDS
+        settings.SHARDS = ('default', 'logdb_shard')
+        call_command('syncdb', database='logdb_shard', verbosity=0, interactive=False)
+
+    def tearDown(self):
+        from django.db import connections
+        from djangologdb import settings
+
+        settings.SHARDS = self.old_shards
+        connections['logdb_shard'].close()
+        del connections._connections['logdb_shard']
+        del connections.databases['logdb_shard']
+
+    def test_compress_logs(self):
+        from django.db import connections
+        from djangologdb.models import LogEntryDetail
+        from djangologdb.utils import is_compressed
+
+        # Store uncompressed values on both shards.
+        exc_text = u'Error\n' * 1000
+        for using in ('default', 'logdb_shard'):
+            log_entry = LogEntry.objects.db_manager(using).create(msg=u'Oops', thread=0)
+            LogEntryDetail.objects.db_manager(using).create(log_entry=log_entry)
+            connections[using].cursor().execute('UPDATE %s SET exc_text = %%s' % LogEntryDetail._meta.db_table, [exc_text])
+
+        call_command('compress_logs', verbosity=0)
+
+        for using in ('default', 'logdb_shard'):
+            self.assertTrue(is_compressed(LogEntryDetail.objects.using(using).values_list('exc_text', flat=True).get()))
+
+    def test_rebuild_aggregates(self):
+        from djangologdb.shards import get_shard
+
+        names = ['djangologdb.tests.logger%d' % i for i in range(10)]
+        for name in names:
+            record = logging.LogRecord(name, logging.WARNING, __file__, 1, 'Django', (), None)
+            LogEntry.objects.build_from_record(record).save(using=get_shard(name))
+        LogAggregate.objects.db_manager('logdb_shard').create(checksum='stale', level=logging.INFO)
+
+        # Each shard keeps its own log aggregates.
+        call_command('rebuild_aggregates', processes=1, verbosity=0)
+        for using in ('default', 'logdb_shard'):
+            names_by_shard = [name for name in names if get_shard(name) == using]
+            self.assertEqual(sorted([(log_aggregate.name, log_aggregate.times_seen) for log_aggregate in LogAggregate.objects.using(using)]), [(name, 1) for name in names_by_shard])
+            self.assertEqual(LogEntry.objects.using(using).filter(log_aggregate=None).count(), 0)
+
+    def test_partition_logs(self):
+        from djangologdb import partitions, settings
+
+        old_partition_period = settings.PARTITION_PERIOD
+        settings.PARTITION_PERIOD = 'day'
+        try:
+            # Record what is done on which shard.
+            calls = []
+            old_functions = dict([(name, getattr(partitions, name)) for name in ('is_supported', 'is_partitioned', 'setup', 'create_partitions', 'drop_partitions')])
+            partitions.is_supported = lambda connection: True
+            partitions.is_partitioned = lambda using=None: calls.append(('is_partitioned', using))
+            partitions.setup = lambda using=None: calls.append(('setup', using))
+            partitions.create_partitions = lambda end_date, using=None: calls.append(('create_partitions', using)) or []
+            partitions.drop_partitions = lambda before, using=None: calls.append(('drop_partitions', using)) or []
+            try:
+                call_command('partition_logs', cleanup=10, verbosity=0)
+            finally:
+                for name, function in old_functions.items():
+                    setattr(partitions, name, function)
+        finally:
+            settings.PARTITION_PERIOD = old_partition_period
+
+        self.assertEqual(calls, [(name, using) for using in ('default', 'logdb_shard') for name in ('is_partitioned', 'setup', 'create_partitions', 'drop_partitions')])
+
+    def test_logdb_loadgen(self):
+        from djangologdb.shards import get_shard
+
+        # Each log entry is inserted into the shard of its logger.
+        call_command('logdb_loadgen', count=100, seed=1, verbosity=0)
+        for using in ('default', 'logdb_shard'):
+            names = set([log_entry.name for log_entry in LogEntry.objects.using(using)])
+            self.assertTrue(len(names) > 0)
+            self.assertEqual(set([get_shard(name) for name in names]), set([using]))
+        self.assertEqual(LogEntry.objects.using('default').count() + LogEntry.objects.using('logdb_shard').count(), 100)
+
+    def test_archive_logs(self):
+        import shutil
+        import tempfile
+        from djangologdb import archive, settings
+
+        old_archive_dir = settings.ARCHIVE_DIR
+        settings.ARCHIVE_DIR = tempfile.mkdtemp()
+        try:
+            created = datetime.datetime.now() - datetime.timedelta(10)
+            for using in ('default', 'logdb_shard'):
+                LogEntry.objects.db_manager(using).create(msg=u'Django', thread=0, created=created)
+                LogEntry.objects.using(using).update(created=created)
+
+            # The log entries of both shards are archived to their own segment.
+            call_command('archive_logs', days=1, verbosity=0)
+            for using in ('default', 'logdb_shard'):
+                self.assertEqual(LogEntry.objects.using(using).count(), 0)
+            segments = archive.get_segments()
+            self.assertEqual([segment.count for segment in segments], [1, 1])
+        finally:
+            shutil.rmtree(settings.ARCHIVE_DIR)
+            settings.ARCHIVE_DIR = old_archive_dir
+
+class LogEntryDetailTest(TestCase):
+
+    def test_detail(self):
+        from djangologdb.models import LogEntryDetail
+
+        log_entry = LogEntry.objects.create(msg=u'%s is great', args=(u'Django',), extra={'why': u'Just because!'}, thread=0)
+        self.assertEqual(LogEntryDetail.objects.count(), 1)
+
+        # The bulky fields are only read when accessed.
+        log_entry = LogEntry.objects.get(pk=log_entry.pk)
+        self.assertEqual(log_entry._detail, None)
+        self.assertEqual(log_entry.get_msg_display(), u'%s is great')
+        self.assertEqual(log_entry._detail, None)
+        self.assertEqual(log_entry.get_message(), u'Django is great')
+        self.assertEqual(log_entry.extra, {'why': u'Just because!'})
+
+        # Saving a log entry without touching the details leaves them alone.
+        log_entry = LogEntry.objects.get(pk=log_entry.pk)
+        log_entry.level = logging.ERROR
+        log_entry.save()
+        self.assertEqual(LogEntry.objects.get(pk=log_entry.pk).args, (u'Django',))
+
+        # A log entry without details still works.
+        LogEntryDetail.objects.all().delete()
+        log_entry = LogEntry.objects.select_related('detail').get(pk=log_entry.pk)
+        self.assertEqual(log_entry.get_message(), u'%s is great')
+
+class CompressionTest(TestCase):
+
+    def test_compressed_text(self):
+        from djangologdb.models import LogEntryDetail
+        from djangologdb.utils import is_compressed
+
+        field = LogEntryDetail._meta.get_field('exc_text')
+        exc_text = u'Traceback (most recent call last):\n%s' % (u'  File "foo.py", line 1, in bar\n' * 100)
+        log_entry = LogEntry.objects.create(msg=u'Oops', exc_text=exc_text, extra={}, thread=0)
+
+        # Large values are compressed in the database.
+        raw_value = LogEntryDetail.objects.values_list('exc_text', flat=True).get(pk=log_entry.pk)
+        self.assertTrue(is_compressed(raw_value))
+        self.assertTrue(len(raw_value) < len(exc_text) / 5)
+        self.assertEqual(LogEntry.objects.get(pk=log_entry.pk).exc_text, exc_text)
+
+        # Short values are not compressed, unless they look like they are.
+        self.assertEqual(field.get_db_prep_save(u'Short', connection=connection), u'Short')
+        value = field.get_db_prep_save(u'\x01Short', connection=connection)
+        self.assertTrue(is_compressed(value))
+        self.assertEqual(field.to_python(value), u'\x01Short')
+
+    def test_compress_logs(self):
+        from djangologdb.models import LogEntryDetail
+        from djangologdb.utils import is_compressed
+
+        extra = {'data': u'x' * 2000}
+        exc_text = u'Error\n' * 1000
+        log_entry = LogEntry.objects.create(msg=u'Oops', thread=0)
+
+        # Store uncompressed values, like rows written by older versions.
+        LogEntryDetail.objects.create(log_entry=log_entry)
+        connection.cursor().execute('UPDATE %s SET exc_text = %%s, extra = %%s' % LogEntryDetail._meta.db_table, [exc_text, u'{"data": "%s"}' % extra['data']])
+
+        call_command('compress_logs', verbosity=0)
+
+        raw_exc_text, raw_extra = LogEntryDetail.objects.values_list('exc_text', 'extra').get(pk=log_entry.pk)
+        self.assertTrue(is_compressed(raw_exc_text))
+        self.assertTrue(is_compressed(raw_extra))
+
+        log_entry = LogEntry.objects.get(pk=log_entry.pk)
+        self.assertEqual(log_entry.exc_text, exc_text)
+        self.assertEqual(log_entry.extra, extra)
+
+class LazyDecodeTest(TestCase):
+
+    def test_lazy_decode(self):
+        from djangologdb.models import LogEntryDetail
+
+        log_entry = LogEntry.objects.create(msg=u'%s', args=(u'Django',), extra={'why': u'Just because!'}, thread=0)
+
+        # Values are only decoded when accessed.
+        detail = LogEntryDetail.objects.get(pk=log_entry.pk)
+        self.assertFalse('extra' in detail.__dict__)
+        self.assertEqual(detail.args, (u'Django',))
+        self.assertFalse('extra' in detail.__dict__)
+        self.assertEqual(detail.extra, {'why': u'Just because!'})
+
+        # Values that were never decoded are saved as they are.
+        detail = LogEntryDetail.objects.get(pk=log_entry.pk)
+        field = LogEntryDetail._meta.get_field('extra')
+        self.assertEqual(field.pre_save(detail, False), u'{"why": "Just because!"}')
+        detail.save()
+
+        # Assigned values are encoded.
+        detail.extra = {'why': u'Because.'}
+        detail.save()
+        self.assertEqual(LogEntryDetail.objects.get(pk=log_entry.pk).extra, {'why': u'Because.'})
+
+class PartitionTest(TestCase):
+
+    def test_periods(self):
+        from djangologdb import partitions
+
+        date = datetime.datetime(2010, 6, 17, 15, 30) # A Thursday.
+        self.assertEqual(partitions.get_period_start(date, 'day'), datetime.datetime(2010, 6, 17))
+        self.assertEqual(partitions.get_period_end(datetime.datetime(2010, 6, 17), 'day'), datetime.datetime(2010, 6, 18))
+        self.assertEqual(partitions.get_period_start(date, 'week'), datetime.datetime(2010, 6, 14))
+        self.assertEqual(partitions.get_period_end(datetime.datetime(2010, 6, 14), 'week'), datetime.datetime(2010, 6, 21))
+        self.assertRaises(ValueError, partitions.get_period_start, date, 'month')
+
+        self.assertEqual(partitions.get_partition_name(datetime.datetime(2010, 6, 14)), '%s_20100614' % LogEntry._meta.db_table)
+
+    def test_create_statements(self):
+        from djangologdb import partitions
+
+        table = LogEntry._meta.db_table
+        start, end = datetime.datetime(2010, 6, 14), datetime.datetime(2010, 6, 15)
+        name = partitions.get_partition_name(start)
+        default = partitions.get_default_partition_name()
+        self.assertEqual(partitions._get_create_statements(connection, [(name, start, end)]), [
+            ('CREATE TABLE "%s" PARTITION OF "%s" FOR VALUES FROM (%%s) TO (%%s)' % (name, table), [start, end]),
+        ])
+
+        # Log entries in the default partition are moved to the new partition
+        # while the default partition is detached.
+        self.assertEqual(partitions._get_create_statements(connection, [(name, start, end)], default), [
+            ('ALTER TABLE "%s" DETACH PARTITION "%s"' % (table, default), []),
+            ('CREATE TABLE "%s" PARTITION OF "%s" FOR VALUES FROM (%%s) TO (%%s)' % (name, table), [start, end]),
+            ('INSERT INTO "%s" SELECT * FROM "%s" WHERE "created" >= %%s AND "created" < %%s' % (name, default), [start, end]),
+            ('DELETE FROM "%s" WHERE "created" >= %%s AND "created" < %%s' % default, [start, end]),
+            ('ALTER TABLE "%s" ATTACH PARTITION "%s" DEFAULT' % (table, default), []),
+        ])
+
+    def test_partitions(self):
+        from djangologdb import partitions
+        from djangologdb.models import LogEntryDetail
+
+        # Partitioning needs PostgreSQL.
+        if not partitions.is_supported(connection):
+            self.assertRaises(ValueError, partitions.setup)
+            return
+
+        now = datetime.datetime.now()
+        def create(days):
+            log_entry = LogEntry.objects.create(msg=u'Oops', exc_text=u'Error', extra={}, thread=0)
+            LogEntry.objects.filter(pk=log_entry.pk).update(created=now + datetime.timedelta(days))
+            return log_entry.pk
+
+        # The existing log entries stay in the existing table.
+        old = create(-10)
+        current = create(0)
+        # The test runs in a transaction, in which the deferred foreign keys
+        # would block changing the tables.
+        connection.cursor().execute('SET CONSTRAINTS ALL IMMEDIATE')
+        partitions.setup()
+        self.assertTrue(partitions.is_partitioned())
+        self.assertEqual(LogEntry.objects.filter(pk__in=[old, current]).count(), 2)
+
+        # Log entries without a partition are moved to the partition that is
+        # created for them.
+        future = create(3)
+        default = partitions.get_default_partition_name()
+        cursor = connection.cursor()
+        def count(table):
+            cursor.execute('SELECT COUNT(*) FROM %s' % connection.ops.quote_name(table))
+            return cursor.fetchone()[0]
+        self.assertEqual(count(default), 1)
+        created = partitions.create_partitions(now + datetime.timedelta(3))
+        self.assertEqual(created[-1], partitions.get_partition_name(partitions.get_period_start(now + datetime.timedelta(3))))
+        self.assertEqual(count(default), 0)
+        self.assertEqual(count(created[-1]), 1)
+
+        # Dropping partitions removes their log entries and details, older log
+        # entries are deleted.
+        dropped = partitions.drop_partitions(now + datetime.timedelta(30))
+        self.assertTrue(partitions.get_partition_name(partitions.get_period_start(now)) in dropped)
+        self.assertTrue(created[-1] in dropped)
+        self.assertEqual(LogEntry.objects.count(), 0)
+        self.assertEqual(LogEntryDetail.objects.filter(log_entry__in=[old, current, future]).count(), 0)
+
+class RouterTest(TestCase):
+
+    def setUp(self):
+        from djangologdb import settings
+        self.old_database = settings.DATABASE
+
+    def tearDown(self):
+        from djangologdb import settings
+        settings.DATABASE = self.old_database
+
+    def test_router(self):
+        from django.contrib.auth.models import User
+        from djangologdb import settings
+        from djangologdb.routers import LogDBRouter
+
+        router = LogDBRouter()
+        settings.DATABASE = None
+        self.assertEqual(router.db_for_write(LogEntry), None)
+        self.assertEqual(router.allow_syncdb('default', LogEntry), None)
+        self.assertEqual(DjangoDatabaseHandler().get_database(), None)
+
+        settings.DATABASE = 'logs'
+        self.assertEqual(router.db_for_read(LogEntry), 'logs')
+        self.assertEqual(router.db_for_write(LogAggregate), 'logs')
+        self.assertEqual(router.db_for_write(User), None)
+        self.assertTrue(router.allow_syncdb('logs', LogEntry))
+        self.assertFalse(router.allow_syncdb('default', LogEntry))
+        self.assertFalse(router.allow_syncdb('logs', User))
+        self.assertEqual(router.allow_syncdb('default', User), None)
+
+    def test_replica(self):
+        from django.db import router
+        from djangologdb import settings, replicas
+        from djangologdb.routers import LogDBRouter
+
+        primary = router.db_for_read(LogEntry)
+        old_replica_database = settings.REPLICA_DATABASE
+        try:
+            settings.REPLICA_DATABASE = None
+            self.assertEqual(replicas.get_read_database(), primary)
+
+            # The only database is always up to date with itself.
+            settings.REPLICA_DATABASE = 'default'
+            self.assertEqual(replicas.get_replica_lag('default'), datetime.timedelta(0))
+            self.assertEqual(replicas.get_read_database(), 'default')
+            self.assertFalse(LogDBRouter().allow_syncdb('default', LogEntry))
+
+            # A replica that can not be used.
+            settings.REPLICA_DATABASE = 'missing'
+            self.assertEqual(replicas.get_replica_lag('missing'), None)
+            self.assertEqual(replicas.get_read_database(), primary)
+        finally:
+            settings.REPLICA_DATABASE = old_replica_database
+
+    def test_shards(self):
+        from djangologdb import settings
+        from djangologdb.routers import LogDBRouter
+        from djangologdb.shards import get_shard, scatter
+
+        router = LogDBRouter()
+        old_shards = settings.SHARDS
+        try:
+            settings.SHARDS = ('logs1', 'logs2')
+            shards = [get_shard('logger%d' % i) for i in range(20)]
+            self.assertEqual(set(shards), set(settings.SHARDS))
+            self.assertEqual(get_shard('logger1'), shards[1])
+
+            # Log entries and log aggregates of a logger are on its shard.
+            self.assertEqual(router.db_for_write(LogEntry, instance=LogEntry(name='logger1')), shards[1])
+            self.assertEqual(router.db_for_write(LogAggregate, instance=LogAggregate(name='logger2')), shards[2])
+            self.assertEqual(router.db_for_read(LogEntry), 'logs1')
+            self.assertTrue(router.allow_syncdb('logs2', LogEntry))
+            self.assertFalse(router.allow_syncdb('default', LogEntry))
+
+            self.assertEqual(scatter(lambda alias: alias.upper(), ['default', 'default']), ['DEFAULT', 'DEFAULT'])
+            def fail(alias):
+                raise ValueError(alias)
+            self.assertRaises(ValueError, scatter, fail, ['default', 'default'])
+        finally:
+            settings.SHARDS = old_shards
+
+class HandlerWriteTest(TransactionTestCase):
+
+    def test_retry(self):
+        from django.db import DatabaseError
+
+        class Handler(DjangoDatabaseHandler):
+            def get_database(self, name=None):
+                return 'default'
+
+        calls = []
+        def write(using):
+            # The log entry is written, but the write fails the first time.
+            record = logging.LogRecord('retry', logging.WARNING, __file__, 1, 'Django', (), None)
+            LogEntry.objects.db_manager(using).create_from_record(record)
+            calls.append(using)
+            if len(calls) == 1:
+                raise DatabaseError('Connection lost')
+
+        # The failed write is rolled back before it is tried again.
+        Handler().write(write, 'retry')
+        self.assertEqual(calls, ['default', 'default'])
+        self.assertEqual(LogEntry.objects.filter(name='retry').count(), 1)
+
+    def test_retry_details(self):
+        from django.db import DatabaseError
+        from djangologdb import models
+        from djangologdb.models import LogEntryDetail
+
+        class Handler(DjangoDatabaseHandler):
+            def get_database(self, name=None):
+                return 'default'
+
+        # The details can not be inserted the first time.
+        failures = []
+        def bulk_insert(model, objs, *args, **kwargs):
+            if model is LogEntryDetail and not failures:
+                failures.append(model)
+                raise DatabaseError('Connection lost')
+            return old_bulk_insert(model, objs, *args, **kwargs)
+
+        old_bulk_insert = models.bulk_insert
+        models.bulk_insert = bulk_insert
+        try:
+            record = logging.LogRecord('retry', logging.WARNING, __file__, 1, 'hello %s', ('world',), None)
+            Handler().write_many([record], [LogEntry.objects.build_from_record(record)])
+        finally:
+            models.bulk_insert = old_bulk_insert
+
+        # The retry writes the details as well.
+        self.assertEqual(failures, [LogEntryDetail])
+        log_entry = LogEntry.objects.get(name='retry')
+        self.assertEqual(LogEntryDetail.objects.count(), 1)
+        self.assertEqual(log_entry.get_message(), u'hello world')
+
+class CopyLogDetailsTest(TransactionTestCase):
+
+    def test_copy_log_details(self):
+        from djangologdb.models import LogEntryDetail
+
+        # The log entry table of version 1.0 with the detail columns.
+        cursor = connection.cursor()
+        table = connection.ops.quote_name(LogEntry._meta.db_table)
+        for column in ('args', 'exc_text', 'extra'):
+            cursor.execute('ALTER TABLE %s ADD COLUMN %s text NULL' % (table, column))
+        old = LogEntry.objects.create(msg=u'Hello %s', thread=0)
+        cursor.execute('UPDATE %s SET args = %%s, exc_text = %%s, extra = %%s' % table, ['["world"]', u'Error', '{"ip_address": "127.0.0.1"}'])
+        new = LogEntry.objects.create(msg=u'Hello %s', args=(u'you',), extra={}, thread=0)
+
+        call_command('copy_log_details', drop_columns=True, verbosity=0)
+
+        old = LogEntry.objects.get(pk=old.pk)
+        self.assertEqual(old.get_message(), u'Hello world')
+        self.assertEqual(old.exc_text, u'Error')
+        self.assertEqual(old.extra, {'ip_address': '127.0.0.1'})
+        self.assertEqual(LogEntry.objects.get(pk=new.pk).get_message(), u'Hello you')
+        self.assertEqual(LogEntryDetail.objects.count(), 2)
+
+        # The columns are gone, so there is nothing left to copy.
+        columns = [row[0] for row in connection.introspection.get_table_description(cursor, LogEntry._meta.db_table)]
+        self.assertFalse('args' in columns)
+        call_command('copy_log_details', verbosity=0)
+        self.assertEqual(LogEntryDetail.objects.count(), 2)
+
+class FingerprintTest(TestCase):
+
+    def test_normalize_traceback(self):
+        from djangologdb.fingerprint import normalize_traceback, get_fingerprint
+
+        exc_text = u"""Traceback (most recent call last):
+  File "/srv/app/views.py", line %d, in detail
+    obj = get_object(pk='%s')
+  File "/srv/app/models.py", line 10, in get_object
+    raise LookupError('Not found: <Obj>' %% pk)
+LookupError: Not found: <Obj at 0x%s>"""
+
+        self.assertEqual(normalize_traceback(exc_text % (12, 'a', '1f')), [
+            u'LookupError',
+            u'/srv/app/views.py in detail',
+            u"obj = get_object(pk='?')",
+            u'/srv/app/models.py in get_object',
+            u"raise LookupError('?' % pk)",
+        ])
+        self.assertEqual(get_fingerprint(exc_text % (12, 'a', '1f')), get_fingerprint(exc_text % (14, 'b', '2e')))
+        self.assertEqual(get_fingerprint(u'Not a traceback'), None)
+        self.assertEqual(get_fingerprint(None), None)
+
+class StatsTest(TestCase):
+
+    def setUp(self):
+        from djangologdb import settings, stats
+        self.old_stats = settings.STATS
+        settings.STATS = True
+        stats.reset()
+        stats.reset_shared()
+
+    def tearDown(self):
+        from djangologdb import settings
+        settings.STATS = self.old_stats
+
+    def test_stats(self):
+        from djangologdb import signals, stats
+
+        handler = DjangoDatabaseHandler()
+        handler.emit(logging.LogRecord('stats', logging.WARNING, __file__, 1, 'Django is great', (), None))
+        local_stats = stats.get_stats()
+        self.assertEqual(local_stats['counters']['handler.records'], 1)
+        self.assertEqual(local_stats['timers']['handler.db_time']['count'], 1)
+
+        received = []
+        def receiver(sender, stats, **kwargs):
+            received.append(stats)
+        signals.logs_aggregated.connect(receiver)
+        try:
+            call_command('aggregate_logs', skip_actions=True)
+        finally:
+            signals.logs_aggregated.disconnect(receiver)
+
+        self.assertEqual(received[0]['counters']['rows'], 1)
+        self.assertEqual(received[0]['counters']['created'], 1)
+        self.assertTrue(received[0]['counters']['queries'] > 0)
+
+        # The command flushes the stats of this process to the cache.
+        shared_stats = stats.get_shared_stats()
+        self.assertEqual(stats.get_stats()['counters'], {})
+        self.assertEqual(shared_stats['counters']['handler.records'], 1)
+        self.assertEqual(shared_stats['counters']['aggregate_logs.created'], 1)
+        self.assertEqual(shared_stats['timers']['aggregate_logs.aggregate_time']['count'], 1)
+
+        LogEntry.objects.get_datasets(start_date=datetime.datetime.now() - datetime.timedelta(1), end_date=datetime.datetime.now())
+        self.assertEqual(stats.get_stats()['counters']['get_datasets.rows'], 1)
+
+class ArchiveTest(TestCase):
+
+    def setUp(self):
+        import tempfile
+        from djangologdb import settings
+        self.old_archive_dir = settings.ARCHIVE_DIR
+        settings.ARCHIVE_DIR = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        from djangologdb import settings
+        shutil.rmtree(settings.ARCHIVE_DIR)
+        settings.ARCHIVE_DIR = self.old_archive_dir
+
+    def test_archive_logs(self):
+        from djangologdb import archive
+
+        handler = DjangoDatabaseHandler()
+        def log(level, msg):
+            handler.emit(logging.LogRecord('archive', level, __file__, 1, msg, (), None))
+
+        now = datetime.datetime.now()
+        for level, hours in [(logging.WARNING, 10 * 24), (logging.WARNING, 3 * 24), (logging.ERROR, 3 * 24 - 2), (logging.WARNING, 3 * 24 - 5), (logging.WARNING, 1)]:
+            log(level, 'Django is great')
+            LogEntry.objects.filter(pk=LogEntry.objects.latest('pk').pk).update(created=now - datetime.timedelta(0, hours * 60 * 60))
+        call_command('aggregate_logs', skip_actions=True)
+
+        def get_all_datasets():
+            result = []
+            for interval in [datetime.timedelta(1), datetime.timedelta(0, 60 * 60)]:
+                for aggregate in ['level', 'checksum']:
+                    result.append(LogEntry.objects.get_datasets(interval=interval, aggregate=aggregate, start_date=now - datetime.timedelta(20), end_date=now))
+            result.append(LogEntry.objects.get_datasets())
+            return result
+
+        datasets = get_all_datasets()
+        call_command('archive_logs', days=1, verbosity=0)
+
+        self.assertEqual(LogEntry.objects.count(), 1)
+        segments = archive.get_segments()
+        self.assertTrue(len(segments) >= 2)
+        self.assertEqual(sum([segment.count for segment in segments]), 4)
+        self.assertEqual(get_all_datasets(), datasets)
+
+        # Filtered querysets only count the log entries in the database.
+        level_datasets = LogEntry.objects.filter(level=logging.WARNING).get_datasets(start_date=now - datetime.timedelta(20), end_date=now)
+        self.assertEqual(sum([count for timestamp, count in level_datasets[logging.WARNING]['data']]), 1)
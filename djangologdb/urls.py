@@ -7,6 +7,9 @@ from djangologdb import views
 
 urlpatterns = patterns('',
     (r'datasets/$', admin.site.admin_view(views.datasets)),
+    (r'top/$', admin.site.admin_view(views.top)),
+    # Never cached, but the response must not be read to add an ETag.
+    (r'tail/$', admin.site.admin_view(views.tail, cacheable=True)),
 )
 
 if settings.DEBUG:
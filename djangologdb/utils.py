@@ -1,9 +1,25 @@
+import base64
 import datetime
+import re
 import time
+import zlib
 
-from django.db import models
+from django import forms
+from django.db import connections, models, router
+from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.loading import get_model
+from django.db.models.sql.constants import QUERY_TERMS, LOOKUP_SEP
 from django.core.serializers.json import DjangoJSONEncoder
 from django.utils import simplejson as json
+from django.utils.encoding import smart_str, force_unicode
+from django.utils.hashcompat import md5_constructor
+
+from djangologdb import settings as djangologdb_settings
+
+# Compressed values start with this character. Uncompressed values that happen
+# to start with it are always compressed, so values remain unambiguous.
+COMPRESSED_MARKER = u'\x01'
 
 def get_timestamp(date_time):
     """
@@ -13,36 +29,290 @@ def get_timestamp(date_time):
     """
     return time.mktime(date_time.timetuple()) * 1000
 
+def get_hour(date_time):
+    """
+    Returns the number of hours since January 1, 1970 00:00 for a `datetime`
+    object.
+    """
+    return int(get_timestamp(date_time) // (60 * 60 * 1000))
+
+def get_seconds(delta):
+    """
+    Returns the number of seconds in the `datetime.timedelta` `delta`.
+    """
+    return delta.days * 24 * 60 * 60 + delta.seconds + delta.microseconds / 1000000.0
+
+def get_field_value(field, value, using=None):
+    """
+    Returns the Python value of `field` for the database `value`, for example
+    from `values_list`, that was read from the database `using`. Interned
+    strings are looked up in the dictionary of that database.
+    """
+    if isinstance(field, InternedCharField):
+        return field.get_value(value, using)
+    return field.to_python(value)
+
 def get_datetime(timestamp):
     """
     Takes a `timestamp` and returns a `datetime` object.
     """
     return datetime.datetime.fromtimestamp(int(timestamp / 1000))
 
+def get_string_id(value):
+    """
+    Returns the id of `value` in the dictionary of interned strings. The id is
+    derived from the string itself (the first 60 bits of its MD5 hash), so it
+    is the same in every process and database.
+    """
+    return int(md5_constructor(smart_str(value)).hexdigest()[:15], 16)
+
+def is_compressed(value):
+    """
+    Returns ``True`` if `value` was compressed with `compress_text`.
+    """
+    return isinstance(value, basestring) and value.startswith(COMPRESSED_MARKER)
+
+def compress_text(value, threshold):
+    """
+    Compresses the string `value` with zlib if it is at least `threshold`
+    characters long. The result is a marker character followed by the base64
+    encoded compressed data, so it can be stored in any text column.
+    """
+    if value is None:
+        return None
+
+    # Values that start with the marker are always compressed, otherwise they
+    # would be mistaken for compressed values when read.
+    has_marker = value.startswith(COMPRESSED_MARKER)
+    if len(value) < threshold and not has_marker:
+        return value
+
+    compressed = COMPRESSED_MARKER + base64.b64encode(zlib.compress(smart_str(value)))
+    if len(compressed) >= len(value) and not has_marker:
+        return value
+
+    return compressed
+
+def decompress_text(value):
+    """
+    Returns the original string of a value created by `compress_text`. Other
+    values are returned as is.
+    """
+    if not is_compressed(value):
+        return value
+
+    try:
+        return force_unicode(zlib.decompress(base64.b64decode(value[1:])))
+    except (TypeError, zlib.error):
+        return value
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+def get_tokens(text, min_length=2, max_length=64):
+    """
+    Returns the set of lowercase words in `text` that are at least `min_length`
+    characters long. Longer words are cut off at `max_length` characters.
+    """
+    tokens = set()
+    for token in TOKEN_RE.findall(text.lower()):
+        if len(token) >= min_length:
+            tokens.add(token[:max_length])
+    return tokens
+
+def bulk_insert(model, objs, using=None, return_ids=False):
+    """
+    Inserts the unsaved instances `objs` of `model` with as few queries as
+    possible. Like `save`, fields are prepared with their `pre_save` and
+    `get_db_prep_save` methods, but explicitly set values of ``auto_now_add``
+    fields are kept.
+    
+    The instances only get their primary key set if `return_ids` is ``True``.
+    This is done with ``RETURNING`` on PostgreSQL and from the last inserted id
+    on SQLite, which assigns consecutive ids within one query. Other databases
+    insert one row per query in that case.
+    """
+    if not objs:
+        return
+
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+
+    fields = [f for f in model._meta.local_fields if not isinstance(f, models.AutoField)]
+    rows = []
+    for obj in objs:
+        row = []
+        for f in fields:
+            if getattr(f, 'auto_now_add', False) and getattr(obj, f.attname) is not None:
+                value = getattr(obj, f.attname)
+            else:
+                value = f.pre_save(obj, True)
+            row.append(f.get_db_prep_save(value, connection=connection))
+        rows.append(row)
+
+    columns = ', '.join([qn(f.column) for f in fields])
+    placeholders = ', '.join(['%s'] * len(fields))
+    is_sqlite = 'sqlite3' in connection.settings_dict['ENGINE']
+    can_return_ids = getattr(connection.features, 'can_return_id_from_insert', False)
+    if is_sqlite:
+        # Older SQLite versions do not support multiple VALUES lists and allow
+        # at most 999 parameters per query.
+        batch_size = max(1, 999 // len(fields))
+        row_sql = 'SELECT %s' % placeholders
+        separator = ' UNION ALL '
+        sql = 'INSERT INTO %s (%s) %%s' % (qn(model._meta.db_table), columns)
+    else:
+        batch_size = 500
+        row_sql = '(%s)' % placeholders
+        separator = ', '
+        sql = 'INSERT INTO %s (%s) VALUES %%s' % (qn(model._meta.db_table), columns)
+
+    pk_column = model._meta.pk.column
+    if return_ids and can_return_ids:
+        sql += ' RETURNING %s' % qn(pk_column)
+    elif return_ids and not is_sqlite:
+        batch_size = 1
+
+    cursor = connection.cursor()
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        params = []
+        for row in batch:
+            params.extend(row)
+        cursor.execute(sql % separator.join([row_sql] * len(batch)), params)
+
+        if not return_ids:
+            continue
+        if can_return_ids:
+            ids = [row[0] for row in cursor.fetchall()]
+        elif is_sqlite:
+            last_id = cursor.lastrowid
+            ids = range(last_id - len(batch) + 1, last_id + 1)
+        else:
+            ids = [connection.ops.last_insert_id(cursor, model._meta.db_table, pk_column)]
+        for obj, id in zip(objs[i:i + batch_size], ids):
+            obj.pk = id
+            obj._state.db = using
+
+class EncodedValue(unicode):
+    """
+    A value exactly as it is stored in the database. Fields that decode their
+    values lazily save it as is.
+    """
+    pass
+
+class LazyDecoder(object):
+    """
+    Descriptor that keeps the database value of a field and only decodes it
+    with the field's `to_python` on first access. Strings that are assigned are
+    treated as encoded values, like `models.SubfieldBase` does.
+    """
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            raise AttributeError('Can only be accessed via an instance.')
+
+        data = obj.__dict__
+        if self.field.encoded_attname in data:
+            data[self.field.attname] = self.field.to_python(data.pop(self.field.encoded_attname))
+        return data[self.field.attname]
+
+    def __set__(self, obj, value):
+        data = obj.__dict__
+        if isinstance(value, basestring):
+            data[self.field.encoded_attname] = value
+            data.pop(self.field.attname, None)
+        else:
+            data[self.field.attname] = value
+            data.pop(self.field.encoded_attname, None)
+
+class LazyDecodeMixin(object):
+    """
+    Mixin for text fields that encode their values, like JSON, and should only
+    decode them when they are actually used. Values that were never decoded are
+    saved without encoding them again.
+    """
+    compress_threshold = None
+
+    def contribute_to_class(self, cls, name):
+        super(LazyDecodeMixin, self).contribute_to_class(cls, name)
+        self.encoded_attname = '_%s_encoded' % self.attname
+        setattr(cls, self.attname, LazyDecoder(self))
+
+    def pre_save(self, model_instance, add):
+        value = model_instance.__dict__.get(self.encoded_attname)
+        if value is not None:
+            # Values that should be compressed but are not, are re-encoded.
+            if self.compress_threshold is None or len(value) < self.compress_threshold or is_compressed(value):
+                return EncodedValue(value)
+
+        return getattr(model_instance, self.attname)
+
+    def get_db_prep_save(self, value, connection):
+        if isinstance(value, EncodedValue):
+            return unicode(value)
 
-class JSONField(models.TextField):
-    __metaclass__ = models.SubfieldBase
+        return super(LazyDecodeMixin, self).get_db_prep_save(self.encode(value), connection=connection)
+
+    def encode(self, value):
+        """
+        Returns the string to store in the database for `value`.
+        """
+        return value
+
+
+class CompressedTextField(LazyDecodeMixin, models.TextField):
+    """
+    A `TextField` that compresses values of at least `compress_threshold`
+    characters. The default threshold is the `LOGDB_COMPRESS_THRESHOLD` setting.
+    Existing uncompressed values can still be read.
+    """
+    def __init__(self, *args, **kwargs):
+        self.compress_threshold = kwargs.pop('compress_threshold', djangologdb_settings.COMPRESS_THRESHOLD)
+        super(CompressedTextField, self).__init__(*args, **kwargs)
+
+    def to_python(self, value):
+        return decompress_text(value)
+
+    def encode(self, value):
+        return compress_text(value, self.compress_threshold)
+
+
+class JSONField(LazyDecodeMixin, models.TextField):
+    """
+    Stores any JSON serializable value. If `compress` is ``True``, large values
+    are compressed like in `CompressedTextField`.
+    """
+    def __init__(self, *args, **kwargs):
+        if kwargs.pop('compress', False):
+            self.compress_threshold = djangologdb_settings.COMPRESS_THRESHOLD
+        super(JSONField, self).__init__(*args, **kwargs)
 
     def to_python(self, value):
         if isinstance(value, basestring) and value:
             try:
-                value = json.loads(value)
+                value = json.loads(decompress_text(value))
             except ValueError:
                 return None
 
         return value
 
-    def get_db_prep_save(self, value, connection):
+    def encode(self, value):
         if value is None:
             return None
 
         value = json.dumps(value, cls=DjangoJSONEncoder)
-        return super(JSONField, self).get_db_prep_save(value, connection=connection)
-
+        if self.compress_threshold is not None:
+            value = compress_text(value, self.compress_threshold)
+        return value
 
-class TupleField(models.TextField):
-    __metaclass__ = models.SubfieldBase
 
+class TupleField(LazyDecodeMixin, models.TextField):
+    """
+    Stores a tuple of JSON serializable values.
+    """
     def to_python(self, value):
         if value is None:
             return None
@@ -55,9 +325,164 @@ class TupleField(models.TextField):
 
         return value
 
+    def encode(self, value):
+        if value is None:
+            return None
+
+        return json.dumps(value, cls=DjangoJSONEncoder)
+
+
+class InternedString(object):
+    """
+    Descriptor that keeps the id of an interned string as it was loaded, and
+    only looks up the string on first access. The string is looked up in the
+    dictionary of the database the instance was loaded from, since every
+    database has its own dictionary.
+    """
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            raise AttributeError('Can only be accessed via an instance.')
+
+        value = obj.__dict__[self.field.attname]
+        if isinstance(value, (int, long)):
+            value = obj.__dict__[self.field.attname] = self.field.get_value(value, obj._state.db)
+        return value
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.field.attname] = value
+
+class InternedLookup(object):
+    """
+    A lookup like ``startswith`` on the strings of an `InternedCharField`, as
+    a subquery for the ids of the matching strings. The subquery runs on the
+    database of the query it is part of, so it uses the dictionary of that
+    database.
+    """
+    lookup_types = ('iexact', 'contains', 'icontains', 'startswith', 'istartswith', 'endswith', 'iendswith', 'regex', 'iregex', 'gt', 'gte', 'lt', 'lte')
+
+    def __init__(self, lookup_type, value):
+        self.lookup_type = lookup_type
+        self.value = value
+
+    def as_sql(self, qn, connection):
+        field = get_model('djangologdb', 'LogString')._meta.get_field('value')
+        table = qn(field.model._meta.db_table)
+        column = connection.ops.lookup_cast(self.lookup_type) % ('%s.%s' % (table, qn(field.column)))
+        sql = '(SELECT %s.%s FROM %s WHERE %s %s)' % (table, qn('id'), table, column, connection.operators[self.lookup_type] % '%s')
+        return sql, field.get_db_prep_lookup(self.lookup_type, self.value, connection=connection)
+
+def _translate_interned_lookup(model, key, value):
+    parts = key.split(LOOKUP_SEP)
+    lookup_type = 'exact'
+    if len(parts) > 1 and parts[-1] in QUERY_TERMS:
+        lookup_type = parts.pop()
+    if lookup_type not in InternedLookup.lookup_types:
+        return key, value
+
+    # Follow relations to the field of the lookup.
+    opts = model._meta
+    field = None
+    for part in parts:
+        if opts is None:
+            return key, value
+        if part == 'pk':
+            field, direct = opts.pk, True
+        else:
+            try:
+                field, field_model, direct, m2m = opts.get_field_by_name(part)
+            except FieldDoesNotExist:
+                return key, value
+        if not direct:
+            opts = field.model._meta
+        elif getattr(field, 'rel', None) is not None:
+            opts = field.rel.to._meta
+        else:
+            opts = None
+
+    if not isinstance(field, InternedCharField):
+        return key, value
+    return LOOKUP_SEP.join(parts + ['in']), InternedLookup(lookup_type, value)
+
+def translate_interned_lookups(model, q):
+    """
+    Returns a copy of the `Q` object `q` for `model`, in which the lookups on
+    an `InternedCharField` that can only be done on the strings, like
+    ``name__startswith``, are replaced by ``in`` lookups of the ids of the
+    matching strings.
+    """
+    translated = Q()
+    translated.connector = q.connector
+    translated.negated = q.negated
+    for child in q.children:
+        if isinstance(child, Q):
+            translated.children.append(translate_interned_lookups(model, child))
+        else:
+            translated.children.append(_translate_interned_lookup(model, *child))
+    return translated
+
+class InternedCharField(models.BigIntegerField):
+    """
+    Stores a string as the id of a `LogString` row instead of the string
+    itself. On the model instance, the value is always the string.
+
+    Because the id is derived from the string, writes only need to check the
+    dictionary once per process and lookups on the field do not need to query
+    the dictionary at all. The ``exact``, ``in`` and ``isnull`` lookups use the
+    ids. Other lookups, like ``startswith``, need a subquery on the dictionary
+    (see `translate_interned_lookups`) and raise a `TypeError` otherwise.
+    """
+    def __init__(self, *args, **kwargs):
+        # Allow this field to be swapped with a `CharField`.
+        kwargs.pop('max_length', None)
+        super(InternedCharField, self).__init__(*args, **kwargs)
+
+    def contribute_to_class(self, cls, name):
+        super(InternedCharField, self).contribute_to_class(cls, name)
+        setattr(cls, self.attname, InternedString(self))
+
+    def get_value(self, value, using=None):
+        """
+        Returns the string for the id `value` from the dictionary of the
+        database `using`. The default is the database of the `LogString` model.
+        """
+        if isinstance(value, (int, long)):
+            return get_model('djangologdb', 'LogString').objects.db_manager(using).get_value(value)
+
+        return value
+
+    def to_python(self, value):
+        return self.get_value(value)
+
+    def get_prep_lookup(self, lookup_type, value):
+        if isinstance(value, InternedLookup):
+            return value
+        if lookup_type not in ('exact', 'in', 'isnull'):
+            raise TypeError('The %s lookup can not be used on interned strings outside of a LogQuerySet or LogAggregateQuerySet.' % lookup_type)
+
+        return super(InternedCharField, self).get_prep_lookup(lookup_type, value)
+
+    def get_db_prep_lookup(self, lookup_type, value, connection, prepared=False):
+        if isinstance(value, InternedLookup):
+            return value
+
+        return super(InternedCharField, self).get_db_prep_lookup(lookup_type, value, connection=connection, prepared=prepared)
+
+    def get_prep_value(self, value):
+        if value is None or isinstance(value, (int, long)):
+            return value
+
+        return get_string_id(value)
+
     def get_db_prep_save(self, value, connection):
         if value is None:
             return None
 
-        value = json.dumps(value, cls=DjangoJSONEncoder)
-        return super(TupleField, self).get_db_prep_save(value, connection=connection)
+        return get_model('djangologdb', 'LogString').objects.db_manager(connection.alias).intern(value)
+
+    def formfield(self, **kwargs):
+        defaults = {'form_class': forms.CharField}
+        defaults.update(kwargs)
+        return models.Field.formfield(self, **defaults)
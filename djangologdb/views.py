@@ -1,10 +1,60 @@
 import datetime
+import time
 
+from django.db import transaction
+from django.db.models import Max
 from django.http import HttpResponseBadRequest, HttpResponse
 from django.utils import simplejson
+from django.utils.cache import patch_cache_control
 
-from djangologdb.utils import get_datetime
-from djangologdb.models import LogEntry
+from djangologdb import settings as djangologdb_settings
+from djangologdb.utils import get_datetime, get_timestamp
+from djangologdb.models import LogEntry, LogAggregate
+from djangologdb.replicas import get_read_database
+from djangologdb.shards import get_shards
+from djangologdb.tail import get_poller
+
+# The number of seconds between checks for new log entries while waiting.
+poll_interval = 1
+
+# The number of seconds after which an idle tail sends a comment, so the
+# connection is not closed and disconnected clients are noticed.
+keepalive_interval = 15
+
+def _get_last_id(queryset, aliases, aggregated=False):
+    """
+    Returns the id of the newest log entry in `queryset` on each of the
+    databases `aliases`, as a comma separated string. Ids are only unique per
+    database, so this is only useful to see if there are new log entries.
+
+    If `aggregated` is set, each id is followed by the time of the last run of
+    ``aggregate_logs`` on that database, which links log entries to their log
+    aggregates later on.
+    """
+    ids = []
+    for alias in aliases:
+        id = str((list(queryset.using(alias).order_by('-pk').values_list('pk', flat=True)[:1]) or [0])[0])
+        if aggregated:
+            last_run = LogAggregate.objects.using(alias).aggregate(last_run=Max('hourly_counts_updated'))['last_run']
+            id = '%s:%d' % (id, last_run and get_timestamp(last_run) or 0)
+        ids.append(id)
+    return ','.join(ids)
+
+def _wait_for_log_entries(queryset, aliases, last_id, timeout, aggregated=False):
+    """
+    Waits at most `timeout` seconds until the newest log entry in `queryset`
+    is no longer `last_id`, and returns the new last id.
+    """
+    deadline = time.time() + timeout
+    while True:
+        new_last_id = _get_last_id(queryset, aliases, aggregated)
+        if new_last_id != last_id or time.time() >= deadline:
+            return new_last_id
+
+        # End the transaction, so the next check sees new log entries.
+        for alias in aliases:
+            transaction.rollback_unless_managed(using=alias)
+        time.sleep(max(min(poll_interval, deadline - time.time()), 0))
 
 def datasets(request):
     """
@@ -28,6 +78,26 @@ def datasets(request):
         
     ``interval_days`` and ``interval_seconds``
         Integers that create a `datetime.timedelta` object.
+    
+    ``approximate``
+        If 1, the datasets are estimated from a sample and have `bounds`.
+    
+    Graphs that are kept up to date can ask for the changes only:
+    
+    ``last_id``
+        The `last_id` of the previous response, or an empty string at first.
+        The result is then a dictionary with the new `last_id` and the
+        `datasets`, which are empty if there are no new log entries. Datasets
+        by checksum also change when log entries are aggregated.
+    
+    ``since``
+        The Javascript timestamp of a data point of the previous response,
+        usually the current one. Only the data points from this one up to the
+        current time are returned.
+    
+    ``wait``
+        The number of seconds to wait for new log entries before responding,
+        at most `LOGDB_LONG_POLL_TIMEOUT`. Requires `last_id`.
     """
     id = request.GET.get('id', None)
     start_date = request.GET.get('start_date', None)
@@ -35,6 +105,10 @@ def datasets(request):
     aggregate = request.GET.get('aggregate', None)
     interval_days = request.GET.get('interval_days', 0)
     interval_seconds = request.GET.get('interval_seconds', 0)
+    last_id = request.GET.get('last_id', None)
+    since = request.GET.get('since', None)
+    wait = request.GET.get('wait', 0)
+    approximate = request.GET.get('approximate', '0') == '1'
 
     if interval_days == 0 and interval_seconds == 0:
         interval = None
@@ -47,13 +121,135 @@ def datasets(request):
         if end_date is not None:
             end_date = get_datetime(int(end_date))
 
-        if id is None:
-            queryset = LogEntry.objects.all()
+        if since is not None:
+            # Data points after the current one can not have changed.
+            start_date = get_datetime(int(since))
+            end_date = max(min(end_date or datetime.datetime.now(), datetime.datetime.now()), start_date)
+
+        database = get_read_database()
+        queryset = LogEntry.objects.using(database)
+        if id is not None:
+            queryset = queryset.filter(pk=int(id))
+
+        if last_id is None:
+            result = queryset.get_datasets(start_date=start_date, end_date=end_date, aggregate=aggregate, interval=interval, approximate=approximate)
         else:
-            queryset = LogEntry.objects.filter(pk=int(id))
+            aliases = database is None and get_shards() or [database]
+            wait = min(float(wait), djangologdb_settings.LONG_POLL_TIMEOUT)
+            new_last_id = _wait_for_log_entries(queryset, aliases, last_id, wait, aggregate == 'checksum')
 
-        result = queryset.get_datasets(start_date=start_date, end_date=end_date, aggregate=aggregate, interval=interval)
+            # Nothing changed without new or aggregated log entries.
+            if new_last_id == last_id:
+                datasets = {}
+            else:
+                datasets = queryset.get_datasets(start_date=start_date, end_date=end_date, aggregate=aggregate, interval=interval, approximate=approximate)
+            result = {'last_id': new_last_id, 'datasets': datasets}
     except:
         return HttpResponseBadRequest()
 
     return HttpResponse(simplejson.dumps(result), mimetype='text/json')
+
+def top(request):
+    """
+    Returns a JSON encoded list of the log aggregates with the most log entries
+    in a period, like `get_top`, with GET-parameters:
+    
+    ``n``
+        The number of log aggregates. The default is 20.
+    
+    ``start_date`` and ``end_date``
+        Javascript timestamps indicating the period. The default is the last
+        hour.
+    
+    ``by``
+        String that can either be 'count' or 'growth'.
+    
+    ``level``
+        Only count log entries with this level.
+    """
+    n = request.GET.get('n', 20)
+    start_date = request.GET.get('start_date', None)
+    end_date = request.GET.get('end_date', None)
+    by = request.GET.get('by', 'count')
+    level = request.GET.get('level', None)
+
+    try:
+        if start_date is not None:
+            start_date = get_datetime(int(start_date))
+        if end_date is not None:
+            end_date = get_datetime(int(end_date))
+        if level is not None:
+            level = int(level)
+
+        top = LogEntry.objects.db_manager(get_read_database()).get_top(int(n), start_date=start_date, end_date=end_date, by=by, level=level)
+    except:
+        return HttpResponseBadRequest()
+
+    result = []
+    for row in top:
+        log_aggregate = row.pop('log_aggregate')
+        row.update({
+            'id': log_aggregate.pk,
+            'checksum': log_aggregate.checksum,
+            'level': log_aggregate.level,
+            'msg': log_aggregate.msg,
+            'name': log_aggregate.name,
+        })
+        result.append(row)
+
+    return HttpResponse(simplejson.dumps(result), mimetype='text/json')
+
+def _stream_events(poller, subscriber):
+    try:
+        yield 'retry: 5000\n\n'
+        while True:
+            events, dropped = subscriber.get(keepalive_interval)
+            if dropped:
+                yield 'event: dropped\ndata: %d\n\n' % dropped
+            for event in events:
+                yield 'data: %s\n\n' % simplejson.dumps(event)
+            if not events and not dropped:
+                yield ': keepalive\n\n'
+    finally:
+        # Called when the server closes the response, after the client went
+        # away.
+        poller.unsubscribe(subscriber)
+
+def tail(request):
+    """
+    Streams new log entries as server-sent events, for an `EventSource` in
+    the browser. Each event contains a JSON object with the log entry. If the
+    client does not keep up, a `dropped` event tells how many log entries were
+    left out. Takes the GET-parameters:
+    
+    ``level``
+        Only send log entries with at least this level.
+    
+    ``name``
+        Only send log entries of loggers whose name starts with this.
+    
+    ``aggregate``
+        Only send log entries of the `LogAggregate` with this id.
+    
+    The response does not end, so it needs a server that handles many
+    requests at the same time, and no middleware that reads the whole
+    response, like the `GZipMiddleware`.
+    """
+    level = request.GET.get('level', None)
+    name = request.GET.get('name', None)
+    aggregate = request.GET.get('aggregate', None)
+
+    try:
+        if level is not None:
+            level = int(level)
+        if aggregate is not None:
+            aggregate = LogAggregate.objects.get(pk=int(aggregate))
+    except:
+        return HttpResponseBadRequest()
+
+    poller = get_poller()
+    subscriber = poller.subscribe(level=level, name=name, log_aggregate=aggregate)
+
+    response = HttpResponse(_stream_events(poller, subscriber), mimetype='text/event-stream')
+    patch_cache_control(response, no_cache=True)
+    return response